@@ -0,0 +1,178 @@
+import os
+import json
+
+import numpy as np
+import torch
+import torchaudio
+from loguru import logger
+
+
+TARGET_SAMPLE_RATE = 48000
+AUDIO_CACHE_INDEX_NAME = "index.json"
+INT16_SCALE = 32767.0
+
+
+def get_resampler(resamplers, orig_sr, new_sr=TARGET_SAMPLE_RATE):
+    """
+    Get a cached resampler, building the sinc kernel only once per sample rate
+
+    Args:
+        resamplers: Dict used as the cache
+        orig_sr: Sample rate of the input audio
+        new_sr: Target sample rate
+
+    Returns:
+        torchaudio.transforms.Resample: Resampler from orig_sr to new_sr
+    """
+    key = (orig_sr, new_sr)
+    if key not in resamplers:
+        resamplers[key] = torchaudio.transforms.Resample(orig_sr, new_sr)
+    return resamplers[key]
+
+
+def decode_audio(filename, resamplers):
+    """
+    Decode an audio file to 48kHz stereo in [-1.0, 1.0]
+
+    Args:
+        filename: Path to the audio file
+        resamplers: Dict used to cache resamplers
+
+    Returns:
+        tuple: (audio tensor of shape (2, num_samples), original sample rate)
+    """
+    audio, sr = torchaudio.load(filename)
+
+    # Convert mono to stereo if needed
+    if audio.shape[0] == 1:
+        audio = torch.cat([audio, audio], dim=0)
+
+    # Take first two channels if more than stereo
+    audio = audio[:2]
+
+    # Resample if needed
+    if sr != TARGET_SAMPLE_RATE:
+        audio = get_resampler(resamplers, sr)(audio)
+
+    # Clip values to [-1.0, 1.0]
+    audio = torch.clamp(audio, -1.0, 1.0)
+    return audio, sr
+
+
+class AudioShardWriter:
+    """
+    Write decoded audio into memory-mappable npy shards
+
+    Every shard is a (2, num_samples) array holding many songs back to back, and
+    index.json maps each filename to its shard, offset, length and metadata.
+    """
+
+    def __init__(self, cache_dir, shard_size_mb=1024, dtype="int16"):
+        assert dtype in ("int16", "float16"), f"Unsupported cache dtype: {dtype}"
+        self.cache_dir = cache_dir
+        self.shard_size_bytes = shard_size_mb * 1024 * 1024
+        self.dtype = dtype
+        self.index = {}
+        self.shard_id = 0
+        self.buffer = []
+        self.buffer_samples = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def add(self, filename, audio, metadata):
+        """
+        Add a decoded song to the cache
+
+        Args:
+            filename: Source filename, used as the cache key
+            audio: Tensor of shape (2, num_samples) or None to only store metadata
+            metadata: Dict of metadata stored in the index
+        """
+        entry = dict(metadata)
+        if audio is not None:
+            if self.dtype == "int16":
+                array = torch.round(audio * INT16_SCALE).to(torch.int16).numpy()
+            else:
+                array = audio.to(torch.float16).numpy()
+            entry.update(
+                shard=self.shard_id,
+                offset=self.buffer_samples,
+                length=array.shape[-1],
+            )
+            self.buffer.append(array)
+            self.buffer_samples += array.shape[-1]
+            if self.buffer_samples * 2 * array.itemsize >= self.shard_size_bytes:
+                self.flush()
+        self.index[filename] = entry
+
+    def flush(self):
+        if not self.buffer:
+            return
+        shard_path = os.path.join(self.cache_dir, f"shard_{self.shard_id:05d}.npy")
+        np.save(shard_path, np.concatenate(self.buffer, axis=-1))
+        logger.info(f"Wrote {shard_path} with {len(self.buffer)} songs")
+        self.buffer = []
+        self.buffer_samples = 0
+        self.shard_id += 1
+
+    def close(self):
+        self.flush()
+        index_path = os.path.join(self.cache_dir, AUDIO_CACHE_INDEX_NAME)
+        with open(index_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(
+                {"sample_rate": TARGET_SAMPLE_RATE, "dtype": self.dtype, "files": self.index},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(index_path + ".tmp", index_path)
+
+
+class AudioShardCache:
+    """
+    Read audio written by AudioShardWriter
+
+    Shards are opened lazily with np.load(mmap_mode="r"), so every DataLoader
+    worker shares the page cache instead of decoding the source files.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, AUDIO_CACHE_INDEX_NAME), encoding="utf-8") as f:
+            index = json.load(f)
+        self.dtype = index["dtype"]
+        self.files = index["files"]
+        self.shards = {}
+
+    def __contains__(self, filename):
+        return filename in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def metadata(self, filename):
+        return self.files[filename]
+
+    def get_shard(self, shard_id):
+        if shard_id not in self.shards:
+            shard_path = os.path.join(self.cache_dir, f"shard_{shard_id:05d}.npy")
+            self.shards[shard_id] = np.load(shard_path, mmap_mode="r")
+        return self.shards[shard_id]
+
+    def load(self, filename):
+        """
+        Load a cached song
+
+        Args:
+            filename: Source filename
+
+        Returns:
+            torch.Tensor or None: float32 tensor of shape (2, num_samples) at 48kHz
+        """
+        entry = self.files[filename]
+        if "shard" not in entry:
+            return None
+        shard = self.get_shard(entry["shard"])
+        array = np.array(shard[:, entry["offset"] : entry["offset"] + entry["length"]])
+        audio = torch.from_numpy(array).float()
+        if self.dtype == "int16":
+            audio = audio / INT16_SCALE
+        return audio
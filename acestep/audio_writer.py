@@ -0,0 +1,115 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torchaudio
+from loguru import logger
+
+
+AUDIO_MEDIA_TYPES = {
+    "wav": "audio/wav",
+    "mp3": "audio/mpeg",
+    "ogg": "audio/ogg",
+    "flac": "audio/flac",
+}
+
+
+def audio_backend(format):
+    return "sox" if format == "ogg" else "soundfile"
+
+
+def save_audio(target, wav, sample_rate, format="wav"):
+    """Encode ``wav`` [channels, samples] to a path or a binary file object."""
+    torchaudio.save(
+        target, wav.float(), sample_rate=sample_rate, format=format, backend=audio_backend(format)
+    )
+
+
+def encode_audio(wav, sample_rate, format="wav"):
+    """Encode ``wav`` in memory and return the file contents as bytes."""
+    buffer = io.BytesIO()
+    save_audio(buffer, wav, sample_rate, format)
+    return buffer.getvalue()
+
+
+def save_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+
+
+class AudioWriter:
+    """
+    Encode and write audio files and their json sidecars on background threads.
+
+    Encoding mp3/ogg/flac for a long song takes seconds, with the writer that time
+    overlaps the compute of the next generation. At most ``max_pending`` writes are
+    queued, further submissions block until a slot frees up so finished audio does
+    not pile up in memory.
+
+    Args:
+        max_workers: Number of writer threads.
+        max_pending: Maximum number of queued or running writes.
+    """
+
+    def __init__(self, max_workers=2, max_pending=16):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="acestep-io")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._errors = []
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if future.exception() is not None:
+                logger.opt(exception=future.exception()).error("Background write failed")
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def write_audio(self, path, wav, sample_rate, format="wav"):
+        return self.submit(save_audio, path, wav, sample_rate, format)
+
+    def encode_audio(self, wav, sample_rate, format="wav"):
+        return self.submit(encode_audio, wav, sample_rate, format)
+
+    def write_json(self, path, data):
+        return self.submit(save_json, path, data)
+
+    def flush(self):
+        """Wait for every submitted write and raise the first error since the last flush."""
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                break
+            for future in pending:
+                future.exception()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def shutdown(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
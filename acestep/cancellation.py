@@ -0,0 +1,109 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import threading
+import time
+
+
+CANCELLED = "cancelled"
+DEADLINE_EXCEEDED = "deadline_exceeded"
+
+
+class GenerationCancelled(Exception):
+    """
+    Raised inside the pipeline when its cancellation token was triggered.
+
+    Args:
+        reason: CANCELLED or DEADLINE_EXCEEDED.
+        stage: Loop that noticed the cancellation, e.g. "diffusion" or "decode".
+        step: Step or window index within that loop.
+        latents: Estimate of the clean latents at that point, if there is one.
+    """
+
+    def __init__(self, reason=CANCELLED, stage=None, step=None, latents=None):
+        super().__init__(f"Generation {reason} during {stage} at step {step}")
+        self.reason = reason
+        self.stage = stage
+        self.step = step
+        self.latents = latents
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation flag checked by the pipeline between diffusion steps,
+    decode windows and saved files.
+
+    Args:
+        deadline: Absolute ``time.time()`` after which the token counts as cancelled.
+        timeout: Seconds from now, shortcut for ``deadline``.
+    """
+
+    def __init__(self, deadline=None, timeout=None):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.deadline = deadline
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    @property
+    def cancelled(self):
+        return self._event.is_set() or self.expired
+
+    @property
+    def reason(self):
+        if self._event.is_set():
+            return CANCELLED
+        if self.expired:
+            return DEADLINE_EXCEEDED
+        return None
+
+    def raise_if_cancelled(self, stage=None, step=None, latents=None):
+        """
+        Raise GenerationCancelled when cancelled. ``latents`` may be a callable so the
+        partial estimate is only computed when it is needed.
+        """
+        if self.cancelled:
+            if callable(latents):
+                latents = latents()
+            raise GenerationCancelled(self.reason, stage=stage, step=step, latents=latents)
+
+
+class CancelledResult:
+    """
+    Returned by ACEStepPipeline.__call__ instead of the output list when the
+    generation was cancelled.
+
+    ``output_paths`` holds the audio decoded from the partial latents when a
+    partial result was requested and available, otherwise it is empty.
+    """
+
+    def __init__(self, reason, stage=None, step=None, output_paths=None, input_params_json=None):
+        self.reason = reason
+        self.stage = stage
+        self.step = step
+        self.output_paths = output_paths or []
+        self.input_params_json = input_params_json
+
+    @property
+    def partial(self):
+        return len(self.output_paths) > 0
+
+    def to_dict(self):
+        return {
+            "status": self.reason,
+            "stage": self.stage,
+            "step": self.step,
+            "partial": self.partial,
+            "output_paths": self.output_paths,
+        }
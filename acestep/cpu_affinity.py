@@ -0,0 +1,98 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import ctypes
+import os
+from glob import glob
+
+from loguru import logger
+
+
+def parse_cpu_list(text):
+    """CPU ids of a sysfs cpulist like ``0-31,64-95``."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def numa_nodes():
+    """
+    Usable CPUs of every NUMA node, read from sysfs. Hosts without NUMA information,
+    e.g. non Linux ones, are one node with all usable CPUs.
+    """
+    usable = set(available_cpus())
+    nodes = {}
+    for path in glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        node = int(os.path.basename(os.path.dirname(path))[len("node"):])
+        with open(path, encoding="utf-8") as f:
+            cpus = [cpu for cpu in parse_cpu_list(f.read()) if cpu in usable]
+        if cpus:
+            nodes[node] = cpus
+    return dict(sorted(nodes.items())) or {0: sorted(usable)}
+
+
+def plan_worker_cpus(num_workers, nodes=None):
+    """
+    Split the NUMA nodes into ``num_workers`` disjoint CPU sets that never span two
+    nodes, returns ``(node, cpus)`` per worker. The workers are spread round robin
+    over the nodes, the CPUs of a node are divided evenly between its workers.
+    """
+    nodes = numa_nodes() if nodes is None else nodes
+    node_ids = list(nodes)
+    if num_workers < len(node_ids):
+        logger.warning(
+            f"{num_workers} workers for {len(node_ids)} NUMA nodes, "
+            f"nodes {node_ids[num_workers:]} stay idle, use at least one worker per node"
+        )
+    workers_per_node = {node: 0 for node in node_ids}
+    for rank in range(num_workers):
+        workers_per_node[node_ids[rank % len(node_ids)]] += 1
+    plan = []
+    for node, count in workers_per_node.items():
+        cpus = nodes[node]
+        if count > len(cpus):
+            raise ValueError(f"{count} workers on NUMA node {node} with only {len(cpus)} CPUs")
+        for index in range(count):
+            plan.append((node, cpus[index * len(cpus) // count : (index + 1) * len(cpus) // count]))
+    return plan
+
+
+def prefer_numa_node(node):
+    """Prefer memory of ``node`` for new allocations through libnuma, False when it is not installed."""
+    try:
+        libnuma = ctypes.CDLL("libnuma.so.1")
+    except OSError:
+        return False
+    if libnuma.numa_available() < 0:
+        return False
+    libnuma.numa_set_preferred(node)
+    return True
+
+
+def pin_to_cpus(cpus, node=None):
+    """
+    Restrict the calling process to ``cpus``, before torch starts its thread pools so
+    they inherit the mask. Without libnuma the first touch policy still places most
+    memory of a pinned process on its node.
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        logger.warning("CPU pinning is not supported on this platform")
+        return
+    os.sched_setaffinity(0, cpus)
+    if node is not None and not prefer_numa_node(node):
+        logger.debug(f"libnuma not available, memory of node {node} workers is placed by first touch")
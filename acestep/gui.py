@@ -47,7 +47,10 @@ import click
 @click.option(
     "--overlapped_decode", type=bool, default=False, help="Whether to use overlapped decoding (run dcae and vocoder using sliding windows)"
 )
-def main(checkpoint_path, server_name, port, device_id, share, bf16, torch_compile, cpu_offload, overlapped_decode):
+@click.option(
+    "--result_cache_dir", type=str, default=None, help="Directory to cache and replay results of generations with fixed seeds"
+)
+def main(checkpoint_path, server_name, port, device_id, share, bf16, torch_compile, cpu_offload, overlapped_decode, result_cache_dir):
     """
     Main function to launch the ACE Step pipeline demo.
     """
@@ -63,7 +66,8 @@ def main(checkpoint_path, server_name, port, device_id, share, bf16, torch_compi
         dtype="bfloat16" if bf16 else "float32",
         torch_compile=torch_compile,
         cpu_offload=cpu_offload,
-        overlapped_decode=overlapped_decode
+        overlapped_decode=overlapped_decode,
+        result_cache_dir=result_cache_dir,
     )
     data_sampler = DataSampler()
 
@@ -0,0 +1,162 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import itertools
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from loguru import logger
+
+from acestep.cancellation import CancellationToken, CancelledResult, GenerationCancelled
+from acestep.profiling import PipelineCallback
+
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class Job:
+    def __init__(self, params, priority=0, timeout=None):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.priority = priority
+        self.status = QUEUED
+        self.step = 0
+        self.total_steps = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # the deadline covers queue wait and generation
+        self.token = CancellationToken(timeout=timeout)
+        self.done = threading.Event()
+
+    def finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self.done.set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "result": self.result,
+            "error": self.error,
+            "cancel_reason": self.token.reason if self.status == CANCELLED else None,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobProgressCallback(PipelineCallback):
+    """Mirror the pipeline's diffusion step progress into a Job."""
+
+    def __init__(self, job):
+        self.job = job
+
+    def on_step(self, step, info, duration):
+        self.job.step = step + 1
+        self.job.total_steps = info.get("num_inference_steps", self.job.total_steps)
+
+
+class JobManager:
+    """
+    Run generation jobs one at a time on a dedicated worker thread.
+
+    Jobs wait in a bounded priority queue, lower ``priority`` values run first and
+    equal priorities run in submission order. ``run_fn(job)`` does the actual work
+    and returns the job result; it should pass ``job.token`` to the pipeline so
+    running jobs can be cancelled between diffusion steps.
+
+    Args:
+        run_fn: Callable executing a job.
+        max_queue_size: Maximum number of queued jobs, ``submit`` raises ``queue.Full`` beyond it.
+        max_finished_jobs: Number of finished jobs kept for status polling.
+    """
+
+    def __init__(self, run_fn, max_queue_size=64, max_finished_jobs=1000):
+        self.run_fn = run_fn
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = OrderedDict()
+        self._queue = queue.PriorityQueue(maxsize=max_queue_size)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._work, name="acestep-job-worker", daemon=True)
+        self._worker.start()
+
+    def submit(self, params, priority=0, timeout=None):
+        job = Job(params, priority, timeout)
+        with self._lock:
+            self._queue.put_nowait((priority, next(self._counter), job))
+            self.jobs[job.id] = job
+            self._evict_finished()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.status in FINISHED_STATES:
+            return job
+        job.token.cancel()
+        if job.status == QUEUED:
+            # the worker skips it when it is dequeued
+            job.finish(CANCELLED)
+        return job
+
+    def queue_size(self):
+        return self._queue.qsize()
+
+    def _evict_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in FINISHED_STATES]
+        for job_id in finished[: max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            _, _, job = self._queue.get()
+            if job.status == CANCELLED:
+                continue
+            if job.token.cancelled:
+                job.finish(CANCELLED)
+                continue
+            job.status = RUNNING
+            job.started_at = time.time()
+            try:
+                result = self.run_fn(job)
+            except GenerationCancelled:
+                logger.info(f"Job {job.id} cancelled at step {job.step}")
+                job.finish(CANCELLED)
+            except Exception as e:
+                logger.exception(f"Job {job.id} failed")
+                job.finish(FAILED, error=str(e))
+            else:
+                if isinstance(result, CancelledResult):
+                    logger.info(f"Job {job.id} {result.reason} during {result.stage} at step {result.step}")
+                    # a partial result, if one was requested, stays available as the job result
+                    job.finish(CANCELLED, result=result.output_paths[0] if result.partial else None)
+                else:
+                    job.finish(SUCCEEDED, result=result)
@@ -0,0 +1,82 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import os
+import threading
+
+import torch
+from huggingface_hub import snapshot_download
+from loguru import logger
+from safetensors.torch import load_file
+
+from acestep.lora_checkpoint_writer import LORA_WEIGHT_NAME_SAFE
+from acestep.lru_cache import LRUCache
+
+
+def lora_signature(state_dict):
+    """
+    Keys, shapes and alphas of a LoRA state dict. Adapters with the same signature
+    produce the same PEFT layers, so one can be swapped for the other in place.
+    """
+    return (
+        tuple(sorted((key, tuple(tensor.shape)) for key, tensor in state_dict.items())),
+        tuple(sorted((key, float(tensor)) for key, tensor in state_dict.items() if key.endswith("alpha"))),
+    )
+
+
+class LoRAAdapterCache:
+    """
+    Keep the state dicts of recently used LoRAs in host memory, pinned when CUDA
+    is available so they copy to the GPU asynchronously.
+
+    Resolved paths are remembered as well, so a cached LoRA is switched to without
+    any ``snapshot_download`` call or file read.
+
+    Args:
+        maxsize: Number of LoRAs kept resident.
+    """
+
+    def __init__(self, maxsize=4):
+        self.adapters = LRUCache(maxsize=maxsize)
+        self.pin_memory = torch.cuda.is_available()
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, lora_name_or_path, cache_dir=None):
+        """Path of the weights file of a local LoRA directory or a hub repo."""
+        with self._lock:
+            weights_path = self._paths.get(lora_name_or_path)
+        if weights_path is None:
+            if os.path.exists(lora_name_or_path):
+                lora_download_path = lora_name_or_path
+            else:
+                lora_download_path = snapshot_download(lora_name_or_path, cache_dir=cache_dir)
+            weights_path = os.path.join(lora_download_path, LORA_WEIGHT_NAME_SAFE)
+            with self._lock:
+                self._paths[lora_name_or_path] = weights_path
+        return weights_path
+
+    def get(self, lora_name_or_path, cache_dir=None):
+        """State dict of a LoRA, read from disk only when it is not resident."""
+        weights_path = self.resolve(lora_name_or_path, cache_dir)
+        return self.adapters.get_or_compute(weights_path, lambda: self._load(weights_path))
+
+    def _load(self, weights_path):
+        logger.info(f"Reading lora weights from {weights_path}")
+        state_dict = load_file(weights_path)
+        if self.pin_memory:
+            state_dict = {key: tensor.pin_memory() for key, tensor in state_dict.items()}
+        return state_dict
+
+    def clear(self):
+        self.adapters.clear()
+        with self._lock:
+            self._paths.clear()
+
+    def stats(self):
+        return self.adapters.stats()
@@ -0,0 +1,141 @@
+import json
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from loguru import logger
+from safetensors.torch import save_file
+
+
+LORA_WEIGHT_NAME_SAFE = "pytorch_lora_weights.safetensors"
+TRAINER_STATE_NAME = "trainer_state.json"
+LATEST_CHECKPOINT_NAME = "latest.json"
+CHECKPOINT_DIR_PATTERN = re.compile(r"^step=(\d+)_lora$")
+# safetensors metadata key diffusers' save_lora_adapter stores the LoRA config under
+LORA_ADAPTER_METADATA_KEY = "lora_adapter_metadata"
+
+
+def lora_file_metadata(lora_config):
+    """safetensors metadata of an adapter file, with the config embedded like save_lora_adapter does."""
+    config = lora_config.to_dict()
+    for key, value in config.items():
+        if isinstance(value, set):
+            config[key] = list(value)
+    return {"format": "pt", LORA_ADAPTER_METADATA_KEY: json.dumps(config, indent=2, sort_keys=True)}
+
+
+class AsyncLoraCheckpointWriter:
+    """Write LoRA checkpoints without blocking the training loop.
+
+    Tensors are copied into pinned CPU buffers that are allocated once and
+    reused for every checkpoint, then serialized on a background thread, to
+    safetensors for ``.safetensors`` files and with ``torch.save`` otherwise. Each checkpoint is written to a temporary directory that is renamed
+    into place, so a crash never leaves a half written ``step=*_lora`` folder.
+
+    Args:
+        root_dir: Directory that holds the ``step=*_lora`` checkpoints.
+        keep_last_n: Number of checkpoints to keep, ``None`` keeps all of them.
+    """
+
+    def __init__(self, root_dir, keep_last_n=None):
+        self.root_dir = root_dir
+        self.keep_last_n = keep_last_n
+        self.pin_memory = torch.cuda.is_available()
+        self._buffers = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future = None
+
+    def _snapshot(self, weight_name, state_dict):
+        buffers = self._buffers.setdefault(weight_name, {})
+        snapshot = {}
+        for name, tensor in state_dict.items():
+            tensor = tensor.detach()
+            buffer = buffers.get(name)
+            if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+                buffer = torch.empty(tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=self.pin_memory)
+                buffers[name] = buffer
+            buffer.copy_(tensor, non_blocking=True)
+            snapshot[name] = buffer
+        return snapshot
+
+    def save(self, step, state_dicts, metadata=None, file_metadata=None):
+        """Snapshot ``state_dicts`` and schedule them to be written.
+
+        Args:
+            step: Global step, used for the checkpoint directory name.
+            state_dicts: Mapping of weight file name to the state dict stored in it.
+            metadata: JSON serializable resume metadata stored in ``trainer_state.json``.
+            file_metadata: Mapping of weight file name to its safetensors metadata,
+                e.g. ``lora_file_metadata`` for adapters, defaults to ``{"format": "pt"}``.
+        """
+        # the pinned buffers are reused, so the previous checkpoint has to be on disk first
+        self.wait()
+        snapshots = {
+            weight_name: self._snapshot(weight_name, state_dict)
+            for weight_name, state_dict in state_dicts.items()
+        }
+        copy_done = None
+        if torch.cuda.is_available():
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+        self._future = self._executor.submit(
+            self._write, step, snapshots, copy_done, metadata or {}, file_metadata or {}
+        )
+
+    def _write(self, step, snapshots, copy_done, metadata, file_metadata):
+        if copy_done is not None:
+            copy_done.synchronize()
+        start_time = time.time()
+        checkpoint_dir = os.path.join(self.root_dir, f"step={step}_lora")
+        tmp_dir = checkpoint_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for weight_name, tensors in snapshots.items():
+            weight_path = os.path.join(tmp_dir, weight_name)
+            if weight_name.endswith(".safetensors"):
+                save_file(tensors, weight_path, metadata=file_metadata.get(weight_name, {"format": "pt"}))
+            else:
+                torch.save(tensors, weight_path)
+        trainer_state = {"global_step": step, "saved_at": time.time(), **metadata}
+        with open(os.path.join(tmp_dir, TRAINER_STATE_NAME), "w", encoding="utf-8") as f:
+            json.dump(trainer_state, f, indent=4, ensure_ascii=False, default=list)
+
+        if os.path.exists(checkpoint_dir):
+            shutil.rmtree(checkpoint_dir)
+        os.replace(tmp_dir, checkpoint_dir)
+        self._write_latest(step, checkpoint_dir)
+        self._apply_retention()
+        logger.info(f"Saved LoRA checkpoint to {checkpoint_dir} in {time.time() - start_time:.2f}s")
+
+    def _write_latest(self, step, checkpoint_dir):
+        latest_path = os.path.join(self.root_dir, LATEST_CHECKPOINT_NAME)
+        with open(latest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"global_step": step, "path": checkpoint_dir}, f, indent=4)
+        os.replace(latest_path + ".tmp", latest_path)
+
+    def _apply_retention(self):
+        if not self.keep_last_n:
+            return
+        checkpoints = []
+        for name in os.listdir(self.root_dir):
+            match = CHECKPOINT_DIR_PATTERN.match(name)
+            if match is not None:
+                checkpoints.append((int(match.group(1)), name))
+        checkpoints.sort()
+        for _, name in checkpoints[: -self.keep_last_n]:
+            shutil.rmtree(os.path.join(self.root_dir, name), ignore_errors=True)
+
+    def wait(self):
+        if self._future is not None:
+            try:
+                self._future.result()
+            except Exception:
+                logger.exception("Failed to write LoRA checkpoint")
+            self._future = None
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,97 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import torch
+from loguru import logger
+from peft.tuners.lora import LoraLayer
+
+from acestep.lru_cache import LRUCache
+
+
+def lora_deltas(model, adapter_name):
+    """
+    Weight deltas ``scaling * B @ A`` of every layer of a loaded PEFT adapter, keyed by
+    the name the base layer has once the adapter is unloaded. Embedding deltas have the
+    shape of the embedding the adapter was injected into, e.g. the resized ``lyric_embs``.
+    """
+    deltas = {}
+    with torch.no_grad():
+        for name, module in model.named_modules():
+            if isinstance(module, LoraLayer) and adapter_name in module.scaling:
+                deltas[name] = module.get_delta_weight(adapter_name).detach()
+    return deltas
+
+
+class LoRAMerger:
+    """
+    Fold LoRA deltas into the base weights of a model, so inference runs without the
+    two extra matmuls per adapted layer.
+
+    The original weights of every touched layer are kept on the host the first time
+    they are merged into. Merging always starts from them and unmerging copies them
+    back, so switching LoRAs or weights never accumulates rounding errors and the base
+    model is restored bit for bit. Computed deltas of recent LoRAs are cached on the
+    host as well, switching back to one of them needs no PEFT injection.
+
+    Args:
+        cache_size: Number of LoRAs whose deltas are kept.
+    """
+
+    def __init__(self, cache_size=2):
+        self.deltas = LRUCache(maxsize=cache_size)
+        self.pin_memory = torch.cuda.is_available()
+        self._originals = {}
+        self._merged = []
+
+    def to_host(self, deltas, dtype):
+        host_deltas = {}
+        for name, delta in deltas.items():
+            delta = delta.to("cpu", dtype)
+            host_deltas[name] = delta.pin_memory() if self.pin_memory else delta
+        return host_deltas
+
+    @property
+    def merged(self):
+        return bool(self._merged)
+
+    def merge(self, model, deltas, scale=1.0):
+        """Set every layer in ``deltas`` to its original weight plus ``scale`` times the delta."""
+        self.unmerge(model)
+        with torch.no_grad():
+            for name, delta in deltas.items():
+                weight = model.get_submodule(name).weight
+                if weight.shape != delta.shape:
+                    raise ValueError(
+                        f"LoRA delta for {name} has shape {tuple(delta.shape)}, the layer {tuple(weight.shape)}"
+                    )
+                original = self._originals.get(name)
+                if original is None or original.shape != weight.shape:
+                    original = weight.detach().to("cpu", copy=True)
+                    self._originals[name] = original.pin_memory() if self.pin_memory else original
+                    original = self._originals[name]
+                # a copy even when the original already is float32 on the weight's device, add_ must not touch it
+                merged = original.to(weight.device, torch.float32, copy=True)
+                merged.add_(delta.to(weight.device, torch.float32, non_blocking=True), alpha=scale)
+                weight.copy_(merged)
+                self._merged.append(name)
+        logger.info(f"Merged LoRA deltas into {len(self._merged)} layers with scale {scale}")
+
+    def unmerge(self, model):
+        """Restore the original weights of every merged layer."""
+        if not self._merged:
+            return
+        with torch.no_grad():
+            for name in self._merged:
+                model.get_submodule(name).weight.copy_(self._originals[name], non_blocking=True)
+        self._merged = []
+
+    def reset(self):
+        """Forget the kept originals, e.g. after the base weights were reloaded."""
+        self._originals.clear()
+        self._merged = []
+        self.deltas.clear()
@@ -26,6 +26,7 @@ from diffusers.loaders import FromOriginalModelMixin, PeftAdapterMixin
 
 
 from .attention import LinearTransformerBlock, t2i_modulate
+from .customer_attention_processor import CustomLiteLAProcessor2_0, prepare_cross_attention_mask, rope_tables
 from .lyrics_utils.lyric_encoder import ConformerEncoder as LyricEncoder
 
 
@@ -59,6 +60,8 @@ class Qwen2RotaryEmbedding(nn.Module):
             )
         )
         self.register_buffer("inv_freq", inv_freq, persistent=False)
+        # broadcast-ready tables per (seq_len, dtype, device), see rope_tables
+        self._rope_tables = {}
 
         # Build here to make `torch.jit.trace` work.
         self._set_cos_sin_cache(
@@ -79,6 +82,22 @@ class Qwen2RotaryEmbedding(nn.Module):
         self.register_buffer("cos_cached", emb.cos().to(dtype), persistent=False)
         self.register_buffer("sin_cached", emb.sin().to(dtype), persistent=False)
 
+    def rope_tables(self, seq_len, dtype, device):
+        """
+        Tables of the first ``seq_len`` positions for ``apply_rotary_emb``, built once
+        per (seq_len, dtype, device) and reused by every layer and step.
+        """
+        key = (seq_len, dtype, device)
+        tables = self._rope_tables.get(key)
+        if tables is None:
+            if seq_len > self.max_seq_len_cached:
+                self._set_cos_sin_cache(seq_len=seq_len, device=device, dtype=dtype)
+            if len(self._rope_tables) >= 16:
+                self._rope_tables.clear()
+            tables = rope_tables(self.cos_cached[:seq_len], self.sin_cached[:seq_len], dtype, device)
+            self._rope_tables[key] = tables
+        return tables
+
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
         if seq_len > self.max_seq_len_cached:
@@ -150,6 +169,25 @@ class T2IFinalLayer(nn.Module):
         return output
 
 
+def masked_group_norm(x, norm, mask):
+    """
+    Apply ``norm`` (a GroupNorm) to x [N, C, H, W] using only the frames where mask [N, W]
+    is 1 for the statistics. Padded frames are zeroed.
+    """
+    n, c, h, w = x.shape
+    num_groups = norm.num_groups
+    x_grouped = x.float().reshape(n, num_groups, c // num_groups, h, w)
+    frame_mask = mask.float()[:, None, None, None, :]
+    count = frame_mask.sum(dim=(2, 3, 4), keepdim=True) * (c // num_groups) * h
+    mean = (x_grouped * frame_mask).sum(dim=(2, 3, 4), keepdim=True) / count
+    var = (((x_grouped - mean) * frame_mask) ** 2).sum(dim=(2, 3, 4), keepdim=True) / count
+    x_grouped = (x_grouped - mean) * torch.rsqrt(var + norm.eps)
+    x = x_grouped.reshape(n, c, h, w).to(x.dtype)
+    if norm.affine:
+        x = x * norm.weight[None, :, None, None] + norm.bias[None, :, None, None]
+    return x * mask[:, None, None, :].to(x.dtype)
+
+
 class PatchEmbed(nn.Module):
     """2D Image to Patch Embedding"""
 
@@ -189,9 +227,14 @@ class PatchEmbed(nn.Module):
         self.height, self.width = height // patch_size_h, width // patch_size_w
         self.base_size = self.width
 
-    def forward(self, latent):
+    def forward(self, latent, mask=None):
         # early convolutions, N x C x H x W -> N x 256 * sqrt(patch_size) x H/patch_size x W/patch_size
-        latent = self.early_conv_layers(latent) # [bs * 2, 8, 16, time_frames] -> [bs * 2, 2560, 1, time_frames]
+        if mask is None:
+            latent = self.early_conv_layers(latent) # [bs * 2, 8, 16, time_frames] -> [bs * 2, 2560, 1, time_frames]
+        else:
+            # right padded batch, the GroupNorm statistics must only cover the valid frames
+            conv_in, norm, conv_out = self.early_conv_layers
+            latent = conv_out(masked_group_norm(conv_in(latent), norm, mask))
         latent = latent.flatten(2).transpose(1, 2)  # BCHW -> BNC / [bs * 2, 2560, 1, time_frames] -> [bs * 2, time_frames, 2560]
         return latent
 
@@ -207,6 +250,8 @@ class ACEStepTransformer2DModel(
     ModelMixin, ConfigMixin, PeftAdapterMixin, FromOriginalModelMixin
 ):
     _supports_gradient_checkpointing = True
+    # the SSL projectors of full checkpoints are not built with inference_only
+    _keys_to_ignore_on_load_unexpected = [r"^projectors\."]
 
     @register_to_config
     def __init__(
@@ -230,6 +275,8 @@ class ACEStepTransformer2DModel(
         patch_size: List[int] = [16, 1],
         max_height: int = 16,
         max_width: int = 4096,
+        lyric_encoder_config: Optional[Dict[str, Any]] = None,
+        inference_only: bool = False,
         **kwargs,
     ):
         super().__init__()
@@ -288,29 +335,34 @@ class ACEStepTransformer2DModel(
         # lyric
         self.lyric_embs = nn.Embedding(lyric_encoder_vocab_size, lyric_hidden_size)
         self.lyric_encoder = LyricEncoder(
-            input_size=lyric_hidden_size, static_chunk_size=0
+            input_size=lyric_hidden_size, static_chunk_size=0, **(lyric_encoder_config or {})
         ) # conformer
         self.lyric_proj = nn.Linear(lyric_hidden_size, self.inner_dim)
 
         projector_dim = 2 * self.inner_dim
 
-        self.projectors = nn.ModuleList(
-            [
-                nn.Sequential(
-                    nn.Linear(self.inner_dim, projector_dim),
-                    nn.SiLU(),
-                    nn.Linear(projector_dim, projector_dim),
-                    nn.SiLU(),
-                    nn.Linear(projector_dim, ssl_dim),
-                )
-                for ssl_dim in ssl_latent_dims
-            ]
-        )
+        # the SSL projection heads and their loss only train the model, inference_only skips them
+        self.inference_only = inference_only
+        if inference_only:
+            self.projectors = None
+            self.cosine_loss = None
+        else:
+            self.projectors = nn.ModuleList(
+                [
+                    nn.Sequential(
+                        nn.Linear(self.inner_dim, projector_dim),
+                        nn.SiLU(),
+                        nn.Linear(projector_dim, projector_dim),
+                        nn.SiLU(),
+                        nn.Linear(projector_dim, ssl_dim),
+                    )
+                    for ssl_dim in ssl_latent_dims
+                ]
+            )
+            self.cosine_loss = torch.nn.CosineEmbeddingLoss(margin=0.0, reduction="mean")
 
         self.ssl_latent_dims = ssl_latent_dims
         self.ssl_encoder_depths = ssl_encoder_depths
-
-        self.cosine_loss = torch.nn.CosineEmbeddingLoss(margin=0.0, reduction="mean")
         self.ssl_names = ssl_names
 
         self.proj_in = PatchEmbed(
@@ -325,6 +377,8 @@ class ACEStepTransformer2DModel(
             self.inner_dim, patch_size=patch_size, out_channels=out_channels
         )
         self.gradient_checkpointing = False
+        # (encoder mask, prepared cross-attention mask) of the last decode, see cross_attention_mask
+        self._cross_attention_mask = None
 
     # Copied from diffusers.models.unets.unet_3d_condition.UNet3DConditionModel.enable_forward_chunking
     def enable_forward_chunking(
@@ -360,6 +414,30 @@ class ACEStepTransformer2DModel(
         for module in self.children():
             fn_recursive_feed_forward(module, chunk_size, dim)
 
+    def set_linear_attention_chunking(self, chunk_threshold: Optional[int], chunk_size: int = 1024) -> None:
+        """
+        Run the linear self-attention of sequences with at least `chunk_threshold` tokens in
+        chunks of `chunk_size`, which keeps long generations from materializing float32
+        copies of the whole query, key, value and output. `None` disables chunking.
+        """
+        for module in self.modules():
+            processor = getattr(module, "processor", None)
+            if isinstance(processor, CustomLiteLAProcessor2_0):
+                processor.chunk_threshold = chunk_threshold
+                processor.chunk_size = chunk_size
+
+    def cross_attention_mask(self, encoder_hidden_mask):
+        """
+        Cross-attention mask of every block, built once and reused by all steps that pass
+        the same encoder mask tensor, which the diffusion loop does for a whole generation.
+        """
+        cached = self._cross_attention_mask
+        if cached is not None and cached[0] is encoder_hidden_mask:
+            return cached[1]
+        cross_attention_mask = prepare_cross_attention_mask(encoder_hidden_mask)
+        self._cross_attention_mask = (encoder_hidden_mask, cross_attention_mask)
+        return cross_attention_mask
+
     def forward_lyric_encoder(
         self,
         lyric_token_idx: Optional[torch.LongTensor] = None, # [bs * 2, lyric_seq_len]
@@ -433,21 +511,31 @@ class ACEStepTransformer2DModel(
         )
         temb = self.t_block(embedded_timestep)
 
-        hidden_states = self.proj_in(hidden_states) # patch embed : # [bs * 2, 8, 16, time_frames] -> [bs * 2, time_frames, 2560]
+        # frames where attention_mask is 0 are right padding of a batch with mixed durations
+        padding_mask = None
+        if attention_mask is not None and not bool(attention_mask.all()):
+            padding_mask = attention_mask
+
+        hidden_states = self.proj_in(hidden_states, padding_mask) # patch embed : # [bs * 2, 8, 16, time_frames] -> [bs * 2, time_frames, 2560]
 
         # controlnet logic
         if block_controlnet_hidden_states is not None:
             control_condi = cross_norm(hidden_states, block_controlnet_hidden_states)
             hidden_states = hidden_states + control_condi * controlnet_scale
 
+        # the hidden states the SSL projectors read are only kept when there are SSL targets
         inner_hidden_states = []
+        collect_ssl = ssl_hidden_states is not None and len(ssl_hidden_states) > 0
+        if collect_ssl and self.projectors is None:
+            raise ValueError("The transformer was loaded with inference_only=True and has no SSL projectors")
 
-        rotary_freqs_cis = self.rotary_emb(
-            hidden_states, seq_len=hidden_states.shape[1]
+        rotary_freqs_cis = self.rotary_emb.rope_tables(
+            hidden_states.shape[1], hidden_states.dtype, hidden_states.device
         )
-        encoder_rotary_freqs_cis = self.rotary_emb(
-            encoder_hidden_states, seq_len=encoder_hidden_states.shape[1]
+        encoder_rotary_freqs_cis = self.rotary_emb.rope_tables(
+            encoder_hidden_states.shape[1], encoder_hidden_states.dtype, encoder_hidden_states.device
         )
+        cross_attention_mask = self.cross_attention_mask(encoder_hidden_mask)
 
         for index_block, block in enumerate(self.transformer_blocks):
 
@@ -458,7 +546,7 @@ class ACEStepTransformer2DModel(
                     hidden_states=hidden_states,
                     attention_mask=attention_mask,
                     encoder_hidden_states=encoder_hidden_states,
-                    encoder_attention_mask=encoder_hidden_mask,
+                    encoder_attention_mask=cross_attention_mask,
                     rotary_freqs_cis=rotary_freqs_cis,
                     rotary_freqs_cis_cross=encoder_rotary_freqs_cis,
                     temb=temb,
@@ -470,15 +558,16 @@ class ACEStepTransformer2DModel(
                     hidden_states=hidden_states,
                     attention_mask=attention_mask,
                     encoder_hidden_states=encoder_hidden_states,
-                    encoder_attention_mask=encoder_hidden_mask,
+                    encoder_attention_mask=cross_attention_mask,
                     rotary_freqs_cis=rotary_freqs_cis,
                     rotary_freqs_cis_cross=encoder_rotary_freqs_cis,
                     temb=temb,
                 )
 
-            for ssl_encoder_depth in self.ssl_encoder_depths:
-                if index_block == ssl_encoder_depth:
-                    inner_hidden_states.append(hidden_states)
+            if collect_ssl:
+                for ssl_encoder_depth in self.ssl_encoder_depths:
+                    if index_block == ssl_encoder_depth:
+                        inner_hidden_states.append(hidden_states)
 
         proj_losses = []
         if (
@@ -520,6 +609,9 @@ class ACEStepTransformer2DModel(
                 proj_losses.append((ssl_name, proj_loss / bs))
 
         output = self.final_layer(hidden_states, embedded_timestep, output_length)
+        if padding_mask is not None:
+            # keep the prediction of padded frames at zero, so guidance and the scheduler leave them untouched
+            output = output * padding_mask[:, None, None, : output.shape[-1]].to(output.dtype)
         if not return_dict:
             return (output, proj_losses)
 
@@ -179,9 +179,12 @@ class GLUMBConv(nn.Module):
             act=act[2],
         )
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, mask: torch.Tensor = None) -> torch.Tensor:
         x = x.transpose(1, 2)
         x = self.inverted_conv(x)
+        if mask is not None:
+            # zero right padded frames so the depthwise conv sees the same border as an unpadded sample
+            x = x * mask[:, None, :].to(x.dtype)
         x = self.depth_conv(x)
 
         x, gate = torch.chunk(x, 2, dim=1)
@@ -322,7 +325,7 @@ class LinearTransformerBlock(nn.Module):
             norm_hidden_states = norm_hidden_states * (1 + scale_mlp) + shift_mlp
 
         # step 4: feed forward
-        ff_output = self.ff(norm_hidden_states)
+        ff_output = self.ff(norm_hidden_states, attention_mask)
         if self.use_adaln_single:
             ff_output = gate_mlp * ff_output
 
@@ -23,13 +23,86 @@ from diffusers.models.attention_processor import Attention
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 
+def rope_tables(cos, sin, dtype, device):
+    """
+    Turn [S, D] cos/sin tables into the broadcast-ready [1, 1, S, D] float32 tables of
+    `apply_rotary_emb`. The values are rounded to `dtype` first, as the activations
+    they rotate, and the sign of the rotation is folded into the even channels of sin.
+    """
+    cos = cos.to(dtype).to(device=device, dtype=torch.float32, copy=True)
+    sin = sin.to(dtype).to(device=device, dtype=torch.float32, copy=True)
+    sin[:, 0::2] = -sin[:, 0::2]
+    return cos[None, None], sin[None, None]
+
+
+def prepare_cross_attention_mask(encoder_attention_mask: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+    """
+    Turn an [B, S_enc] encoder mask into the boolean [B, 1, 1, S_enc] key padding mask the
+    cross-attention passes to `scaled_dot_product_attention`, which broadcasts it over heads
+    and queries without materializing it. Returns None when no key is padded, so SDPA can
+    pick a backend without mask support.
+    """
+    if encoder_attention_mask is None:
+        return None
+    encoder_attention_mask = encoder_attention_mask == 1
+    if bool(encoder_attention_mask.all()):
+        return None
+    return encoder_attention_mask[:, None, None, :]
+
+
+def apply_rotary_emb(x: torch.Tensor, freqs_cis: Tuple[torch.Tensor]) -> torch.Tensor:
+    """
+    Rotate the channel pairs (2k, 2k + 1) of `x` [B, H, S, D] in float32 as
+    `x * cos + rotated(x) * sin` with rotated(x) = (-x[2k + 1], x[2k]). With the tables
+    of `rope_tables` the rotation is a pair swap, so no intermediate stack is built.
+    """
+    cos, sin = freqs_cis
+    if cos.dim() == 2:
+        cos, sin = rope_tables(cos, sin, cos.dtype, x.device)
+    x_float = x.float()
+    x_swapped = x_float.reshape(*x.shape[:-1], -1, 2).flip(-1).reshape(x.shape)
+    out = x_float * cos
+    out += x_swapped.mul_(sin)
+    return out.to(x.dtype)
+
+
 class CustomLiteLAProcessor2_0:
-    """Attention processor used typically in processing the SD3-like self-attention projections. add rms norm for query and key and apply RoPE"""
+    """Attention processor used typically in processing the SD3-like self-attention projections. add rms norm for query and key and apply RoPE
 
-    def __init__(self):
+    Sequences of at least `chunk_threshold` tokens are processed in chunks of `chunk_size`, see
+    `chunked_linear_attention`.
+    """
+
+    def __init__(self, chunk_threshold: Optional[int] = None, chunk_size: int = 1024):
         self.kernel_func = nn.ReLU(inplace=False)
         self.eps = 1e-15
         self.pad_val = 1.0
+        self.chunk_threshold = chunk_threshold
+        self.chunk_size = chunk_size
+
+    def chunked_linear_attention(
+        self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, dtype: torch.dtype
+    ) -> torch.Tensor:
+        """
+        Linear attention of query [B, H, D, S_q], key [B, H, S_k, D] and value [B, H, D, S_k]
+        without float32 copies of the full inputs and output. `vk` and the key sum (the
+        row the padded value row of ones adds) are accumulated in float32 over key chunks,
+        the output is normalized and cast to `dtype` chunk by chunk.
+        """
+        batch_size, heads, head_dim, query_len = query.shape
+        vk = query.new_zeros((batch_size, heads, head_dim, key.shape[-1]), dtype=torch.float32)
+        key_sum = query.new_zeros((batch_size, heads, 1, key.shape[-1]), dtype=torch.float32)
+        for start in range(0, key.shape[2], self.chunk_size):
+            key_chunk = key[:, :, start : start + self.chunk_size].float()
+            vk += torch.matmul(value[..., start : start + self.chunk_size].float(), key_chunk)
+            key_sum += key_chunk.sum(dim=2, keepdim=True)
+
+        hidden_states = torch.empty((batch_size, heads, head_dim, query_len), dtype=dtype, device=query.device)
+        for start in range(0, query_len, self.chunk_size):
+            query_chunk = query[..., start : start + self.chunk_size].float()
+            normalizer = torch.matmul(key_sum, query_chunk) + self.eps
+            hidden_states[..., start : start + self.chunk_size] = torch.matmul(vk, query_chunk) / normalizer
+        return hidden_states
 
     def apply_rotary_emb(
         self,
@@ -46,20 +119,12 @@ class CustomLiteLAProcessor2_0:
             x (`torch.Tensor`):
                 Query or key tensor to apply rotary embeddings. [B, H, S, D] xk (torch.Tensor): Key tensor to apply
             freqs_cis (`Tuple[torch.Tensor]`): Precomputed frequency tensor for complex exponentials. ([S, D], [S, D],)
+                or the tables of `rope_tables`. ([1, 1, S, D], [1, 1, S, D],)
 
         Returns:
             Tuple[torch.Tensor, torch.Tensor]: Tuple of modified query tensor and key tensor with rotary embeddings.
         """
-        cos, sin = freqs_cis  # [S, D]
-        cos = cos[None, None]
-        sin = sin[None, None]
-        cos, sin = cos.to(x.device), sin.to(x.device)
-
-        x_real, x_imag = x.reshape(*x.shape[:-1], -1, 2).unbind(-1)  # [B, S, H, D//2]
-        x_rotated = torch.stack([-x_imag, x_real], dim=-1).flatten(3)
-        out = (x.float() * cos + x_rotated.float() * sin).to(x.dtype)
-
-        return out
+        return apply_rotary_emb(x, freqs_cis)
 
     def __call__(
         self,
@@ -183,18 +248,21 @@ class CustomLiteLAProcessor2_0:
         query = self.kernel_func(query)
         key = self.kernel_func(key)
 
-        query, key, value = query.float(), key.float(), value.float()
+        if self.chunk_threshold is not None and max(query.shape[-1], key.shape[2]) >= self.chunk_threshold:
+            hidden_states = self.chunked_linear_attention(query, key, value, dtype)
+        else:
+            query, key, value = query.float(), key.float(), value.float()
 
-        value = F.pad(value, (0, 0, 0, 1), mode="constant", value=self.pad_val)
+            value = F.pad(value, (0, 0, 0, 1), mode="constant", value=self.pad_val)
 
-        vk = torch.matmul(value, key)
+            vk = torch.matmul(value, key)
 
-        hidden_states = torch.matmul(vk, query)
+            hidden_states = torch.matmul(vk, query)
 
-        if hidden_states.dtype in [torch.float16, torch.bfloat16]:
-            hidden_states = hidden_states.float()
+            if hidden_states.dtype in [torch.float16, torch.bfloat16]:
+                hidden_states = hidden_states.float()
 
-        hidden_states = hidden_states[:, :, :-1] / (hidden_states[:, :, -1:] + self.eps)
+            hidden_states = hidden_states[:, :, :-1] / (hidden_states[:, :, -1:] + self.eps)
 
         hidden_states = hidden_states.view(
             batch_size, attn.heads * head_dim, -1
@@ -270,20 +338,12 @@ class CustomerAttnProcessor2_0:
             x (`torch.Tensor`):
                 Query or key tensor to apply rotary embeddings. [B, H, S, D] xk (torch.Tensor): Key tensor to apply
             freqs_cis (`Tuple[torch.Tensor]`): Precomputed frequency tensor for complex exponentials. ([S, D], [S, D],)
+                or the tables of `rope_tables`. ([1, 1, S, D], [1, 1, S, D],)
 
         Returns:
             Tuple[torch.Tensor, torch.Tensor]: Tuple of modified query tensor and key tensor with rotary embeddings.
         """
-        cos, sin = freqs_cis  # [S, D]
-        cos = cos[None, None]
-        sin = sin[None, None]
-        cos, sin = cos.to(x.device), sin.to(x.device)
-
-        x_real, x_imag = x.reshape(*x.shape[:-1], -1, 2).unbind(-1)  # [B, S, H, D//2]
-        x_rotated = torch.stack([-x_imag, x_real], dim=-1).flatten(3)
-        out = (x.float() * cos + x_rotated.float() * sin).to(x.dtype)
-
-        return out
+        return apply_rotary_emb(x, freqs_cis)
 
     def __call__(
         self,
@@ -300,6 +360,7 @@ class CustomerAttnProcessor2_0:
 
         residual = hidden_states
         input_ndim = hidden_states.ndim
+        query_mask = None
 
         if input_ndim == 4:
             batch_size, channel, height, width = hidden_states.shape
@@ -357,23 +418,15 @@ class CustomerAttnProcessor2_0:
             elif rotary_freqs_cis_cross is not None and has_encoder_hidden_state_proj:
                 key = self.apply_rotary_emb(key, rotary_freqs_cis_cross)
 
-        if (
-            attn.is_cross_attention
-            and encoder_attention_mask is not None
-            and has_encoder_hidden_state_proj
-        ):
+        if attn.is_cross_attention and has_encoder_hidden_state_proj:
             # attention_mask: N x S1
-            # encoder_attention_mask: N x S2
-            # cross attention 整合attention_mask和encoder_attention_mask
-            combined_mask = (
-                attention_mask[:, :, None] * encoder_attention_mask[:, None, :]
-            )
-            attention_mask = torch.where(combined_mask == 1, 0.0, -torch.inf)
-            attention_mask = (
-                attention_mask[:, None, :, :]
-                .expand(-1, attn.heads, -1, -1)
-                .to(query.dtype)
-            )
+            # encoder_attention_mask: N x S2, or N x 1 x 1 x S2 from prepare_cross_attention_mask
+            # only the keys are masked, a padded query row masked everywhere would turn into NaN.
+            # the outputs of padded queries are zeroed after the projection instead
+            query_mask = attention_mask
+            if encoder_attention_mask is not None and encoder_attention_mask.dim() == 2:
+                encoder_attention_mask = prepare_cross_attention_mask(encoder_attention_mask)
+            attention_mask = encoder_attention_mask
 
         elif not attn.is_cross_attention and attention_mask is not None:
             attention_mask = attn.prepare_attention_mask(
@@ -401,6 +454,9 @@ class CustomerAttnProcessor2_0:
         # dropout
         hidden_states = attn.to_out[1](hidden_states)
 
+        if query_mask is not None:
+            hidden_states = hidden_states * query_mask[:, :, None].to(hidden_states.dtype)
+
         if input_ndim == 4:
             hidden_states = hidden_states.transpose(-1, -2).reshape(
                 batch_size, channel, height, width
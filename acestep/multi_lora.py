@@ -0,0 +1,256 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import abc
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from loguru import logger
+from peft.tuners.lora import LoraLayer
+
+
+def lora_factors(model, adapter_name):
+    """
+    Low rank factors ``(A, B, scaling)`` of every layer of a loaded PEFT adapter, keyed
+    by the name the base layer has once the adapter is unloaded. ``A`` is [r, in] and
+    ``B`` [out, r], for embeddings ``A`` is [r, num_embeddings] as in PEFT.
+    """
+    factors = {}
+    for name, module in model.named_modules():
+        if not isinstance(module, LoraLayer) or adapter_name not in module.scaling:
+            continue
+        if adapter_name in module.lora_A:
+            lora_A = module.lora_A[adapter_name].weight
+            lora_B = module.lora_B[adapter_name].weight
+        else:
+            lora_A = module.lora_embedding_A[adapter_name]
+            lora_B = module.lora_embedding_B[adapter_name]
+        factors[name] = (lora_A.detach().clone(), lora_B.detach().clone(), float(module.scaling[adapter_name]))
+    return factors
+
+
+class AdapterRoute:
+    """
+    Adapter of every sample of a batch, grouped so each adapter runs one matmul over
+    all of its rows. ``groups_for`` returns ``(adapter_id, rows, weights)`` where rows is
+    None when the adapter serves the whole batch.
+
+    Inputs stacked from copies of the batch, e.g. the conditional and unconditional
+    halves of classifier free guidance or the flowedit source and target, route row
+    ``i`` like sample ``i % batch_size``.
+    """
+
+    def __init__(self, adapter_ids, weights, device):
+        self.batch_size = len(adapter_ids)
+        self.adapter_ids = list(adapter_ids)
+        self.weights = list(weights)
+        self.device = device
+        self._groups = {}
+
+    def groups_for(self, num_rows):
+        if num_rows % self.batch_size != 0:
+            raise ValueError(f"Adapter route is for a batch of {self.batch_size}, got {num_rows}")
+        groups = self._groups.get(num_rows)
+        if groups is not None:
+            return groups
+        repeats = num_rows // self.batch_size
+        adapter_ids = self.adapter_ids * repeats
+        weights = self.weights * repeats
+        groups = []
+        for adapter_id in sorted(set(adapter_ids) - {None}):
+            rows = [i for i, sample_adapter in enumerate(adapter_ids) if sample_adapter == adapter_id]
+            row_weights = torch.tensor([weights[i] for i in rows], device=self.device)
+            if len(rows) == num_rows:
+                groups.append((adapter_id, None, row_weights))
+            else:
+                groups.append((adapter_id, torch.tensor(rows, device=self.device), row_weights))
+        self._groups[num_rows] = groups
+        return groups
+
+
+class MultiLoRALayer(nn.Module, metaclass=abc.ABCMeta):
+    """Base layer plus the LoRA deltas of the adapter each sample of the batch is routed to."""
+
+    def __init__(self, base_layer, multi_lora):
+        super().__init__()
+        self.base_layer = base_layer
+        self.multi_lora = multi_lora
+        self.adapters = {}
+
+    @property
+    def weight(self):
+        return self.base_layer.weight
+
+    @abc.abstractmethod
+    def lora_delta(self, x, lora_A, lora_B):
+        """Unscaled LoRA delta of ``x``, shaped like the base layer output."""
+
+    def forward(self, x):
+        output = self.base_layer(x)
+        route = self.multi_lora.route
+        if route is None or not self.adapters:
+            return output
+        for adapter_id, rows, weights in route.groups_for(x.shape[0]):
+            factors = self.adapters.get(adapter_id)
+            if factors is None:
+                continue
+            lora_A, lora_B, scaling = factors
+            # no-ops unless cpu_offload moved the model after the adapters were added
+            lora_A, lora_B, weights = lora_A.to(x.device), lora_B.to(x.device), weights.to(x.device)
+            if rows is None:
+                group_x = x
+            else:
+                rows = rows.to(x.device)
+                group_x = x.index_select(0, rows)
+            delta = self.lora_delta(group_x, lora_A, lora_B)
+            delta = delta * (weights * scaling).to(delta.dtype).view(-1, *([1] * (delta.dim() - 1)))
+            if rows is None:
+                output = output + delta
+            else:
+                output = output.index_add(0, rows, delta.to(output.dtype))
+        return output
+
+
+class MultiLoRALinear(MultiLoRALayer):
+    def lora_delta(self, x, lora_A, lora_B):
+        return F.linear(F.linear(x.to(lora_A.dtype), lora_A), lora_B)
+
+
+class MultiLoRAEmbedding(MultiLoRALayer):
+    def lora_delta(self, x, lora_A, lora_B):
+        return F.linear(F.embedding(x, lora_A.T), lora_B)
+
+
+class MultiLoRA:
+    """
+    Serve several LoRAs from one model at once, each sample of a batch with its own
+    adapter and weight, in the spirit of Punica/S-LoRA.
+
+    The adapted linears and embeddings are wrapped by layers that hold the low rank
+    factors of every registered adapter. A route maps the samples of the next
+    forward passes to adapters, and the samples that share an adapter are gathered so
+    it costs two small matmuls per group instead of one model per adapter. Batches
+    with different style LoRAs therefore do not have to be split by adapter.
+
+    Args:
+        model: Model whose layers are wrapped, the ACE-Step transformer.
+        max_adapters: Number of registered adapters, the least recently used one
+            that is not routed to is dropped beyond it.
+    """
+
+    def __init__(self, model, max_adapters=8):
+        self.model = model
+        self.max_adapters = max_adapters
+        self.route = None
+        self.installed = False
+        self._adapters = OrderedDict()
+        self._layers = {}
+        self._next_id = 0
+
+    def __contains__(self, key):
+        return key in self._adapters
+
+    def add_adapter(self, key, factors):
+        """Register the ``lora_factors`` of an adapter under ``key``, e.g. its weights path."""
+        if key in self._adapters:
+            self._adapters.move_to_end(key)
+            return
+        self._check_factors(factors)
+        adapter_id = self._next_id
+        self._next_id += 1
+        self._adapters[key] = (adapter_id, factors)
+        if self.installed:
+            self._install_adapter(adapter_id, factors)
+
+    def remove_adapter(self, key):
+        adapter_id, _ = self._adapters.pop(key)
+        for layer in self._layers.values():
+            layer.adapters.pop(adapter_id, None)
+
+    def set_route(self, keys, weights):
+        """
+        Route sample ``i`` of the following batches to the adapter ``keys[i]`` with
+        ``weights[i]``, None leaves a sample without adapter.
+        """
+        if not self.installed:
+            self.install()
+        adapter_ids = []
+        for key in keys:
+            if key is None:
+                adapter_ids.append(None)
+                continue
+            self._adapters.move_to_end(key)
+            adapter_ids.append(self._adapters[key][0])
+        self.route = AdapterRoute(adapter_ids, weights, self._device())
+        self._evict(set(keys))
+
+    def _evict(self, keep):
+        while len(self._adapters) > self.max_adapters:
+            key = next((key for key in self._adapters if key not in keep), None)
+            if key is None:
+                break
+            logger.info(f"Dropping adapter {key} from the multi LoRA layers")
+            self.remove_adapter(key)
+
+    def _device(self):
+        return next(self.model.parameters()).device
+
+    def install(self):
+        """Wrap the adapted layers, the model must not have PEFT layers meanwhile."""
+        if self.installed:
+            return
+        self.installed = True
+        for adapter_id, factors in self._adapters.values():
+            self._install_adapter(adapter_id, factors)
+
+    def _check_factors(self, factors):
+        """Raise a ValueError when the factors do not fit the layers they adapt, e.g. a resized lyric_embs."""
+        for name, (lora_A, lora_B, _) in factors.items():
+            layer = self.model.get_submodule(name)
+            base_layer = layer.base_layer if isinstance(layer, MultiLoRALayer) else layer
+            if isinstance(base_layer, nn.Embedding):
+                # A is [r, num_embeddings] and B [embedding_dim, r], the weight [num_embeddings, embedding_dim]
+                shape = (lora_A.shape[1], lora_B.shape[0])
+            else:
+                shape = (lora_B.shape[0], lora_A.shape[1])
+            if lora_A.shape[0] != lora_B.shape[1] or shape != tuple(base_layer.weight.shape):
+                raise ValueError(
+                    f"LoRA factors for {name} of shapes {tuple(lora_A.shape)} and {tuple(lora_B.shape)} "
+                    f"do not fit the layer {tuple(base_layer.weight.shape)}"
+                )
+
+    def _install_adapter(self, adapter_id, factors):
+        # checked before any layer is wrapped, so a mismatched adapter leaves the model untouched
+        self._check_factors(factors)
+        device = self._device()
+        for name, (lora_A, lora_B, scaling) in factors.items():
+            layer = self._layers.get(name)
+            if layer is None:
+                parent_name, _, child_name = name.rpartition(".")
+                parent = self.model.get_submodule(parent_name) if parent_name else self.model
+                base_layer = getattr(parent, child_name)
+                layer_cls = MultiLoRAEmbedding if isinstance(base_layer, nn.Embedding) else MultiLoRALinear
+                layer = layer_cls(base_layer, self)
+                setattr(parent, child_name, layer)
+                self._layers[name] = layer
+            dtype = layer.weight.dtype
+            layer.adapters[adapter_id] = (lora_A.to(device, dtype), lora_B.to(device, dtype), scaling)
+
+    def uninstall(self):
+        """Put the base layers back, registered adapters are kept for the next install."""
+        if not self.installed:
+            return
+        for name, layer in self._layers.items():
+            parent_name, _, child_name = name.rpartition(".")
+            parent = self.model.get_submodule(parent_name) if parent_name else self.model
+            setattr(parent, child_name, layer.base_layer)
+        self._layers = {}
+        self.route = None
+        self.installed = False
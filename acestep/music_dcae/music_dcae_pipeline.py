@@ -7,8 +7,11 @@ Apache 2.0 License
 """
 
 import os
+from glob import glob
+
 import torch
 from diffusers import AutoencoderDC
+from safetensors import safe_open
 import torchaudio
 import torchvision.transforms as transforms
 from diffusers.models.modeling_utils import ModelMixin
@@ -16,6 +19,8 @@ from diffusers.loaders import FromOriginalModelMixin
 from diffusers.configuration_utils import ConfigMixin, register_to_config
 from tqdm import tqdm
 
+from acestep.profiling import NULL_TRACER
+
 try:
     from .music_vocoder import ADaMoSHiFiGANV1
 except ImportError:
@@ -27,6 +32,25 @@ DEFAULT_PRETRAINED_PATH = os.path.join(root_dir, "checkpoints", "music_dcae_f8c8
 VOCODER_PRETRAINED_PATH = os.path.join(root_dir, "checkpoints", "music_vocoder")
 
 
+def load_dcae_decoder(checkpoint_path):
+    """
+    AutoencoderDC with only its decoder, built on the meta device and filled with the
+    decoder weights of the checkpoint, so the encoder weights are never read. Works with
+    full checkpoints and with the decoder only ones written by export_inference_checkpoint.py.
+    """
+    with torch.device("meta"):
+        dcae = AutoencoderDC.from_config(AutoencoderDC.load_config(checkpoint_path))
+    dcae.encoder = None
+    state_dict = {}
+    for path in sorted(glob(os.path.join(checkpoint_path, "*.safetensors"))):
+        with safe_open(path, framework="pt") as f:
+            for key in f.keys():
+                if key.startswith("decoder."):
+                    state_dict[key] = f.get_tensor(key)
+    dcae.load_state_dict(state_dict, assign=True)
+    return dcae
+
+
 class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
     @register_to_config
     def __init__(
@@ -34,11 +58,24 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         source_sample_rate=None,
         dcae_checkpoint_path=DEFAULT_PRETRAINED_PATH,
         vocoder_checkpoint_path=VOCODER_PRETRAINED_PATH,
+        dcae_config=None,
+        vocoder_config=None,
+        decoder_only=False,
     ):
         super(MusicDCAE, self).__init__()
 
-        self.dcae = AutoencoderDC.from_pretrained(dcae_checkpoint_path)
-        self.vocoder = ADaMoSHiFiGANV1.from_pretrained(vocoder_checkpoint_path)
+        # configs build randomly initialized models, e.g. for benchmarks without checkpoints
+        if dcae_config is not None:
+            self.dcae = AutoencoderDC.from_config(dcae_config)
+        elif decoder_only:
+            # text2music only decodes, audio inputs need the encoder
+            self.dcae = load_dcae_decoder(dcae_checkpoint_path)
+        else:
+            self.dcae = AutoencoderDC.from_pretrained(dcae_checkpoint_path)
+        if vocoder_config is not None:
+            self.vocoder = ADaMoSHiFiGANV1.from_config(vocoder_config)
+        else:
+            self.vocoder = ADaMoSHiFiGANV1.from_pretrained(vocoder_checkpoint_path)
 
         if source_sample_rate is None:
             source_sample_rate = 48000
@@ -58,6 +95,18 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         self.latent_chunk_size = self.mel_chunk_size // self.time_dimention_multiple
         self.scale_factor = 0.1786
         self.shift_factor = -1.9091
+        # set by ACEStepPipeline to time the DCAE and vocoder windows
+        self.tracer = NULL_TRACER
+
+    def train(self, mode=True):
+        super().train(mode)
+        # the vocoder weight norm only matters for training, in eval mode the normalized
+        # weights are folded once instead of being recomputed by every vocoder forward
+        if mode:
+            self.vocoder.apply_weight_norm()
+        else:
+            self.vocoder.remove_weight_norm()
+        return self
 
     def load_audio(self, audio_path):
         audio, sr = torchaudio.load(audio_path)
@@ -75,6 +124,8 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
 
     @torch.no_grad()
     def encode(self, audios, audio_lengths=None, sr=None):
+        if self.dcae.encoder is None:
+            raise ValueError("MusicDCAE was loaded with decoder_only=True and cannot encode audio")
         if audio_lengths is None:
             audio_lengths = torch.tensor([audios.shape[2]] * audios.shape[0])
             audio_lengths = audio_lengths.to(audios.device)
@@ -112,20 +163,25 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         return latents, latent_lengths
 
     @torch.no_grad()
-    def decode(self, latents, audio_lengths=None, sr=None):
-        latents = latents / self.scale_factor + self.shift_factor
-
+    def decode(self, latents, audio_lengths=None, sr=None, cancellation_token=None):
+        # latents is a batch tensor or a list of [C, H, W] latents of different lengths
         pred_wavs = []
 
-        for latent in latents:
-            mels = self.dcae.decoder(latent.unsqueeze(0))
+        for latent_idx, latent in enumerate(latents):
+            if cancellation_token is not None:
+                cancellation_token.raise_if_cancelled(stage="decode", step=latent_idx)
+            latent = latent / self.scale_factor + self.shift_factor
+            with self.tracer.stage("latents2audio.dcae", sample=latent_idx):
+                mels = self.dcae.decoder(latent.unsqueeze(0))
             mels = mels * 0.5 + 0.5
             mels = mels * (self.max_mel_value - self.min_mel_value) + self.min_mel_value
 
             # wav = self.vocoder.decode(mels[0]).squeeze(1)
             # decode waveform for each channels to reduce vram footprint
-            wav_ch1 = self.vocoder.decode(mels[:,0,:,:]).squeeze(1).cpu()
-            wav_ch2 = self.vocoder.decode(mels[:,1,:,:]).squeeze(1).cpu()
+            with self.tracer.stage("latents2audio.vocoder", sample=latent_idx, channel=0):
+                wav_ch1 = self.vocoder.decode(mels[:,0,:,:]).squeeze(1).cpu()
+            with self.tracer.stage("latents2audio.vocoder", sample=latent_idx, channel=1):
+                wav_ch2 = self.vocoder.decode(mels[:,1,:,:]).squeeze(1).cpu()
             wav = torch.cat([wav_ch1, wav_ch2],dim=0)
 
             if sr is not None:
@@ -144,7 +200,7 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         return sr, pred_wavs
 
     @torch.no_grad()
-    def decode_overlap(self, latents, audio_lengths=None, sr=None):
+    def decode_overlap(self, latents, audio_lengths=None, sr=None, cancellation_token=None):
         """
         Decodes latents into waveforms using an overlapped DCAE and Vocoder.
         """
@@ -208,7 +264,11 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
                     dcae_input_segment = current_latent[:, :, :, win_start_idx:win_end_idx]
                     if dcae_input_segment.shape[3] == 0: continue
 
-                    mel_output_full = self.dcae.decoder(dcae_input_segment) # (1, C, H_mel, W_mel_fixed_from_dcae)
+                    if cancellation_token is not None:
+                        cancellation_token.raise_if_cancelled(stage="decode", step=i)
+
+                    with self.tracer.stage("latents2audio.dcae", sample=latent_idx, window=i):
+                        mel_output_full = self.dcae.decoder(dcae_input_segment) # (1, C, H_mel, W_mel_fixed_from_dcae)
 
                     is_first = (i == 0)
                     is_last = (i == len(dcae_anchors) - 1)
@@ -264,7 +324,8 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
                     pad_len = vocoder_input_mel_frames_per_block - mel_block.shape[2]
                     mel_block = torch.nn.functional.pad(mel_block, (0, pad_len), mode='constant', value=0) # Pad last dim
                 
-                current_audio_output = self.vocoder.decode(mel_block) # (C_audio, 1, Samples)
+                with self.tracer.stage("latents2audio.vocoder", sample=latent_idx, window=0):
+                    current_audio_output = self.vocoder.decode(mel_block) # (C_audio, 1, Samples)
                 current_audio_output = current_audio_output[:, :, :-vocoder_overlap_len_audio] # Remove end overlap
 
                 # p_audio_samples tracks the start of the *next* audio segment to generate (in conceptual total audio samples)
@@ -283,6 +344,9 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
                     
                     if mel_frame_start >= mel_total_frames: break # No more mel frames
 
+                    if cancellation_token is not None:
+                        cancellation_token.raise_if_cancelled(stage="vocoder", step=p_audio_samples // vocoder_hop_len_audio)
+
                     mel_block = concatenated_mels[0, :, :, mel_frame_start:min(mel_frame_end, mel_total_frames)].to(self.device)
                     
                     if mel_block.shape[2] == 0: break # Should not happen if mel_frame_start is valid
@@ -292,7 +356,8 @@ class MusicDCAE(ModelMixin, ConfigMixin, FromOriginalModelMixin):
                         pad_len = vocoder_input_mel_frames_per_block - mel_block.shape[2]
                         mel_block = torch.nn.functional.pad(mel_block, (0, pad_len), mode='constant', value=0)
 
-                    new_audio_win = self.vocoder.decode(mel_block) # (C_audio, 1, Samples)
+                    with self.tracer.stage("latents2audio.vocoder", sample=latent_idx, window=p_audio_samples // vocoder_hop_len_audio):
+                        new_audio_win = self.vocoder.decode(mel_block) # (C_audio, 1, Samples)
 
                     # Crossfade
                     # Determine actual crossfade length based on available audio
@@ -17,8 +17,8 @@ from typing import Callable, Tuple, List
 import numpy as np
 import torch.nn.functional as F
 from torch.nn import Conv1d
-from torch.nn.utils import weight_norm
-from torch.nn.utils.parametrize import remove_parametrizations as remove_weight_norm
+# the convs use the hook based weight_norm, so it is removed with the matching remove_weight_norm
+from torch.nn.utils import remove_weight_norm, weight_norm
 from diffusers.models.modeling_utils import ModelMixin
 from diffusers.loaders import FromOriginalModelMixin
 from diffusers.configuration_utils import ConfigMixin, register_to_config
@@ -358,6 +358,9 @@ class ResBlock1(torch.nn.Module):
             x = xt + x
         return x
 
+    def weight_norm_convs(self):
+        return [*self.convs1, *self.convs2]
+
     def remove_weight_norm(self):
         for conv in self.convs1:
             remove_weight_norm(conv)
@@ -480,13 +483,35 @@ class HiFiGANGenerator(nn.Module):
 
         return x
 
-    def remove_weight_norm(self):
-        for up in self.ups:
-            remove_weight_norm(up)
+    def weight_norm_convs(self):
+        convs = [self.conv_pre, *self.ups, self.conv_post]
         for block in self.resblocks:
-            block.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
-        remove_weight_norm(self.conv_post)
+            convs.extend(block.weight_norm_convs())
+        return convs
+
+    @property
+    def weight_norm_folded(self):
+        return not hasattr(self.conv_pre, "weight_g")
+
+    def remove_weight_norm(self):
+        """Fold the weight norm into plain weights, so the forward stops renormalizing them."""
+        if self.weight_norm_folded:
+            return
+        for conv in self.weight_norm_convs():
+            # the folded weight is a new Parameter, it keeps the frozen state of the normalized one
+            requires_grad = conv.weight_g.requires_grad
+            remove_weight_norm(conv)
+            conv.weight.requires_grad_(requires_grad)
+
+    def apply_weight_norm(self):
+        """Undo remove_weight_norm, the folded weights become the magnitude and direction again."""
+        if not self.weight_norm_folded:
+            return
+        for conv in self.weight_norm_convs():
+            requires_grad = conv.weight.requires_grad
+            weight_norm(conv)
+            conv.weight_g.requires_grad_(requires_grad)
+            conv.weight_v.requires_grad_(requires_grad)
 
 
 class ADaMoSHiFiGANV1(ModelMixin, ConfigMixin, FromOriginalModelMixin):
@@ -555,6 +580,13 @@ class ADaMoSHiFiGANV1(ModelMixin, ConfigMixin, FromOriginalModelMixin):
         )
         self.eval()
 
+    def remove_weight_norm(self):
+        """Fold the weight norm of the HiFiGAN convs into plain weights, for inference only."""
+        self.head.remove_weight_norm()
+
+    def apply_weight_norm(self):
+        self.head.apply_weight_norm()
+
     @torch.no_grad()
     def decode(self, mel):
         y = self.backbone(mel)
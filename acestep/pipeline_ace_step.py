@@ -10,6 +10,7 @@ import random
 import time
 import os
 import re
+import shutil
 import torch.nn as nn
 import torch
 from loguru import logger
@@ -32,10 +33,12 @@ from diffusers.pipelines.stable_diffusion_3.pipeline_stable_diffusion_3 import (
 )
 from diffusers.utils.torch_utils import randn_tensor
 from diffusers.utils.peft_utils import set_weights_and_activate_adapters
-from transformers import UMT5EncoderModel, AutoTokenizer
+from diffusers import AutoencoderDC
+from transformers import UMT5Config, UMT5EncoderModel, AutoTokenizer
 
 from acestep.language_segmentation import LangSegment, language_filters
 from acestep.music_dcae.music_dcae_pipeline import MusicDCAE
+from acestep.music_dcae.music_vocoder import ADaMoSHiFiGANV1
 from acestep.models.ace_step_transformer import ACEStepTransformer2DModel
 from acestep.models.lyrics_utils.lyric_tokenizer import VoiceBpeTokenizer
 from acestep.apg_guidance import (
@@ -47,6 +50,17 @@ from acestep.apg_guidance import (
 )
 import torchaudio
 from .cpu_offload import cpu_offload
+from acestep.profiling import StageTracer
+from acestep.lru_cache import LRUCache
+from acestep.cancellation import CancelledResult, GenerationCancelled
+from acestep.result_cache import ResultCache, canonical_hash, file_sha256
+from acestep.audio_writer import AudioWriter, encode_audio, save_audio, save_json
+from acestep.lora_cache import LoRAAdapterCache, lora_signature
+from acestep.lora_merge import LoRAMerger, lora_deltas
+from acestep.multi_lora import MultiLoRA, lora_factors
+from acestep.quantization import INT8_MODES, load_int8_checkpoint, quantize_int8, save_int8_checkpoint
+from acestep.lora_checkpoint_writer import LORA_WEIGHT_NAME_SAFE
+from acestep.shared_weights import load_shared_weights, save_shared_weights
 
 from acestep.resize_lyric_emb import resize_and_initialize_embedding
 from acestep.models.lyrics_utils.vocab_utils import *
@@ -87,8 +101,34 @@ def ensure_directory_exists(directory):
         os.makedirs(directory)
 
 
+def per_sample(value, batch_size, name):
+    """Broadcast a single value to the batch, or check that a list holds one value per sample."""
+    if isinstance(value, (list, tuple)):
+        if len(value) != batch_size:
+            raise ValueError(f"{name} has {len(value)} values but batch_size is {batch_size}")
+        return list(value)
+    return [value] * batch_size
+
+
+def pad_and_cat(tensors):
+    """Right-pad [1, L, ...] tensors with zeros to the longest L and concatenate them along the batch."""
+    max_length = max(tensor.shape[1] for tensor in tensors)
+    padded = []
+    for tensor in tensors:
+        pad = [0, 0] * (tensor.dim() - 2) + [0, max_length - tensor.shape[1]]
+        padded.append(torch.nn.functional.pad(tensor, pad))
+    return torch.cat(padded, dim=0)
+
+
+def duration_to_frame_length(duration):
+    return int(duration * 44100 / 512 / 8)
+
+
 REPO_ID = "ACE-Step/ACE-Step-v1-3.5B"
 REPO_ID_QUANT = REPO_ID + "-q4-K-M" # ??? update this i guess
+# written last by export_shared_weights, it marks a complete export
+SHARED_WEIGHTS_INFO = "shared_weights.json"
+SHARED_WEIGHT_MODELS = ("ace_step_transformer", "music_dcae", "text_encoder_model")
 
 
 # class ACEStepPipeline(DiffusionPipeline):
@@ -104,6 +144,20 @@ class ACEStepPipeline:
         cpu_offload=False,
         quantized=False,
         overlapped_decode=False,
+        result_cache_dir=None,
+        result_cache_size_gb=10.0,
+        cache_latents=False,
+        async_io=False,
+        io_workers=2,
+        lora_cache_size=4,
+        merge_lora=False,
+        lora_merge_cache_size=2,
+        multi_lora_max_adapters=8,
+        int8_quantization=None,
+        attention_chunk_threshold=None,
+        inference_only=False,
+        dcae_decoder_only=False,
+        shared_weights_dir=None,
         **kwargs,
     ):
         if not checkpoint_dir:
@@ -119,6 +173,15 @@ class ACEStepPipeline:
         self.checkpoint_dir = checkpoint_dir
         self.lora_path = "none"
         self.lora_weight = 1
+        # recently used LoRAs stay in host memory, see acestep/lora_cache.py
+        self.lora_cache = LoRAAdapterCache(maxsize=lora_cache_size)
+        self.lora_signature = None
+        # fold LoRAs into the base weights instead of running PEFT layers, see acestep/lora_merge.py
+        self.merge_lora = merge_lora
+        self.lora_merger = LoRAMerger(cache_size=lora_merge_cache_size)
+        # per sample LoRAs of mixed batches, created on first use, see acestep/multi_lora.py
+        self.multi_lora = None
+        self.multi_lora_max_adapters = multi_lora_max_adapters
         device = (
             torch.device(f"cuda:{device_id}")
             if torch.cuda.is_available()
@@ -138,7 +201,77 @@ class ACEStepPipeline:
         self.torch_compile = torch_compile
         self.cpu_offload = cpu_offload
         self.quantized = quantized
+        # int8 transformer and text encoder for CPU inference, see acestep/quantization.py
+        if int8_quantization is not None:
+            if int8_quantization not in INT8_MODES:
+                raise ValueError(f"int8_quantization must be one of {INT8_MODES}, got {int8_quantization}")
+            if torch_compile or quantized:
+                raise ValueError("int8_quantization cannot be combined with torch_compile or quantized")
+            if int8_quantization == "dynamic":
+                if self.device.type != "cpu":
+                    raise ValueError("int8_quantization='dynamic' runs on the CPU only, use 'weight_only' on GPUs")
+                # the dynamic int8 kernels take float32 activations
+                self.dtype = torch.float32
+        self.int8_quantization = int8_quantization
+        # sequence length from which the linear attention runs chunked to save activation memory
+        self.attention_chunk_threshold = attention_chunk_threshold
+        # skip the training only transformer heads
+        self.inference_only = inference_only
+        # load the DCAE without its encoder, text2music only
+        self.dcae_decoder_only = dcae_decoder_only
+        # models mapped from the files of export_shared_weights, shared by the processes of a host
+        if shared_weights_dir is not None:
+            if self.device.type != "cpu":
+                raise ValueError("shared_weights_dir maps the weights into host memory, it is for CPU inference only")
+            if int8_quantization is not None or quantized or cpu_offload:
+                raise ValueError("shared_weights_dir cannot be combined with int8_quantization, quantized or cpu_offload")
+        self.shared_weights_dir = shared_weights_dir
+        # lyric vocab of the loaded checkpoint, exported shared weights carry its resized embeddings
+        self.vocab_name = DEFAULT_VOCAB_NAME
         self.overlapped_decode = overlapped_decode
+        # opt-in instrumentation, see acestep/profiling.py
+        self.tracer = StageTracer()
+        # preprocessing results reused across generations with the same inputs
+        self.caches = {
+            "text_embeddings": LRUCache(maxsize=64),
+            "lyric_tokens": LRUCache(maxsize=256),
+            "latents": LRUCache(maxsize=8),
+        }
+        # generated audio of deterministic requests, see acestep/result_cache.py
+        self.result_cache = ResultCache(result_cache_dir, result_cache_size_gb) if result_cache_dir else None
+        self.cache_latents = cache_latents
+        # with async_io audio and sidecars are written on background threads, see flush_io
+        self.audio_writer = AudioWriter(max_workers=io_workers) if async_io else None
+        self.checkpoint_dir_models = None
+        self._checkpoint_revision = None
+
+    def add_callback(self, callback):
+        """Register an acestep.profiling.PipelineCallback, e.g. a TraceRecorder."""
+        self.tracer.add_callback(callback)
+
+    def remove_callback(self, callback):
+        self.tracer.remove_callback(callback)
+
+    def clear_caches(self):
+        for cache in self.caches.values():
+            cache.clear()
+
+    def cache_stats(self):
+        stats = {name: cache.stats() for name, cache in self.caches.items()}
+        stats["lora_adapters"] = self.lora_cache.stats()
+        stats["lora_deltas"] = self.lora_merger.deltas.stats()
+        if self.result_cache is not None:
+            stats["results"] = self.result_cache.stats()
+        return stats
+
+    def audio_latents_cache_key(self, audio_path):
+        stat = os.stat(audio_path)
+        return (os.path.abspath(audio_path), stat.st_mtime_ns, stat.st_size)
+
+    def flush_io(self):
+        """Wait until every audio file and sidecar of previous generations is written."""
+        if self.audio_writer is not None:
+            self.audio_writer.flush()
 
     def cleanup_memory(self):
         """Clean up GPU and CPU memory to prevent VRAM overflow during multiple generations."""
@@ -178,18 +311,61 @@ class ACEStepPipeline:
             else:
                 logger.info(f"Download models from Hugging Face: {repo}, cache to: {checkpoint_dir}")
                 checkpoint_dir_models = snapshot_download(repo, cache_dir=checkpoint_dir)
+        self.checkpoint_dir_models = checkpoint_dir_models
+        self._checkpoint_revision = None
         return checkpoint_dir_models
 
-    def load_checkpoint(self, checkpoint_dir=None, vocab_name=DEFAULT_VOCAB_NAME, export_quantized_weights=False):
+    def checkpoint_revision(self):
+        """Fingerprint of the checkpoint files, computed without loading or downloading them."""
+        if self._checkpoint_revision is not None:
+            return self._checkpoint_revision
+        checkpoint_dir_models = self.checkpoint_dir_models
+        if checkpoint_dir_models is None:
+            try:
+                repo = REPO_ID_QUANT if self.quantized else REPO_ID
+                checkpoint_dir_models = snapshot_download(repo, cache_dir=self.checkpoint_dir, local_files_only=True)
+            except Exception:
+                return None
+        files = []
+        for root, _, names in os.walk(checkpoint_dir_models, followlinks=True):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                files.append((os.path.relpath(path, checkpoint_dir_models), stat.st_size, stat.st_mtime_ns))
+        if not files:
+            return None
+        self._checkpoint_revision = canonical_hash(sorted(files))
+        return self._checkpoint_revision
+
+    def load_checkpoint(self, checkpoint_dir=None, vocab_name=DEFAULT_VOCAB_NAME, export_quantized_weights=False, export_int8_weights=False):
         checkpoint_dir = self.get_checkpoint_path(checkpoint_dir, REPO_ID)
         dcae_checkpoint_path = os.path.join(checkpoint_dir, "music_dcae_f8c8")
         vocoder_checkpoint_path = os.path.join(checkpoint_dir, "music_vocoder")
         ace_step_checkpoint_path = os.path.join(checkpoint_dir, "ace_step_transformer")
         text_encoder_checkpoint_path = os.path.join(checkpoint_dir, "umt5-base")
-
-        self.ace_step_transformer = ACEStepTransformer2DModel.from_pretrained(
-            ace_step_checkpoint_path, torch_dtype=self.dtype
-        )
+        # exported int8 weights replace the full precision ones, the models are only built from their configs
+        int8_transformer_path = int8_text_encoder_path = None
+        if self.int8_quantization is not None and not export_int8_weights:
+            int8_transformer_path = os.path.join(
+                ace_step_checkpoint_path, f"diffusion_pytorch_model_int8_{self.int8_quantization}.pt"
+            )
+            int8_text_encoder_path = os.path.join(
+                text_encoder_checkpoint_path, f"pytorch_model_int8_{self.int8_quantization}.pt"
+            )
+            if not os.path.exists(int8_transformer_path) or not os.path.exists(int8_text_encoder_path):
+                logger.info("No exported int8 weights, quantizing the full precision checkpoint")
+                int8_transformer_path = int8_text_encoder_path = None
+
+        # checkpoints written by export_inference_checkpoint.py are inference_only in their config
+        transformer_overrides = {"inference_only": True} if self.inference_only else {}
+        if int8_transformer_path is not None:
+            self.ace_step_transformer = ACEStepTransformer2DModel.from_config(
+                ACEStepTransformer2DModel.load_config(ace_step_checkpoint_path), **transformer_overrides
+            )
+        else:
+            self.ace_step_transformer = ACEStepTransformer2DModel.from_pretrained(
+                ace_step_checkpoint_path, torch_dtype=self.dtype, **transformer_overrides
+            )
         # self.ace_step_transformer.to(self.device).eval().to(self.dtype)
         if self.cpu_offload:
             self.ace_step_transformer = (
@@ -205,6 +381,7 @@ class ACEStepPipeline:
         self.music_dcae = MusicDCAE(
             dcae_checkpoint_path=dcae_checkpoint_path,
             vocoder_checkpoint_path=vocoder_checkpoint_path,
+            decoder_only=self.dcae_decoder_only,
         )
         # self.music_dcae.to(self.device).eval().to(self.dtype)
         if self.cpu_offload:  # might be redundant
@@ -217,20 +394,15 @@ class ACEStepPipeline:
         lang_segment = LangSegment()
         lang_segment.setfilters(language_filters.default)
         self.lang_segment = lang_segment
-        if vocab_name != DEFAULT_VOCAB_NAME:
-            vocab_config_path = get_vocab_yaml_path(vocab_name)
-            config = load_yaml(vocab_config_path)
-            self.lyric_tokenizer = VoiceBpeTokenizer(vocab_file=Path(vocab_config_path).stem)
-            resize_and_initialize_embedding(self.ace_step_transformer,
-                                            self.lyric_tokenizer,
-                                            config["target_embed_name"],
-                                            config["target_init_vocab"])
-        else:
-            self.lyric_tokenizer = VoiceBpeTokenizer()
+        self.lyric_tokenizer = self.load_lyric_tokenizer(vocab_name, self.ace_step_transformer)
+        self.vocab_name = vocab_name
 
-        text_encoder_model = UMT5EncoderModel.from_pretrained(
-            text_encoder_checkpoint_path, torch_dtype=self.dtype
-        ).eval()
+        if int8_text_encoder_path is not None:
+            text_encoder_model = UMT5EncoderModel(UMT5Config.from_pretrained(text_encoder_checkpoint_path)).eval()
+        else:
+            text_encoder_model = UMT5EncoderModel.from_pretrained(
+                text_encoder_checkpoint_path, torch_dtype=self.dtype
+            ).eval()
         # text_encoder_model = text_encoder_model.to(self.device).to(self.dtype)
         if self.cpu_offload:
             text_encoder_model = text_encoder_model.to("cpu").eval().to(self.dtype)
@@ -241,9 +413,29 @@ class ACEStepPipeline:
         if self.torch_compile:
             self.text_encoder_model = torch.compile(self.text_encoder_model)
 
+        if self.int8_quantization is not None:
+            if int8_transformer_path is not None:
+                load_int8_checkpoint(self.ace_step_transformer, int8_transformer_path, self.int8_quantization)
+                load_int8_checkpoint(self.text_encoder_model, int8_text_encoder_path, self.int8_quantization)
+            else:
+                quantize_int8(self.ace_step_transformer, self.int8_quantization)
+                quantize_int8(self.text_encoder_model, self.int8_quantization)
+            if export_int8_weights:
+                save_int8_checkpoint(
+                    self.ace_step_transformer,
+                    os.path.join(ace_step_checkpoint_path, f"diffusion_pytorch_model_int8_{self.int8_quantization}.pt"),
+                )
+                save_int8_checkpoint(
+                    self.text_encoder_model,
+                    os.path.join(text_encoder_checkpoint_path, f"pytorch_model_int8_{self.int8_quantization}.pt"),
+                )
+
         self.text_tokenizer = AutoTokenizer.from_pretrained(
             text_encoder_checkpoint_path
         )
+        if self.attention_chunk_threshold is not None:
+            self.ace_step_transformer.set_linear_attention_chunking(self.attention_chunk_threshold)
+        self.clear_caches()
         self.loaded = True
 
         # compile
@@ -297,6 +489,7 @@ class ACEStepPipeline:
         self.music_dcae = MusicDCAE(
             dcae_checkpoint_path=dcae_checkpoint_path,
             vocoder_checkpoint_path=vocoder_checkpoint_path,
+            decoder_only=self.dcae_decoder_only,
         )
         if self.cpu_offload:
             self.music_dcae.eval().to(self.dtype).to(self.device)
@@ -335,6 +528,105 @@ class ACEStepPipeline:
         self.lang_segment = lang_segment
         self.lyric_tokenizer = VoiceBpeTokenizer()
 
+        if self.attention_chunk_threshold is not None:
+            self.ace_step_transformer.set_linear_attention_chunking(self.attention_chunk_threshold)
+        self.clear_caches()
+        self.loaded = True
+
+    def load_lyric_tokenizer(self, vocab_name, ace_step_transformer):
+        """Lyric tokenizer of ``vocab_name``, other vocabs than the default one resize the lyric embeddings to it."""
+        if vocab_name == DEFAULT_VOCAB_NAME:
+            return VoiceBpeTokenizer()
+        vocab_config_path = get_vocab_yaml_path(vocab_name)
+        config = load_yaml(vocab_config_path)
+        lyric_tokenizer = VoiceBpeTokenizer(vocab_file=Path(vocab_config_path).stem)
+        resize_and_initialize_embedding(ace_step_transformer,
+                                        lyric_tokenizer,
+                                        config["target_embed_name"],
+                                        config["target_init_vocab"])
+        return lyric_tokenizer
+
+    def shared_weights_info(self, vocab_name=None):
+        return {
+            "dtype": str(self.dtype),
+            "inference_only": self.inference_only,
+            "dcae_decoder_only": self.dcae_decoder_only,
+            "vocab_name": self.vocab_name if vocab_name is None else vocab_name,
+        }
+
+    def export_shared_weights(self, shared_weights_dir):
+        """Save the loaded models for load_shared_checkpoint, in the pipeline dtype so they map without a copy."""
+        os.makedirs(shared_weights_dir, exist_ok=True)
+        for name in SHARED_WEIGHT_MODELS:
+            model = getattr(self, name)
+            save_shared_weights(getattr(model, "_orig_mod", model), os.path.join(shared_weights_dir, f"{name}.pt"))
+        with open(os.path.join(shared_weights_dir, SHARED_WEIGHTS_INFO), "w", encoding="utf-8") as f:
+            json.dump(self.shared_weights_info(), f, indent=2)
+
+    def load_shared_checkpoint(self, checkpoint_dir=None, vocab_name=DEFAULT_VOCAB_NAME):
+        """
+        Build the models on the meta device and map their weights from the files of
+        export_shared_weights in shared_weights_dir, so the worker processes of a host
+        share one copy of the weights. Only configs and tokenizers are read from the checkpoint,
+        ``vocab_name`` has to be the one the weights were exported with.
+        """
+        shared_weights_dir = self.shared_weights_dir
+        info_path = os.path.join(shared_weights_dir, SHARED_WEIGHTS_INFO)
+        if not os.path.exists(info_path):
+            raise ValueError(f"No shared weights in {shared_weights_dir}, write them with export_shared_weights")
+        with open(info_path, encoding="utf-8") as f:
+            info = json.load(f)
+        expected_info = self.shared_weights_info(vocab_name)
+        if info != expected_info:
+            raise ValueError(
+                f"Shared weights in {shared_weights_dir} were exported with {info}, "
+                f"the pipeline uses {expected_info}, export them again"
+            )
+        checkpoint_dir = self.get_checkpoint_path(checkpoint_dir, REPO_ID)
+        dcae_checkpoint_path = os.path.join(checkpoint_dir, "music_dcae_f8c8")
+        vocoder_checkpoint_path = os.path.join(checkpoint_dir, "music_vocoder")
+        ace_step_checkpoint_path = os.path.join(checkpoint_dir, "ace_step_transformer")
+        text_encoder_checkpoint_path = os.path.join(checkpoint_dir, "umt5-base")
+
+        transformer_overrides = {"inference_only": True} if self.inference_only else {}
+        with torch.device("meta"):
+            ace_step_transformer = ACEStepTransformer2DModel.from_config(
+                ACEStepTransformer2DModel.load_config(ace_step_checkpoint_path), **transformer_overrides
+            )
+            music_dcae = MusicDCAE(
+                dcae_config=AutoencoderDC.load_config(dcae_checkpoint_path),
+                vocoder_config=ADaMoSHiFiGANV1.load_config(vocoder_checkpoint_path),
+            )
+            text_encoder_model = UMT5EncoderModel(UMT5Config.from_pretrained(text_encoder_checkpoint_path))
+        if self.dcae_decoder_only:
+            music_dcae.dcae.encoder = None
+        # resizes the lyric embeddings on the meta device to the exported shape
+        lyric_tokenizer = self.load_lyric_tokenizer(vocab_name, ace_step_transformer)
+        models = {
+            "ace_step_transformer": ace_step_transformer,
+            "music_dcae": music_dcae,
+            "text_encoder_model": text_encoder_model,
+        }
+        for name in SHARED_WEIGHT_MODELS:
+            # eval first, it folds the vocoder weight norm as in the exported MusicDCAE
+            model = models[name].eval().requires_grad_(False)
+            load_shared_weights(model, os.path.join(shared_weights_dir, f"{name}.pt"))
+            if self.torch_compile:
+                model = torch.compile(model)
+            setattr(self, name, model)
+
+        self.text_tokenizer = AutoTokenizer.from_pretrained(
+            text_encoder_checkpoint_path
+        )
+        lang_segment = LangSegment()
+        lang_segment.setfilters(language_filters.default)
+        self.lang_segment = lang_segment
+        self.lyric_tokenizer = lyric_tokenizer
+        self.vocab_name = vocab_name
+
+        if self.attention_chunk_threshold is not None:
+            self.ace_step_transformer.set_linear_attention_chunking(self.attention_chunk_threshold)
+        self.clear_caches()
         self.loaded = True
 
     @cpu_offload("text_encoder_model")
@@ -594,6 +886,7 @@ class ACEStepPipeline:
         n_max=1.0,
         n_avg=1,
         scheduler_type="euler",
+        cancellation_token=None,
     ):
 
         do_classifier_free_guidance = True
@@ -673,31 +966,84 @@ class ACEStepPipeline:
             if i < n_min:
                 continue
 
-            t_i = t / 1000
-
-            if i + 1 < len(timesteps):
-                t_im1 = (timesteps[i + 1]) / 1000
-            else:
-                t_im1 = torch.zeros_like(t_i).to(self.device)
-
-            if i < n_max:
-                # Calculate the average of the V predictions
-                V_delta_avg = torch.zeros_like(x_src)
-                for k in range(n_avg):
-                    fwd_noise = randn_tensor(
-                        shape=x_src.shape,
-                        generator=random_generators,
-                        device=self.device,
-                        dtype=self.dtype,
-                    )
+            if cancellation_token is not None:
+                # zt_edit is the edited clean estimate, xt_tar the trajectory of the last regular steps
+                cancellation_token.raise_if_cancelled(
+                    stage="diffusion", step=i, latents=zt_edit if xt_tar is None else xt_tar
+                )
 
-                    zt_src = (1 - t_i) * x_src + (t_i) * fwd_noise
+            with self.tracer.step(i, num_inference_steps=T_steps, task="edit"):
+                t_i = t / 1000
 
-                    zt_tar = zt_edit + zt_src - x_src
+                if i + 1 < len(timesteps):
+                    t_im1 = (timesteps[i + 1]) / 1000
+                else:
+                    t_im1 = torch.zeros_like(t_i).to(self.device)
 
-                    Vt_src, Vt_tar = self.calc_v(
-                        zt_src=zt_src,
-                        zt_tar=zt_tar,
+                if i < n_max:
+                    # Calculate the average of the V predictions
+                    V_delta_avg = torch.zeros_like(x_src)
+                    for k in range(n_avg):
+                        fwd_noise = randn_tensor(
+                            shape=x_src.shape,
+                            generator=random_generators,
+                            device=self.device,
+                            dtype=self.dtype,
+                        )
+
+                        zt_src = (1 - t_i) * x_src + (t_i) * fwd_noise
+
+                        zt_tar = zt_edit + zt_src - x_src
+
+                        Vt_src, Vt_tar = self.calc_v(
+                            zt_src=zt_src,
+                            zt_tar=zt_tar,
+                            t=t,
+                            encoder_text_hidden_states=encoder_text_hidden_states,
+                            text_attention_mask=text_attention_mask,
+                            target_encoder_text_hidden_states=target_encoder_text_hidden_states,
+                            target_text_attention_mask=target_text_attention_mask,
+                            speaker_embds=speaker_embds,
+                            target_speaker_embeds=target_speaker_embeds,
+                            lyric_token_ids=lyric_token_ids,
+                            lyric_mask=lyric_mask,
+                            target_lyric_token_ids=target_lyric_token_ids,
+                            target_lyric_mask=target_lyric_mask,
+                            do_classifier_free_guidance=do_classifier_free_guidance,
+                            guidance_scale=guidance_scale,
+                            target_guidance_scale=target_guidance_scale,
+                            attention_mask=attention_mask,
+                            momentum_buffer=momentum_buffer,
+                        )
+                        V_delta_avg += (1 / n_avg) * (Vt_tar - Vt_src)  # - (hfg - 1) * (x_src)
+
+                    zt_edit = zt_edit.to(torch.float32)  # arbitrary, should be settable for compatibility
+                    if scheduler_type != "pingpong":
+                        # propagate direct ODE
+                        zt_edit = zt_edit + (t_im1 - t_i) * V_delta_avg
+                        zt_edit = zt_edit.to(self.dtype)
+                    else:
+                        # propagate pingpong SDE
+                        zt_edit_denoised = zt_edit - t_i * V_delta_avg
+                        noise = torch.empty_like(zt_edit).normal_(generator=random_generators[0] if random_generators else None)
+                        prev_sample = (1 - t_im1) * zt_edit_denoised + t_im1 * noise
+
+                else:  # i >= T_steps-n_min # regular sampling for last n_min steps
+                    if i == n_max:
+                        fwd_noise = randn_tensor(
+                            shape=x_src.shape,
+                            generator=random_generators,
+                            device=self.device,
+                            dtype=self.dtype,
+                        )
+                        scheduler._init_step_index(t)
+                        sigma = scheduler.sigmas[scheduler.step_index]
+                        xt_src = sigma * fwd_noise + (1.0 - sigma) * x_src
+                        xt_tar = zt_edit + xt_src - x_src
+
+                    _, Vt_tar = self.calc_v(
+                        zt_src=None,
+                        zt_tar=xt_tar,
                         t=t,
                         encoder_text_hidden_states=encoder_text_hidden_states,
                         text_attention_mask=text_attention_mask,
@@ -713,66 +1059,20 @@ class ACEStepPipeline:
                         guidance_scale=guidance_scale,
                         target_guidance_scale=target_guidance_scale,
                         attention_mask=attention_mask,
-                        momentum_buffer=momentum_buffer,
+                        momentum_buffer_tar=momentum_buffer_tar,
+                        return_src_pred=False,
                     )
-                    V_delta_avg += (1 / n_avg) * (Vt_tar - Vt_src)  # - (hfg - 1) * (x_src)
-
-                zt_edit = zt_edit.to(torch.float32)  # arbitrary, should be settable for compatibility
-                if scheduler_type != "pingpong":
-                    # propagate direct ODE
-                    zt_edit = zt_edit + (t_im1 - t_i) * V_delta_avg
-                    zt_edit = zt_edit.to(self.dtype)
-                else:
-                    # propagate pingpong SDE
-                    zt_edit_denoised = zt_edit - t_i * V_delta_avg
-                    noise = torch.empty_like(zt_edit).normal_(generator=random_generators[0] if random_generators else None)
-                    prev_sample = (1 - t_im1) * zt_edit_denoised + t_im1 * noise
-
-            else:  # i >= T_steps-n_min # regular sampling for last n_min steps
-                if i == n_max:
-                    fwd_noise = randn_tensor(
-                        shape=x_src.shape,
-                        generator=random_generators,
-                        device=self.device,
-                        dtype=self.dtype,
-                    )
-                    scheduler._init_step_index(t)
-                    sigma = scheduler.sigmas[scheduler.step_index]
-                    xt_src = sigma * fwd_noise + (1.0 - sigma) * x_src
-                    xt_tar = zt_edit + xt_src - x_src
-
-                _, Vt_tar = self.calc_v(
-                    zt_src=None,
-                    zt_tar=xt_tar,
-                    t=t,
-                    encoder_text_hidden_states=encoder_text_hidden_states,
-                    text_attention_mask=text_attention_mask,
-                    target_encoder_text_hidden_states=target_encoder_text_hidden_states,
-                    target_text_attention_mask=target_text_attention_mask,
-                    speaker_embds=speaker_embds,
-                    target_speaker_embeds=target_speaker_embeds,
-                    lyric_token_ids=lyric_token_ids,
-                    lyric_mask=lyric_mask,
-                    target_lyric_token_ids=target_lyric_token_ids,
-                    target_lyric_mask=target_lyric_mask,
-                    do_classifier_free_guidance=do_classifier_free_guidance,
-                    guidance_scale=guidance_scale,
-                    target_guidance_scale=target_guidance_scale,
-                    attention_mask=attention_mask,
-                    momentum_buffer_tar=momentum_buffer_tar,
-                    return_src_pred=False,
-                )
 
-                xt_tar = xt_tar.to(torch.float32)
-                if scheduler_type != "pingpong":
-                    prev_sample = xt_tar + (t_im1 - t_i) * Vt_tar
-                    prev_sample = prev_sample.to(self.dtype)
-                    xt_tar = prev_sample
-                else:
-                    prev_sample = xt_tar - t_i * Vt_tar
-                    noise = torch.empty_like(zt_edit).normal_(generator=random_generators[0] if random_generators else None)
-                    prev_sample = (1 - t_im1) * prev_sample + t_im1 * noise
-                    xt_tar = prev_sample
+                    xt_tar = xt_tar.to(torch.float32)
+                    if scheduler_type != "pingpong":
+                        prev_sample = xt_tar + (t_im1 - t_i) * Vt_tar
+                        prev_sample = prev_sample.to(self.dtype)
+                        xt_tar = prev_sample
+                    else:
+                        prev_sample = xt_tar - t_i * Vt_tar
+                        noise = torch.empty_like(zt_edit).normal_(generator=random_generators[0] if random_generators else None)
+                        prev_sample = (1 - t_im1) * prev_sample + t_im1 * noise
+                        xt_tar = prev_sample
 
         target_latents = zt_edit if xt_tar is None else xt_tar
         return target_latents
@@ -853,6 +1153,7 @@ class ACEStepPipeline:
         audio2audio_enable=False,
         ref_audio_strength=0.5,
         ref_latents=None,
+        cancellation_token=None,
     ):
 
         logger.info(
@@ -898,12 +1199,20 @@ class ACEStepPipeline:
                 shift=3.0,
             )
 
-        frame_length = int(duration * 44100 / 512 / 8)
+        # a list of durations gives a batch of mixed lengths, right padded to the longest one
+        if isinstance(duration, (list, tuple)):
+            frame_lengths = [duration_to_frame_length(d) for d in duration]
+        else:
+            frame_lengths = [duration_to_frame_length(duration)] * bsz
+        frame_length = max(frame_lengths)
         if src_latents is not None:
             frame_length = src_latents.shape[-1]
+            frame_lengths = [frame_length] * bsz
         
         if ref_latents is not None:
             frame_length = ref_latents.shape[-1]
+            frame_lengths = [frame_length] * bsz
+        is_padded = min(frame_lengths) < frame_length
 
         if len(oss_steps) > 0:
             infer_steps = max(oss_steps)
@@ -936,12 +1245,28 @@ class ACEStepPipeline:
                 timesteps=None,
             )
 
-        target_latents = randn_tensor(
-            shape=(bsz, 8, 16, frame_length),
-            generator=random_generators,
-            device=self.device,
-            dtype=self.dtype,
-        )
+        if is_padded:
+            # draw the noise of every sample at its own length, so a seed gives the same
+            # song whatever it is batched with
+            target_latents = torch.cat([
+                torch.nn.functional.pad(
+                    randn_tensor(
+                        shape=(1, 8, 16, length),
+                        generator=random_generators[i],
+                        device=self.device,
+                        dtype=self.dtype,
+                    ),
+                    (0, frame_length - length),
+                )
+                for i, length in enumerate(frame_lengths)
+            ])
+        else:
+            target_latents = randn_tensor(
+                shape=(bsz, 8, 16, frame_length),
+                generator=random_generators,
+                device=self.device,
+                dtype=self.dtype,
+            )
 
         is_repaint = False
         is_extend = False
@@ -1076,6 +1401,15 @@ class ACEStepPipeline:
             )
 
         attention_mask = torch.ones(bsz, frame_length, device=self.device, dtype=self.dtype)
+        latent_mask = None
+        if is_padded:
+            frame_index = torch.arange(frame_length, device=self.device)
+            attention_mask = (
+                frame_index[None, :] < torch.tensor(frame_lengths, device=self.device)[:, None]
+            ).to(self.dtype)
+            # the transformer returns zeros for padded frames, APG and the cfg variants only see
+            # zeros there and the scheduler keeps them out of its mean shift
+            latent_mask = attention_mask[:, None, None, :]
 
         # guidance interval
         start_idx = int(num_inference_steps * ((1 - guidance_interval) / 2))
@@ -1108,65 +1442,66 @@ class ACEStepPipeline:
 
             return encoder_hidden_states
 
-        # P(speaker, text, lyric)
-        encoder_hidden_states, encoder_hidden_mask = self.ace_step_transformer.encode(
-            encoder_text_hidden_states,
-            text_attention_mask,
-            speaker_embds,
-            lyric_token_ids,
-            lyric_mask,
-        )
-
-        if use_erg_lyric:
-            # P(null_speaker, text_weaker, lyric_weaker)
-            encoder_hidden_states_null = forward_encoder_with_temperature(
-                self,
-                inputs={
-                    "encoder_text_hidden_states": (
-                        encoder_text_hidden_states_null
-                        if encoder_text_hidden_states_null is not None
-                        else torch.zeros_like(encoder_text_hidden_states)
-                    ),
-                    "text_attention_mask": text_attention_mask,
-                    "speaker_embeds": torch.zeros_like(speaker_embds),
-                    "lyric_token_idx": lyric_token_ids,
-                    "lyric_mask": lyric_mask,
-                },
-            )
-        else:
-            # P(null_speaker, null_text, null_lyric)
-            encoder_hidden_states_null, _ = self.ace_step_transformer.encode(
-                torch.zeros_like(encoder_text_hidden_states),
+        with self.tracer.stage("diffusion.encode"):
+            # P(speaker, text, lyric)
+            encoder_hidden_states, encoder_hidden_mask = self.ace_step_transformer.encode(
+                encoder_text_hidden_states,
                 text_attention_mask,
-                torch.zeros_like(speaker_embds),
-                torch.zeros_like(lyric_token_ids),
+                speaker_embds,
+                lyric_token_ids,
                 lyric_mask,
             )
 
-        encoder_hidden_states_no_lyric = None
-        if do_double_condition_guidance:
-            # P(null_speaker, text, lyric_weaker)
             if use_erg_lyric:
-                encoder_hidden_states_no_lyric = forward_encoder_with_temperature(
+                # P(null_speaker, text_weaker, lyric_weaker)
+                encoder_hidden_states_null = forward_encoder_with_temperature(
                     self,
                     inputs={
-                        "encoder_text_hidden_states": encoder_text_hidden_states,
+                        "encoder_text_hidden_states": (
+                            encoder_text_hidden_states_null
+                            if encoder_text_hidden_states_null is not None
+                            else torch.zeros_like(encoder_text_hidden_states)
+                        ),
                         "text_attention_mask": text_attention_mask,
                         "speaker_embeds": torch.zeros_like(speaker_embds),
                         "lyric_token_idx": lyric_token_ids,
                         "lyric_mask": lyric_mask,
                     },
                 )
-            # P(null_speaker, text, no_lyric)
             else:
-                encoder_hidden_states_no_lyric, _ = self.ace_step_transformer.encode(
-                    encoder_text_hidden_states,
+                # P(null_speaker, null_text, null_lyric)
+                encoder_hidden_states_null, _ = self.ace_step_transformer.encode(
+                    torch.zeros_like(encoder_text_hidden_states),
                     text_attention_mask,
                     torch.zeros_like(speaker_embds),
                     torch.zeros_like(lyric_token_ids),
                     lyric_mask,
                 )
 
+            encoder_hidden_states_no_lyric = None
+            if do_double_condition_guidance:
+                # P(null_speaker, text, lyric_weaker)
+                if use_erg_lyric:
+                    encoder_hidden_states_no_lyric = forward_encoder_with_temperature(
+                        self,
+                        inputs={
+                            "encoder_text_hidden_states": encoder_text_hidden_states,
+                            "text_attention_mask": text_attention_mask,
+                            "speaker_embeds": torch.zeros_like(speaker_embds),
+                            "lyric_token_idx": lyric_token_ids,
+                            "lyric_mask": lyric_mask,
+                        },
+                    )
+                # P(null_speaker, text, no_lyric)
+                else:
+                    encoder_hidden_states_no_lyric, _ = self.ace_step_transformer.encode(
+                        encoder_text_hidden_states,
+                        text_attention_mask,
+                        torch.zeros_like(speaker_embds),
+                        torch.zeros_like(lyric_token_ids),
+                        lyric_mask,
+                    )
+
         def forward_diffusion_with_temperature(
             self, hidden_states, timestep, inputs, tau=0.01, l_min=15, l_max=20
         ):
@@ -1195,8 +1530,19 @@ class ACEStepPipeline:
 
             return sample
 
+        # inputs of the last finished step, used for the partial result on cancellation
+        latents, noise_pred, last_sigma = None, None, None
+
         for i, t in tqdm(enumerate(timesteps), total=num_inference_steps):
 
+            if cancellation_token is not None:
+                cancellation_token.raise_if_cancelled(
+                    stage="diffusion",
+                    step=i,
+                    # x0 = x_t - sigma * v
+                    latents=lambda: None if noise_pred is None else latents - last_sigma * noise_pred,
+                )
+
             if is_repaint:
                 if i < n_min:
                     continue
@@ -1206,144 +1552,153 @@ class ACEStepPipeline:
                     target_latents = zt_edit + zt_src - x0
                     logger.info(f"repaint start from {n_min} add {t_i} level of noise")
 
-            # expand the latents if we are doing classifier free guidance
-            latents = target_latents
-
-            is_in_guidance_interval = start_idx <= i < end_idx
-            if is_in_guidance_interval and do_classifier_free_guidance:
-                # compute current guidance scale
-                if guidance_interval_decay > 0:
-                    # Linearly interpolate to calculate the current guidance scale
-                    progress = (i - start_idx) / (
-                        end_idx - start_idx - 1
-                    )  # 归一化到[0,1]
-                    current_guidance_scale = (
-                        guidance_scale
-                        - (guidance_scale - min_guidance_scale)
-                        * progress
-                        * guidance_interval_decay
-                    )
-                else:
-                    current_guidance_scale = guidance_scale
-
-                latent_model_input = latents
-                timestep = t.expand(latent_model_input.shape[0])
-                output_length = latent_model_input.shape[-1]
-                # P(x|speaker, text, lyric)
-                noise_pred_with_cond = self.ace_step_transformer.decode(
-                    hidden_states=latent_model_input,
-                    attention_mask=attention_mask,
-                    encoder_hidden_states=encoder_hidden_states,
-                    encoder_hidden_mask=encoder_hidden_mask,
-                    output_length=output_length,
-                    timestep=timestep,
-                ).sample
-
-                noise_pred_with_only_text_cond = None
-                if (
-                    do_double_condition_guidance
-                    and encoder_hidden_states_no_lyric is not None
-                ):
-                    noise_pred_with_only_text_cond = self.ace_step_transformer.decode(
-                        hidden_states=latent_model_input,
-                        attention_mask=attention_mask,
-                        encoder_hidden_states=encoder_hidden_states_no_lyric,
-                        encoder_hidden_mask=encoder_hidden_mask,
-                        output_length=output_length,
-                        timestep=timestep,
-                    ).sample
-
-                if use_erg_diffusion:
-                    noise_pred_uncond = forward_diffusion_with_temperature(
-                        self,
-                        hidden_states=latent_model_input,
-                        timestep=timestep,
-                        inputs={
-                            "encoder_hidden_states": encoder_hidden_states_null,
-                            "encoder_hidden_mask": encoder_hidden_mask,
-                            "output_length": output_length,
-                            "attention_mask": attention_mask,
-                        },
-                    )
-                else:
-                    noise_pred_uncond = self.ace_step_transformer.decode(
-                        hidden_states=latent_model_input,
-                        attention_mask=attention_mask,
-                        encoder_hidden_states=encoder_hidden_states_null,
-                        encoder_hidden_mask=encoder_hidden_mask,
-                        output_length=output_length,
-                        timestep=timestep,
-                    ).sample
-
-                if (
-                    do_double_condition_guidance
-                    and noise_pred_with_only_text_cond is not None
-                ):
-                    noise_pred = cfg_double_condition_forward(
-                        cond_output=noise_pred_with_cond,
-                        uncond_output=noise_pred_uncond,
-                        only_text_cond_output=noise_pred_with_only_text_cond,
-                        guidance_scale_text=guidance_scale_text,
-                        guidance_scale_lyric=guidance_scale_lyric,
-                    )
-
-                elif cfg_type == "apg":
-                    noise_pred = apg_forward(
-                        pred_cond=noise_pred_with_cond,
-                        pred_uncond=noise_pred_uncond,
-                        guidance_scale=current_guidance_scale,
-                        momentum_buffer=momentum_buffer,
-                    )
-                elif cfg_type == "cfg":
-                    noise_pred = cfg_forward(
-                        cond_output=noise_pred_with_cond,
-                        uncond_output=noise_pred_uncond,
-                        cfg_strength=current_guidance_scale,
-                    )
-                elif cfg_type == "cfg_star":
-                    noise_pred = cfg_zero_star(
-                        noise_pred_with_cond=noise_pred_with_cond,
-                        noise_pred_uncond=noise_pred_uncond,
-                        guidance_scale=current_guidance_scale,
-                        i=i,
-                        zero_steps=zero_steps,
-                        use_zero_init=use_zero_init,
-                    )
-            else:
-                latent_model_input = latents
-                timestep = t.expand(latent_model_input.shape[0])
-                noise_pred = self.ace_step_transformer.decode(
-                    hidden_states=latent_model_input,
-                    attention_mask=attention_mask,
-                    encoder_hidden_states=encoder_hidden_states,
-                    encoder_hidden_mask=encoder_hidden_mask,
-                    output_length=latent_model_input.shape[-1],
-                    timestep=timestep,
-                ).sample
-
-            if is_repaint and i >= n_min:
-                t_i = t / 1000
-                if i + 1 < len(timesteps):
-                    t_im1 = (timesteps[i + 1]) / 1000
+            with self.tracer.step(i, num_inference_steps=num_inference_steps):
+                # expand the latents if we are doing classifier free guidance
+                latents = target_latents
+
+                is_in_guidance_interval = start_idx <= i < end_idx
+                if is_in_guidance_interval and do_classifier_free_guidance:
+                    # compute current guidance scale
+                    if guidance_interval_decay > 0:
+                        # Linearly interpolate to calculate the current guidance scale
+                        progress = (i - start_idx) / (
+                            end_idx - start_idx - 1
+                        )  # 归一化到[0,1]
+                        current_guidance_scale = (
+                            guidance_scale
+                            - (guidance_scale - min_guidance_scale)
+                            * progress
+                            * guidance_interval_decay
+                        )
+                    else:
+                        current_guidance_scale = guidance_scale
+
+                    latent_model_input = latents
+                    timestep = t.expand(latent_model_input.shape[0])
+                    output_length = latent_model_input.shape[-1]
+                    # P(x|speaker, text, lyric)
+                    with self.tracer.stage("diffusion.decode.cond", step=i):
+                        noise_pred_with_cond = self.ace_step_transformer.decode(
+                            hidden_states=latent_model_input,
+                            attention_mask=attention_mask,
+                            encoder_hidden_states=encoder_hidden_states,
+                            encoder_hidden_mask=encoder_hidden_mask,
+                            output_length=output_length,
+                            timestep=timestep,
+                        ).sample
+
+                    noise_pred_with_only_text_cond = None
+                    if (
+                        do_double_condition_guidance
+                        and encoder_hidden_states_no_lyric is not None
+                    ):
+                        with self.tracer.stage("diffusion.decode.text_only", step=i):
+                            noise_pred_with_only_text_cond = self.ace_step_transformer.decode(
+                                hidden_states=latent_model_input,
+                                attention_mask=attention_mask,
+                                encoder_hidden_states=encoder_hidden_states_no_lyric,
+                                encoder_hidden_mask=encoder_hidden_mask,
+                                output_length=output_length,
+                                timestep=timestep,
+                            ).sample
+
+                    with self.tracer.stage("diffusion.decode.uncond", step=i, erg=use_erg_diffusion):
+                        if use_erg_diffusion:
+                            noise_pred_uncond = forward_diffusion_with_temperature(
+                                self,
+                                hidden_states=latent_model_input,
+                                timestep=timestep,
+                                inputs={
+                                    "encoder_hidden_states": encoder_hidden_states_null,
+                                    "encoder_hidden_mask": encoder_hidden_mask,
+                                    "output_length": output_length,
+                                    "attention_mask": attention_mask,
+                                },
+                            )
+                        else:
+                            noise_pred_uncond = self.ace_step_transformer.decode(
+                                hidden_states=latent_model_input,
+                                attention_mask=attention_mask,
+                                encoder_hidden_states=encoder_hidden_states_null,
+                                encoder_hidden_mask=encoder_hidden_mask,
+                                output_length=output_length,
+                                timestep=timestep,
+                            ).sample
+
+                    with self.tracer.stage("diffusion.guidance", step=i, cfg_type=cfg_type):
+                        if (
+                            do_double_condition_guidance
+                            and noise_pred_with_only_text_cond is not None
+                        ):
+                            noise_pred = cfg_double_condition_forward(
+                                cond_output=noise_pred_with_cond,
+                                uncond_output=noise_pred_uncond,
+                                only_text_cond_output=noise_pred_with_only_text_cond,
+                                guidance_scale_text=guidance_scale_text,
+                                guidance_scale_lyric=guidance_scale_lyric,
+                            )
+
+                        elif cfg_type == "apg":
+                            noise_pred = apg_forward(
+                                pred_cond=noise_pred_with_cond,
+                                pred_uncond=noise_pred_uncond,
+                                guidance_scale=current_guidance_scale,
+                                momentum_buffer=momentum_buffer,
+                            )
+                        elif cfg_type == "cfg":
+                            noise_pred = cfg_forward(
+                                cond_output=noise_pred_with_cond,
+                                uncond_output=noise_pred_uncond,
+                                cfg_strength=current_guidance_scale,
+                            )
+                        elif cfg_type == "cfg_star":
+                            noise_pred = cfg_zero_star(
+                                noise_pred_with_cond=noise_pred_with_cond,
+                                noise_pred_uncond=noise_pred_uncond,
+                                guidance_scale=current_guidance_scale,
+                                i=i,
+                                zero_steps=zero_steps,
+                                use_zero_init=use_zero_init,
+                            )
                 else:
-                    t_im1 = torch.zeros_like(t_i).to(self.device)
-                target_latents = target_latents.to(torch.float32)
-                prev_sample = target_latents + (t_im1 - t_i) * noise_pred
-                prev_sample = prev_sample.to(self.dtype)
-                target_latents = prev_sample
-                zt_src = (1 - t_im1) * x0 + (t_im1) * z0
-                target_latents = torch.where(
-                    repaint_mask == 1.0, target_latents, zt_src
-                )
-            else:
-                target_latents = scheduler.step(
-                    model_output=noise_pred,
-                    timestep=t,
-                    sample=target_latents,
-                    return_dict=False,
-                    omega=omega_scale,
-                    generator=random_generators[0],
-                )[0]
+                    latent_model_input = latents
+                    timestep = t.expand(latent_model_input.shape[0])
+                    with self.tracer.stage("diffusion.decode.cond", step=i):
+                        noise_pred = self.ace_step_transformer.decode(
+                            hidden_states=latent_model_input,
+                            attention_mask=attention_mask,
+                            encoder_hidden_states=encoder_hidden_states,
+                            encoder_hidden_mask=encoder_hidden_mask,
+                            output_length=latent_model_input.shape[-1],
+                            timestep=timestep,
+                        ).sample
+
+                with self.tracer.stage("diffusion.scheduler", step=i, scheduler_type=scheduler_type):
+                    if is_repaint and i >= n_min:
+                        t_i = t / 1000
+                        if i + 1 < len(timesteps):
+                            t_im1 = (timesteps[i + 1]) / 1000
+                        else:
+                            t_im1 = torch.zeros_like(t_i).to(self.device)
+                        target_latents = target_latents.to(torch.float32)
+                        prev_sample = target_latents + (t_im1 - t_i) * noise_pred
+                        prev_sample = prev_sample.to(self.dtype)
+                        target_latents = prev_sample
+                        zt_src = (1 - t_im1) * x0 + (t_im1) * z0
+                        target_latents = torch.where(
+                            repaint_mask == 1.0, target_latents, zt_src
+                        )
+                    else:
+                        target_latents = scheduler.step(
+                            model_output=noise_pred,
+                            timestep=t,
+                            sample=target_latents,
+                            return_dict=False,
+                            omega=omega_scale,
+                            generator=random_generators[0],
+                            latent_mask=latent_mask,
+                        )[0]
+                last_sigma = t / 1000
 
         if is_extend:
             if to_right_pad_gt_latents is not None:
@@ -1364,30 +1719,51 @@ class ACEStepPipeline:
         sample_rate=48000,
         save_path=None,
         format="wav",
+        cancellation_token=None,
+        latent_lengths=None,
+        in_memory=False,
     ):
         output_audio_paths = []
         bs = latents.shape[0]
         pred_latents = latents
+        if latent_lengths is not None:
+            # drop the right padding of a mixed duration batch before decoding
+            pred_latents = [latent[..., :length] for latent, length in zip(latents, latent_lengths)]
+        # torch.compile wraps the module, the windows are traced inside the original one
+        getattr(self.music_dcae, "_orig_mod", self.music_dcae).tracer = self.tracer
         with torch.no_grad():
             if self.overlapped_decode and target_wav_duration_second > 48:
-                _, pred_wavs = self.music_dcae.decode_overlap(pred_latents, sr=sample_rate)
+                _, pred_wavs = self.music_dcae.decode_overlap(pred_latents, sr=sample_rate, cancellation_token=cancellation_token)
             else:
-                _, pred_wavs = self.music_dcae.decode(pred_latents, sr=sample_rate)
+                _, pred_wavs = self.music_dcae.decode(pred_latents, sr=sample_rate, cancellation_token=cancellation_token)
         pred_wavs = [pred_wav.cpu().float() for pred_wav in pred_wavs]
         for i in tqdm(range(bs)):
-            output_audio_path = self.save_wav_file(
-                pred_wavs[i],
-                i,
-                save_path=save_path,
-                sample_rate=sample_rate,
-                format=format,
-            )
+            if cancellation_token is not None:
+                cancellation_token.raise_if_cancelled(stage="save", step=i)
+            with self.tracer.stage("latents2audio.save", index=i, format=format):
+                if in_memory:
+                    # encoded bytes instead of files, e.g. for API responses
+                    if self.audio_writer is not None:
+                        output_audio_path = self.audio_writer.encode_audio(pred_wavs[i], sample_rate, format)
+                    else:
+                        output_audio_path = encode_audio(pred_wavs[i], sample_rate, format)
+                else:
+                    output_audio_path = self.save_wav_file(
+                        pred_wavs[i],
+                        i,
+                        save_path=save_path,
+                        sample_rate=sample_rate,
+                        format=format,
+                    )
             output_audio_paths.append(output_audio_path)
+        if in_memory and self.audio_writer is not None:
+            output_audio_paths = [future.result() for future in output_audio_paths]
         return output_audio_paths
 
-    def save_wav_file(
-        self, target_wav, idx, save_path=None, sample_rate=48000, format="wav"
-    ):
+    def get_output_path(self, idx, save_path=None, format="wav"):
+        if isinstance(save_path, (list, tuple)):
+            # one path per sample
+            save_path = save_path[idx]
         if save_path is None:
             logger.warning("save_path is None, using default path ./outputs/")
             base_path = "./outputs"
@@ -1402,15 +1778,18 @@ class ACEStepPipeline:
                 output_path_wav = os.path.join(save_path, f"output_{time.strftime('%Y%m%d%H%M%S')}_{idx}."+format)
             else:
                 output_path_wav = save_path
+        return output_path_wav
 
-        target_wav = target_wav.float()
-        backend = "soundfile"
-        if format == "ogg":
-            backend = "sox"
-        logger.info(f"Saving audio to {output_path_wav} using backend {backend}")
-        torchaudio.save(
-            output_path_wav, target_wav, sample_rate=sample_rate, format=format, backend=backend
-        )
+    def save_wav_file(
+        self, target_wav, idx, save_path=None, sample_rate=48000, format="wav"
+    ):
+        output_path_wav = self.get_output_path(idx, save_path=save_path, format=format)
+
+        logger.info(f"Saving audio to {output_path_wav}")
+        if self.audio_writer is not None:
+            self.audio_writer.write_audio(output_path_wav, target_wav, sample_rate, format)
+        else:
+            save_audio(output_path_wav, target_wav, sample_rate, format)
         return output_path_wav
 
     @cpu_offload("music_dcae")
@@ -1423,22 +1802,240 @@ class ACEStepPipeline:
         latents, _ = self.music_dcae.encode(input_audio, sr=sr)
         return latents
 
-    def load_lora(self, lora_name_or_path, lora_weight):
-        if (lora_name_or_path != self.lora_path or lora_weight != self.lora_weight) and lora_name_or_path != "none":
-            if not os.path.exists(lora_name_or_path):
-                lora_download_path = snapshot_download(lora_name_or_path, cache_dir=self.checkpoint_dir)
-            else:
-                lora_download_path = lora_name_or_path
-            if self.lora_path != "none":
+    def result_cache_key(self, params):
+        """
+        Canonical hash of everything that determines the generated audio, or None
+        when the request is not reproducible (random seeds or random duration).
+        """
+        def seeds_fixed(seeds):
+            if isinstance(seeds, str):
+                parts = [part.strip() for part in seeds.split(",")]
+                return len(parts) > 0 and all(part.isdigit() for part in parts)
+            if isinstance(seeds, list):
+                return len(seeds) > 0 and all(isinstance(seed, int) for seed in seeds)
+            return isinstance(seeds, int)
+
+        durations = params["audio_duration"]
+        if not isinstance(durations, (list, tuple)):
+            durations = [durations]
+        if min(durations) <= 0 or not seeds_fixed(params["manual_seeds"]):
+            return None
+        if params["task"] in ("retake", "repaint", "extend", "edit") and not seeds_fixed(params["retake_seeds"]):
+            return None
+        checkpoint_revision = self.checkpoint_revision()
+        if checkpoint_revision is None:
+            return None
+
+        lora_names = params["lora_name_or_path"]
+        if not isinstance(lora_names, (list, tuple)):
+            lora_names = [lora_names]
+        lora_revisions = []
+        for lora_name_or_path in lora_names:
+            lora_weights_path = os.path.join(lora_name_or_path, LORA_WEIGHT_NAME_SAFE)
+            lora_revisions.append(file_sha256(lora_weights_path) if os.path.exists(lora_weights_path) else None)
+        lora_revision = lora_revisions[0] if len(lora_revisions) == 1 else lora_revisions
+        audio_hashes = {
+            name: file_sha256(params[name])
+            for name in ("src_audio_path", "ref_audio_input")
+            if params[name] is not None and os.path.exists(params[name])
+        }
+        return canonical_hash(
+            {
+                "params": params,
+                "audio_hashes": audio_hashes,
+                "checkpoint_revision": checkpoint_revision,
+                "lora_revision": lora_revision,
+                "dtype": str(self.dtype),
+                "device_type": self.device.type,
+                "quantized": self.quantized,
+                "int8_quantization": self.int8_quantization,
+                "overlapped_decode": self.overlapped_decode,
+                "merge_lora": self.merge_lora,
+                "inference_only": self.inference_only,
+            }
+        )
+
+    def replay_cached_result(self, result, save_path=None, format="wav"):
+        output_paths = []
+        for idx, cached_audio_path in enumerate(result["audio_paths"]):
+            output_path = self.get_output_path(idx, save_path=save_path, format=format)
+            shutil.copyfile(cached_audio_path, output_path)
+            output_paths.append(output_path)
+
+        input_params_json = dict(result["input_params_json"])
+        input_params_json["timecosts"] = {"preprocess": 0.0, "diffusion": 0.0, "latent2audio": 0.0}
+        input_params_json["result_cache_hit"] = True
+        for output_audio_path in output_paths:
+            input_params_json_save_path = output_audio_path.replace(
+                f".{format}", "_input_params.json"
+            )
+            input_params_json["audio_path"] = output_audio_path
+            save_json(input_params_json_save_path, input_params_json)
+        return output_paths + [input_params_json]
+
+    def read_cached_result(self, result):
+        outputs = []
+        for cached_audio_path in result["audio_paths"]:
+            with open(cached_audio_path, "rb") as f:
+                outputs.append(f.read())
+        input_params_json = dict(result["input_params_json"])
+        input_params_json["timecosts"] = {"preprocess": 0.0, "diffusion": 0.0, "latent2audio": 0.0}
+        input_params_json["result_cache_hit"] = True
+        return outputs + [input_params_json]
+
+    def handle_cancelled(self, reason, stage, step, latents, audio_duration, save_path=None, format="wav", latent_lengths=None):
+        logger.info(f"Generation {reason} during {stage} at step {step}")
+        self.cleanup_memory()
+        output_paths = []
+        if latents is not None:
+            logger.info("Decoding the partial result from the current latent estimate")
+            output_paths = self.latents2audio(
+                latents=latents.to(self.dtype),
+                target_wav_duration_second=audio_duration,
+                save_path=save_path,
+                format=format,
+                latent_lengths=latent_lengths,
+            )
+            del latents
+            self.cleanup_memory()
+        return CancelledResult(reason, stage=stage, step=step, output_paths=output_paths)
+
+    def copy_lora_weights(self, state_dict):
+        """
+        Copy a LoRA state dict into the adapter that is already loaded, returns False
+        when the state dict does not fit the adapter layers one to one.
+        """
+        params = {
+            name.replace(".ace_step_lora", ""): param
+            for name, param in self.ace_step_transformer.named_parameters()
+            if ".ace_step_lora" in name
+        }
+        weights = {key: tensor for key, tensor in state_dict.items() if not key.endswith("alpha")}
+        if len(weights) != len(params):
+            return False
+        pairs = []
+        for key, tensor in weights.items():
+            param = params.get(key)
+            if param is None and key.startswith("transformer."):
+                param = params.get(key[len("transformer."):])
+            if param is None or param.shape != tensor.shape:
+                return False
+            pairs.append((param, tensor))
+        with torch.no_grad():
+            for param, tensor in pairs:
+                param.copy_(tensor, non_blocking=True)
+        return True
+
+    def load_lora_adapter(self, lora_name_or_path):
+        """Inject the PEFT adapter of a LoRA, in place of a loaded one when the layers fit."""
+        state_dict = self.lora_cache.get(lora_name_or_path, cache_dir=self.checkpoint_dir)
+        signature = lora_signature(state_dict)
+        if self.lora_signature is not None and signature == self.lora_signature and self.copy_lora_weights(state_dict):
+            logger.info(f"Swapped lora weights in place: {self.lora_path} -> {lora_name_or_path}")
+        else:
+            if self.lora_signature is not None:
                 self.ace_step_transformer.unload_lora()
-            self.ace_step_transformer.load_lora_adapter(os.path.join(lora_download_path, "pytorch_lora_weights.safetensors"), adapter_name="ace_step_lora", with_alpha=True, prefix=None)
-            logger.info(f"Loading lora weights from: {lora_name_or_path} download path is: {lora_download_path} weight: {lora_weight}")
-            set_weights_and_activate_adapters(self.ace_step_transformer, ["ace_step_lora"], [lora_weight])
-            self.lora_path = lora_name_or_path
-            self.lora_weight = lora_weight
-        elif self.lora_path != "none" and lora_name_or_path == "none":
-            logger.info("No lora weights to load.")
+            # load_lora_adapter may consume the dict it gets, the cached one is shared
+            self.ace_step_transformer.load_lora_adapter(dict(state_dict), adapter_name="ace_step_lora", with_alpha=True, prefix=None)
+            logger.info(f"Loading lora weights from: {lora_name_or_path}")
+        self.lora_signature = signature
+
+    def unload_lora_adapter(self):
+        if self.lora_signature is not None:
             self.ace_step_transformer.unload_lora()
+            self.lora_signature = None
+
+    def merged_lora_deltas(self, lora_name_or_path):
+        weights_path = self.lora_cache.resolve(lora_name_or_path, cache_dir=self.checkpoint_dir)
+        deltas = self.lora_merger.deltas.get(weights_path)
+        if deltas is None:
+            # let PEFT compute the deltas, it knows the scaling and the embedding layout
+            self.load_lora_adapter(lora_name_or_path)
+            # a swapped in adapter keeps the scale of the previous lora_weight
+            set_weights_and_activate_adapters(self.ace_step_transformer, ["ace_step_lora"], [1.0])
+            deltas = self.lora_merger.to_host(lora_deltas(self.ace_step_transformer, "ace_step_lora"), self.dtype)
+            self.lora_merger.deltas.put(weights_path, deltas)
+            self.unload_lora_adapter()
+        return deltas
+
+    def load_multi_lora(self, lora_names, lora_weights):
+        """Route every sample of the next batches to its own LoRA, see acestep/multi_lora.py."""
+        self.lora_merger.unmerge(self.ace_step_transformer)
+        self.unload_lora_adapter()
+        self.lora_path = "none"
+        if self.multi_lora is None:
+            self.multi_lora = MultiLoRA(self.ace_step_transformer, max_adapters=self.multi_lora_max_adapters)
+        keys = []
+        for lora_name_or_path in lora_names:
+            if lora_name_or_path == "none":
+                keys.append(None)
+                continue
+            key = self.lora_cache.resolve(lora_name_or_path, cache_dir=self.checkpoint_dir)
+            if key not in self.multi_lora:
+                # PEFT reads the adapter and its scaling, its layers are only used to take the factors
+                self.multi_lora.uninstall()
+                self.load_lora_adapter(lora_name_or_path)
+                set_weights_and_activate_adapters(self.ace_step_transformer, ["ace_step_lora"], [1.0])
+                self.multi_lora.add_adapter(key, lora_factors(self.ace_step_transformer, "ace_step_lora"))
+                self.unload_lora_adapter()
+            keys.append(key)
+        self.multi_lora.set_route(keys, lora_weights)
+        logger.info(f"Routed samples to loras {lora_names} with weights {lora_weights}")
+
+    def load_lora(self, lora_name_or_path, lora_weight, merge=None):
+        """
+        Activate a LoRA with the given weight, ``"none"`` removes the active one.
+
+        With ``merge`` (by default the ``merge_lora`` option of the pipeline) the
+        adapter scaled by ``lora_weight`` is folded into the base weights instead of
+        running as extra PEFT layers, which saves two matmuls per adapted layer on
+        every step. The base weights are restored exactly when it is unloaded.
+
+        Lists give every sample of the batch its own LoRA and weight.
+        """
+        lora_names = lora_name_or_path if isinstance(lora_name_or_path, (list, tuple)) else [lora_name_or_path]
+        if self.int8_quantization is not None and any(name != "none" for name in lora_names):
+            raise ValueError("LoRAs cannot be applied to an int8 quantized transformer")
+        if isinstance(lora_name_or_path, (list, tuple)) or isinstance(lora_weight, (list, tuple)):
+            batch_size = len(lora_name_or_path if isinstance(lora_name_or_path, (list, tuple)) else lora_weight)
+            lora_names = per_sample(lora_name_or_path, batch_size, "lora_name_or_path")
+            lora_weights = per_sample(lora_weight, batch_size, "lora_weight")
+            if len(set(lora_names)) > 1 or len(set(lora_weights)) > 1:
+                return self.load_multi_lora(lora_names, lora_weights)
+            lora_name_or_path, lora_weight = lora_names[0], lora_weights[0]
+        if self.multi_lora is not None:
+            self.multi_lora.uninstall()
+
+        merge = self.merge_lora if merge is None else merge
+        if lora_name_or_path == "none":
+            if self.lora_path != "none":
+                logger.info("No lora weights to load.")
+                self.lora_merger.unmerge(self.ace_step_transformer)
+                self.unload_lora_adapter()
+                self.lora_path = "none"
+            return
+        if lora_name_or_path == self.lora_path and merge == self.lora_merger.merged:
+            if lora_weight != self.lora_weight:
+                # same adapter, only its scale changes
+                if merge:
+                    self.lora_merger.merge(self.ace_step_transformer, self.merged_lora_deltas(lora_name_or_path), lora_weight)
+                else:
+                    set_weights_and_activate_adapters(self.ace_step_transformer, ["ace_step_lora"], [lora_weight])
+                self.lora_weight = lora_weight
+            return
+
+        self.lora_merger.unmerge(self.ace_step_transformer)
+        if merge:
+            deltas = self.merged_lora_deltas(lora_name_or_path)
+            # an adapter that was active unmerged must not be applied on top
+            self.unload_lora_adapter()
+            self.lora_merger.merge(self.ace_step_transformer, deltas, lora_weight)
+        else:
+            self.load_lora_adapter(lora_name_or_path)
+            set_weights_and_activate_adapters(self.ace_step_transformer, ["ace_step_lora"], [lora_weight])
+        logger.info(f"Activated lora {lora_name_or_path} weight: {lora_weight} merged: {merge}")
+        self.lora_path = lora_name_or_path
+        self.lora_weight = lora_weight
 
     def __call__(
         self,
@@ -1481,84 +2078,163 @@ class ACEStepPipeline:
         save_path: str = None,
         batch_size: int = 1,
         debug: bool = False,
+        cancellation_token=None,
+        return_partial_on_cancel: bool = False,
+        return_audio_bytes: bool = False,
     ):
+        params = {name: value for name, value in locals().items() if name != "self"}
+        state = self.prepare_generation(params)
+        cancelled = None
+        try:
+            if state["cached_result"] is None:
+                self.run_diffusion(state)
+            outputs = self.finalize_generation(state)
+        except GenerationCancelled as e:
+            # only keep the partial latents, the traceback holds every intermediate tensor
+            cancelled = (e.reason, e.stage, e.step, e.latents if return_partial_on_cancel else None)
+
+        if cancelled is not None:
+            return self.cancel_generation(state, *cancelled)
+        return outputs
+
+    def prepare_generation(self, params):
+        """
+        First stage of a generation: load the checkpoint, look up the result cache and
+        encode the prompts, lyrics and source audio.
+
+        ``params`` holds the arguments of ``__call__``. Returns the state dict consumed by
+        run_diffusion and finalize_generation.
+        """
+        # every argument that can change the generated audio, for the result cache key
+        request_params = {
+            name: value
+            for name, value in params.items()
+            if name not in ("save_path", "debug", "cancellation_token", "return_partial_on_cancel", "return_audio_bytes")
+        }
+        p = dict(params)
 
         start_time = time.time()
 
-        if audio2audio_enable and ref_audio_input is not None:
-            task = "audio2audio"
-
-        if not self.loaded:
-            logger.warning("Checkpoint not loaded, loading checkpoint...")
-            if self.quantized:
-                self.load_quantized_checkpoint(self.checkpoint_dir)
-            else:
-                self.load_checkpoint(checkpoint_dir=self.checkpoint_dir,
-                                     vocab_name=vocab_name)
+        if p["audio2audio_enable"] and p["ref_audio_input"] is not None:
+            p["task"] = "audio2audio"
+        task = p["task"]
+        batch_size = p["batch_size"]
+
+        p["result_cache_key"] = None
+        p["cached_result"] = None
+        if self.result_cache is not None:
+            p["result_cache_key"] = self.result_cache_key(request_params)
+            if p["result_cache_key"] is not None:
+                p["cached_result"] = self.result_cache.get(p["result_cache_key"])
+            if p["cached_result"] is not None:
+                logger.info(f"Result cache hit {p['result_cache_key']}, skipping generation")
+                return p
+
+        self.tracer.generation_start(
+            task=task, audio_duration=p["audio_duration"], infer_step=p["infer_step"], batch_size=batch_size
+        )
 
-        self.load_lora(lora_name_or_path, lora_weight)
+        with self.tracer.stage("load_model"):
+            if not self.loaded:
+                logger.warning("Checkpoint not loaded, loading checkpoint...")
+                if self.quantized:
+                    self.load_quantized_checkpoint(self.checkpoint_dir)
+                elif self.shared_weights_dir is not None:
+                    self.load_shared_checkpoint(self.checkpoint_dir, vocab_name=p["vocab_name"])
+                else:
+                    self.load_checkpoint(checkpoint_dir=self.checkpoint_dir,
+                                         vocab_name=p["vocab_name"])
         load_model_cost = time.time() - start_time
         logger.info(f"Model loaded in {load_model_cost:.2f} seconds.")
 
         start_time = time.time()
 
-        random_generators, actual_seeds = self.set_seeds(batch_size, manual_seeds)
-        retake_random_generators, actual_retake_seeds = self.set_seeds(
-            batch_size, retake_seeds
+        p["random_generators"], p["actual_seeds"] = self.set_seeds(batch_size, p["manual_seeds"])
+        p["retake_random_generators"], p["actual_retake_seeds"] = self.set_seeds(
+            batch_size, p["retake_seeds"]
         )
 
+        oss_steps = p["oss_steps"]
         if isinstance(oss_steps, str) and len(oss_steps) > 0:
-            oss_steps = list(map(int, oss_steps.split(",")))
+            p["oss_steps"] = list(map(int, oss_steps.split(",")))
         else:
-            oss_steps = []
-
-        texts = [prompt]
-        encoder_text_hidden_states, text_attention_mask = self.get_text_embeddings(texts)
-        encoder_text_hidden_states = encoder_text_hidden_states.repeat(batch_size, 1, 1)
-        text_attention_mask = text_attention_mask.repeat(batch_size, 1)
-
-        encoder_text_hidden_states_null = None
-        if use_erg_tag:
-            encoder_text_hidden_states_null = self.get_text_embeddings_null(texts)
-            encoder_text_hidden_states_null = encoder_text_hidden_states_null.repeat(batch_size, 1, 1)
+            p["oss_steps"] = []
+
+        # prompt, lyrics and audio_duration take a single value for the whole batch or a list with one value per sample
+        prompts = per_sample(p["prompt"], batch_size, "prompt")
+        p["prompts"] = prompts
+        with self.tracer.stage("preprocess.text_embeddings"):
+            text_embeddings = {
+                text: self.caches["text_embeddings"].get_or_compute(
+                    ("cond", text), lambda text=text: self.get_text_embeddings([text])
+                )
+                for text in prompts
+            }
+        p["encoder_text_hidden_states"] = pad_and_cat([text_embeddings[text][0] for text in prompts])
+        p["text_attention_mask"] = pad_and_cat([text_embeddings[text][1] for text in prompts])
+
+        p["encoder_text_hidden_states_null"] = None
+        if p["use_erg_tag"]:
+            with self.tracer.stage("preprocess.text_embeddings_null"):
+                text_embeddings_null = {
+                    text: self.caches["text_embeddings"].get_or_compute(
+                        ("null", text), lambda text=text: self.get_text_embeddings_null([text])
+                    )
+                    for text in prompts
+                }
+            p["encoder_text_hidden_states_null"] = pad_and_cat([text_embeddings_null[text] for text in prompts])
 
         # not support for released checkpoint
-        speaker_embeds = torch.zeros(batch_size, 512).to(self.device).to(self.dtype)
+        p["speaker_embeds"] = torch.zeros(batch_size, 512).to(self.device).to(self.dtype)
 
         # 6 lyric
-        lyric_token_idx = torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
-        lyric_mask = torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
-        if len(lyrics) > 0:
-            lyric_token_idx = self.tokenize_lyrics(lyrics, debug=debug)
-            lyric_mask = [1] * len(lyric_token_idx)
-            lyric_token_idx = (
-                torch.tensor(lyric_token_idx)
-                .unsqueeze(0)
-                .to(self.device)
-                .repeat(batch_size, 1)
-            )
-            lyric_mask = (
-                torch.tensor(lyric_mask)
-                .unsqueeze(0)
-                .to(self.device)
-                .repeat(batch_size, 1)
-            )
-
-        if audio_duration <= 0:
+        lyric_token_idx = []
+        lyric_mask = []
+        with self.tracer.stage("preprocess.lyrics"):
+            for sample_lyrics in per_sample(p["lyrics"], batch_size, "lyrics"):
+                if len(sample_lyrics) > 0:
+                    sample_token_idx = self.caches["lyric_tokens"].get_or_compute(
+                        sample_lyrics, lambda: self.tokenize_lyrics(sample_lyrics, debug=p["debug"])
+                    )
+                    sample_mask = [1] * len(sample_token_idx)
+                else:
+                    sample_token_idx, sample_mask = [0], [0]
+                lyric_token_idx.append(torch.tensor(sample_token_idx).unsqueeze(0))
+                lyric_mask.append(torch.tensor(sample_mask).unsqueeze(0))
+        p["lyric_token_idx"] = pad_and_cat(lyric_token_idx).to(self.device).long()
+        p["lyric_mask"] = pad_and_cat(lyric_mask).to(self.device).long()
+
+        # checked here so a bad request fails before the diffusion stage
+        per_sample(p["lora_name_or_path"], batch_size, "lora_name_or_path")
+        per_sample(p["lora_weight"], batch_size, "lora_weight")
+        audio_duration = p["audio_duration"]
+        if not isinstance(audio_duration, (list, tuple)) and audio_duration <= 0:
+            # one random duration for the whole batch, only explicit per sample lists mix lengths
             audio_duration = random.uniform(30.0, 240.0)
             logger.info(f"random audio duration: {audio_duration}")
+        durations = per_sample(audio_duration, batch_size, "audio_duration")
+        for i, duration in enumerate(durations):
+            if duration <= 0:
+                durations[i] = random.uniform(30.0, 240.0)
+                logger.info(f"random audio duration of sample {i}: {durations[i]}")
+        p["durations"] = durations
+        p["latent_lengths"] = None
+        if len(set(durations)) == 1:
+            p["audio_duration"] = durations[0]
+        else:
+            if task != "text2music":
+                raise ValueError(f"Mixed audio_duration values are only supported for text2music, not {task}")
+            p["audio_duration"] = durations
+            p["latent_lengths"] = [duration_to_frame_length(duration) for duration in durations]
 
-        end_time = time.time()
-        preprocess_time_cost = end_time - start_time
-        start_time = end_time
-
-        add_retake_noise = task in ("retake", "repaint", "extend")
+        p["add_retake_noise"] = task in ("retake", "repaint", "extend")
         # retake equal to repaint
         if task == "retake":
-            repaint_start = 0
-            repaint_end = audio_duration
+            p["repaint_start"] = 0
+            p["repaint_end"] = p["audio_duration"]
 
-        src_latents = None
+        src_audio_path = p["src_audio_path"]
+        p["src_latents"] = None
         if src_audio_path is not None:
             assert src_audio_path is not None and task in (
                 "repaint",
@@ -1568,25 +2244,32 @@ class ACEStepPipeline:
             assert os.path.exists(
                 src_audio_path
             ), f"src_audio_path {src_audio_path} does not exist"
-            src_latents = self.infer_latents(src_audio_path)
+            with self.tracer.stage("preprocess.infer_latents", source="src_audio"):
+                p["src_latents"] = self.caches["latents"].get_or_compute(
+                    self.audio_latents_cache_key(src_audio_path), lambda: self.infer_latents(src_audio_path)
+                )
         
-        ref_latents = None
-        if ref_audio_input is not None and audio2audio_enable:
+        ref_audio_input = p["ref_audio_input"]
+        p["ref_latents"] = None
+        if ref_audio_input is not None and p["audio2audio_enable"]:
             assert ref_audio_input is not None, "ref_audio_input is required for audio2audio task"
             assert os.path.exists(
                 ref_audio_input
             ), f"ref_audio_input {ref_audio_input} does not exist"
-            ref_latents = self.infer_latents(ref_audio_input)
+            with self.tracer.stage("preprocess.infer_latents", source="ref_audio"):
+                p["ref_latents"] = self.caches["latents"].get_or_compute(
+                    self.audio_latents_cache_key(ref_audio_input), lambda: self.infer_latents(ref_audio_input)
+                )
 
         if task == "edit":
-            texts = [edit_target_prompt]
+            texts = [p["edit_target_prompt"]]
             target_encoder_text_hidden_states, target_text_attention_mask = (
                 self.get_text_embeddings(texts)
             )
-            target_encoder_text_hidden_states = (
+            p["target_encoder_text_hidden_states"] = (
                 target_encoder_text_hidden_states.repeat(batch_size, 1, 1)
             )
-            target_text_attention_mask = target_text_attention_mask.repeat(
+            p["target_text_attention_mask"] = target_text_attention_mask.repeat(
                 batch_size, 1
             )
 
@@ -1596,6 +2279,7 @@ class ACEStepPipeline:
             target_lyric_mask = (
                 torch.tensor([0]).repeat(batch_size, 1).to(self.device).long()
             )
+            edit_target_lyrics = p["edit_target_lyrics"]
             if len(edit_target_lyrics) > 0:
                 target_lyric_token_idx = self.tokenize_lyrics(
                     edit_target_lyrics, debug=True
@@ -1613,130 +2297,220 @@ class ACEStepPipeline:
                     .to(self.device)
                     .repeat(batch_size, 1)
                 )
+            p["target_lyric_token_idx"] = target_lyric_token_idx
+            p["target_lyric_mask"] = target_lyric_mask
 
-            target_speaker_embeds = speaker_embeds.clone()
+        p["preprocess_time_cost"] = time.time() - start_time
+        return p
 
-            target_latents = self.flowedit_diffusion_process(
-                encoder_text_hidden_states=encoder_text_hidden_states,
-                text_attention_mask=text_attention_mask,
-                speaker_embds=speaker_embeds,
-                lyric_token_ids=lyric_token_idx,
-                lyric_mask=lyric_mask,
-                target_encoder_text_hidden_states=target_encoder_text_hidden_states,
-                target_text_attention_mask=target_text_attention_mask,
+    def run_diffusion(self, state):
+        """
+        Second stage of a generation: load the LoRA and run the diffusion, the final
+        latents are stored as ``state["target_latents"]``.
+        """
+        p = state
+        with self.tracer.stage("load_lora", lora=p["lora_name_or_path"]):
+            self.load_lora(p["lora_name_or_path"], p["lora_weight"])
+
+        start_time = time.time()
+        if p["task"] == "edit":
+            target_speaker_embeds = p["speaker_embeds"].clone()
+
+            p["target_latents"] = self.flowedit_diffusion_process(
+                encoder_text_hidden_states=p["encoder_text_hidden_states"],
+                text_attention_mask=p["text_attention_mask"],
+                speaker_embds=p["speaker_embeds"],
+                lyric_token_ids=p["lyric_token_idx"],
+                lyric_mask=p["lyric_mask"],
+                target_encoder_text_hidden_states=p["target_encoder_text_hidden_states"],
+                target_text_attention_mask=p["target_text_attention_mask"],
                 target_speaker_embeds=target_speaker_embeds,
-                target_lyric_token_ids=target_lyric_token_idx,
-                target_lyric_mask=target_lyric_mask,
-                src_latents=src_latents,
-                random_generators=retake_random_generators,  # more diversity
-                infer_steps=infer_step,
-                guidance_scale=guidance_scale,
-                n_min=edit_n_min,
-                n_max=edit_n_max,
-                n_avg=edit_n_avg,
-                scheduler_type=scheduler_type,
+                target_lyric_token_ids=p["target_lyric_token_idx"],
+                target_lyric_mask=p["target_lyric_mask"],
+                src_latents=p["src_latents"],
+                random_generators=p["retake_random_generators"],  # more diversity
+                infer_steps=p["infer_step"],
+                guidance_scale=p["guidance_scale"],
+                n_min=p["edit_n_min"],
+                n_max=p["edit_n_max"],
+                n_avg=p["edit_n_avg"],
+                scheduler_type=p["scheduler_type"],
+                cancellation_token=p["cancellation_token"],
             )
         else:
-            target_latents = self.text2music_diffusion_process(
-                duration=audio_duration,
-                encoder_text_hidden_states=encoder_text_hidden_states,
-                text_attention_mask=text_attention_mask,
-                speaker_embds=speaker_embeds,
-                lyric_token_ids=lyric_token_idx,
-                lyric_mask=lyric_mask,
-                guidance_scale=guidance_scale,
-                omega_scale=omega_scale,
-                infer_steps=infer_step,
-                random_generators=random_generators,
-                scheduler_type=scheduler_type,
-                cfg_type=cfg_type,
-                guidance_interval=guidance_interval,
-                guidance_interval_decay=guidance_interval_decay,
-                min_guidance_scale=min_guidance_scale,
-                oss_steps=oss_steps,
-                encoder_text_hidden_states_null=encoder_text_hidden_states_null,
-                use_erg_lyric=use_erg_lyric,
-                use_erg_diffusion=use_erg_diffusion,
-                retake_random_generators=retake_random_generators,
-                retake_variance=retake_variance,
-                add_retake_noise=add_retake_noise,
-                guidance_scale_text=guidance_scale_text,
-                guidance_scale_lyric=guidance_scale_lyric,
-                repaint_start=repaint_start,
-                repaint_end=repaint_end,
-                src_latents=src_latents,
-                audio2audio_enable=audio2audio_enable,
-                ref_audio_strength=ref_audio_strength,
-                ref_latents=ref_latents,
+            p["target_latents"] = self.text2music_diffusion_process(
+                duration=p["audio_duration"],
+                encoder_text_hidden_states=p["encoder_text_hidden_states"],
+                text_attention_mask=p["text_attention_mask"],
+                speaker_embds=p["speaker_embeds"],
+                lyric_token_ids=p["lyric_token_idx"],
+                lyric_mask=p["lyric_mask"],
+                guidance_scale=p["guidance_scale"],
+                omega_scale=p["omega_scale"],
+                infer_steps=p["infer_step"],
+                random_generators=p["random_generators"],
+                scheduler_type=p["scheduler_type"],
+                cfg_type=p["cfg_type"],
+                guidance_interval=p["guidance_interval"],
+                guidance_interval_decay=p["guidance_interval_decay"],
+                min_guidance_scale=p["min_guidance_scale"],
+                oss_steps=p["oss_steps"],
+                encoder_text_hidden_states_null=p["encoder_text_hidden_states_null"],
+                use_erg_lyric=p["use_erg_lyric"],
+                use_erg_diffusion=p["use_erg_diffusion"],
+                retake_random_generators=p["retake_random_generators"],
+                retake_variance=p["retake_variance"],
+                add_retake_noise=p["add_retake_noise"],
+                guidance_scale_text=p["guidance_scale_text"],
+                guidance_scale_lyric=p["guidance_scale_lyric"],
+                repaint_start=p["repaint_start"],
+                repaint_end=p["repaint_end"],
+                src_latents=p["src_latents"],
+                audio2audio_enable=p["audio2audio_enable"],
+                ref_audio_strength=p["ref_audio_strength"],
+                ref_latents=p["ref_latents"],
+                cancellation_token=p["cancellation_token"],
             )
+        p["diffusion_time_cost"] = time.time() - start_time
+        return state
+
+    def finalize_generation(self, state):
+        """
+        Last stage of a generation: decode the latents, save the audio and the input
+        params and fill the result cache. Returns the output paths followed by the
+        input params dict.
+        """
+        p = state
+        save_path, format = p["save_path"], p["format"]
+        if p["cached_result"] is not None:
+            if p["return_audio_bytes"]:
+                return self.read_cached_result(p["cached_result"])
+            return self.replay_cached_result(p["cached_result"], save_path=save_path, format=format)
 
-        end_time = time.time()
-        diffusion_time_cost = end_time - start_time
-        start_time = end_time
-
-        output_paths = self.latents2audio(
-            latents=target_latents,
-            target_wav_duration_second=audio_duration,
-            save_path=save_path,
-            format=format,
-        )
+        start_time = time.time()
+        with self.tracer.stage("latents2audio"):
+            output_paths = self.latents2audio(
+                latents=p["target_latents"],
+                target_wav_duration_second=max(p["durations"]),
+                save_path=save_path,
+                format=format,
+                cancellation_token=p["cancellation_token"],
+                latent_lengths=p["latent_lengths"],
+                in_memory=p["return_audio_bytes"],
+            )
 
         # Clean up memory after generation
         self.cleanup_memory()
 
-        end_time = time.time()
-        latent2audio_time_cost = end_time - start_time
+        latent2audio_time_cost = time.time() - start_time
         timecosts = {
-            "preprocess": preprocess_time_cost,
-            "diffusion": diffusion_time_cost,
+            "preprocess": p["preprocess_time_cost"],
+            "diffusion": p["diffusion_time_cost"],
             "latent2audio": latent2audio_time_cost,
         }
 
+        task = p["task"]
         input_params_json = {
             "format": format,
-            "lora_name_or_path": lora_name_or_path,
-            "lora_weight": lora_weight,
+            "lora_name_or_path": p["lora_name_or_path"],
+            "lora_weight": p["lora_weight"],
             "task": task,
-            "prompt": prompt if task != "edit" else edit_target_prompt,
-            "lyrics": lyrics if task != "edit" else edit_target_lyrics,
-            "audio_duration": audio_duration,
-            "infer_step": infer_step,
-            "guidance_scale": guidance_scale,
-            "scheduler_type": scheduler_type,
-            "cfg_type": cfg_type,
-            "omega_scale": omega_scale,
-            "guidance_interval": guidance_interval,
-            "guidance_interval_decay": guidance_interval_decay,
-            "min_guidance_scale": min_guidance_scale,
-            "use_erg_tag": use_erg_tag,
-            "use_erg_lyric": use_erg_lyric,
-            "use_erg_diffusion": use_erg_diffusion,
-            "oss_steps": oss_steps,
+            "prompt": p["prompt"] if task != "edit" else p["edit_target_prompt"],
+            "lyrics": p["lyrics"] if task != "edit" else p["edit_target_lyrics"],
+            "audio_duration": p["audio_duration"],
+            "infer_step": p["infer_step"],
+            "guidance_scale": p["guidance_scale"],
+            "scheduler_type": p["scheduler_type"],
+            "cfg_type": p["cfg_type"],
+            "omega_scale": p["omega_scale"],
+            "guidance_interval": p["guidance_interval"],
+            "guidance_interval_decay": p["guidance_interval_decay"],
+            "min_guidance_scale": p["min_guidance_scale"],
+            "use_erg_tag": p["use_erg_tag"],
+            "use_erg_lyric": p["use_erg_lyric"],
+            "use_erg_diffusion": p["use_erg_diffusion"],
+            "oss_steps": p["oss_steps"],
             "timecosts": timecosts,
-            "actual_seeds": actual_seeds,
-            "retake_seeds": actual_retake_seeds,
-            "retake_variance": retake_variance,
-            "guidance_scale_text": guidance_scale_text,
-            "guidance_scale_lyric": guidance_scale_lyric,
-            "repaint_start": repaint_start,
-            "repaint_end": repaint_end,
-            "edit_n_min": edit_n_min,
-            "edit_n_max": edit_n_max,
-            "edit_n_avg": edit_n_avg,
-            "src_audio_path": src_audio_path,
-            "edit_target_prompt": edit_target_prompt,
-            "edit_target_lyrics": edit_target_lyrics,
-            "audio2audio_enable": audio2audio_enable,
-            "ref_audio_strength": ref_audio_strength,
-            "ref_audio_input": ref_audio_input,
+            "actual_seeds": p["actual_seeds"],
+            "retake_seeds": p["actual_retake_seeds"],
+            "retake_variance": p["retake_variance"],
+            "guidance_scale_text": p["guidance_scale_text"],
+            "guidance_scale_lyric": p["guidance_scale_lyric"],
+            "repaint_start": p["repaint_start"],
+            "repaint_end": p["repaint_end"],
+            "edit_n_min": p["edit_n_min"],
+            "edit_n_max": p["edit_n_max"],
+            "edit_n_avg": p["edit_n_avg"],
+            "src_audio_path": p["src_audio_path"],
+            "edit_target_prompt": p["edit_target_prompt"],
+            "edit_target_lyrics": p["edit_target_lyrics"],
+            "audio2audio_enable": p["audio2audio_enable"],
+            "ref_audio_strength": p["ref_audio_strength"],
+            "ref_audio_input": p["ref_audio_input"],
         }
+        if p["return_audio_bytes"]:
+            # nothing was written to disk, the outputs are the encoded files
+            if p["result_cache_key"] is not None:
+                self.result_cache.put(
+                    p["result_cache_key"],
+                    output_paths,
+                    dict(input_params_json),
+                    latents=p["target_latents"] if self.cache_latents else None,
+                    audio_format=format,
+                )
+            self.tracer.generation_end(task=task, timecosts=timecosts)
+            return output_paths + [input_params_json]
+
+        mixed_batch = task != "edit" and any(
+            isinstance(p[name], (list, tuple))
+            for name in ("prompt", "lyrics", "audio_duration", "lora_name_or_path", "lora_weight")
+        )
         # save input_params_json
-        for output_audio_path in output_paths:
+        for i, output_audio_path in enumerate(output_paths):
             input_params_json_save_path = output_audio_path.replace(
                 f".{format}", "_input_params.json"
             )
             input_params_json["audio_path"] = output_audio_path
-            with open(input_params_json_save_path, "w", encoding="utf-8") as f:
-                json.dump(input_params_json, f, indent=4, ensure_ascii=False)
+            sample_params_json = input_params_json
+            if mixed_batch:
+                # a mixed batch records the values of each sample next to its audio
+                sample_params_json = dict(
+                    input_params_json,
+                    prompt=p["prompts"][i],
+                    lyrics=per_sample(p["lyrics"], p["batch_size"], "lyrics")[i],
+                    audio_duration=p["durations"][i],
+                    lora_name_or_path=per_sample(p["lora_name_or_path"], p["batch_size"], "lora_name_or_path")[i],
+                    lora_weight=per_sample(p["lora_weight"], p["batch_size"], "lora_weight")[i],
+                )
+            if self.audio_writer is not None:
+                self.audio_writer.write_json(input_params_json_save_path, dict(sample_params_json))
+            else:
+                save_json(input_params_json_save_path, sample_params_json)
+
+        if p["result_cache_key"] is not None:
+            # the cache copies the audio files, they have to be on disk first
+            self.flush_io()
+            cached_params = {k: v for k, v in input_params_json.items() if k != "audio_path"}
+            self.result_cache.put(
+                p["result_cache_key"],
+                output_paths,
+                cached_params,
+                latents=p["target_latents"] if self.cache_latents else None,
+            )
 
+        self.tracer.generation_end(task=task, timecosts=timecosts, output_paths=output_paths)
         return output_paths + [input_params_json]
+
+    def cancel_generation(self, state, reason, stage, step, latents):
+        """Turn a cancelled generation into a CancelledResult, decoding the partial latents if given."""
+        self.tracer.generation_end(task=state["task"], cancelled=reason)
+        return self.handle_cancelled(
+            reason,
+            stage,
+            step,
+            latents,
+            audio_duration=max(state["durations"]),
+            save_path=state["save_path"],
+            format=state["format"],
+            latent_lengths=state["latent_lengths"],
+        )
@@ -0,0 +1,80 @@
+import queue
+
+import torch
+import torch.multiprocessing as mp
+from loguru import logger
+
+
+def _preview_loop(module_cls, module_kwargs, device, requests):
+    torch.set_grad_enabled(False)
+    if device.startswith("cuda"):
+        torch.cuda.set_device(torch.device(device))
+
+    # frozen models are loaded once, only the trainable tensors travel per request
+    module = module_cls(**module_kwargs).to(device).eval()
+    batch = module.get_preview_batch()
+    logger.info(f"Preview worker ready on {device}")
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        step, state_dict, save_dir = request
+        try:
+            unexpected_keys = module.transformers.load_state_dict(state_dict, strict=False).unexpected_keys
+            if unexpected_keys:
+                logger.warning(f"Preview worker ignored unexpected keys: {unexpected_keys[:5]}")
+            results = module.predict_step(batch)
+            module.save_preview_results(results, save_dir)
+            logger.info(f"Preview for step {step} saved to {save_dir}")
+        except Exception:
+            logger.exception(f"Preview for step {step} failed")
+        finally:
+            del state_dict
+            if device.startswith("cuda"):
+                torch.cuda.empty_cache()
+
+
+class PreviewWorker:
+    """Generate training previews in a background process.
+
+    The worker builds its own copy of the training module (with ``train=False``,
+    so no SSL models are loaded), caches the preview batch and keeps the frozen
+    models resident. Each request only carries a CPU snapshot of the trainable
+    tensors, so the training step returns as soon as the snapshot is queued.
+
+    Args:
+        module_cls: LightningModule class to instantiate in the worker.
+        module_kwargs: Keyword arguments for ``module_cls``.
+        device: Device the worker runs the preview on, e.g. ``"cuda:0"``.
+    """
+
+    def __init__(self, module_cls, module_kwargs, device):
+        ctx = mp.get_context("spawn")
+        # at most one pending request, previews are skipped while the worker is busy
+        self.requests = ctx.Queue(maxsize=1)
+        self.process = ctx.Process(
+            target=_preview_loop,
+            args=(module_cls, module_kwargs, str(device), self.requests),
+            daemon=True,
+        )
+        self.process.start()
+
+    def submit(self, step, state_dict, save_dir):
+        if not self.process.is_alive():
+            logger.warning(f"Preview worker is not running, skipping preview for step {step}")
+            return False
+        try:
+            self.requests.put_nowait((step, state_dict, save_dir))
+        except queue.Full:
+            logger.warning(f"Preview worker is busy, skipping preview for step {step}")
+            return False
+        return True
+
+    def close(self, timeout=None):
+        # let the pending preview finish before shutting down
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
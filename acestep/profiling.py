@@ -0,0 +1,242 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+from loguru import logger
+
+
+class PipelineCallback:
+    """
+    Base class for pipeline instrumentation callbacks.
+
+    Stages are named with dots, e.g. ``preprocess.lyrics``, ``diffusion.decode.cond``
+    or ``latents2audio.vocoder``. ``info`` carries stage specific context such as the
+    diffusion step or the decode window index.
+    """
+
+    def on_generation_start(self, info):
+        pass
+
+    def on_generation_end(self, info):
+        pass
+
+    def on_stage_start(self, name, info):
+        pass
+
+    def on_stage_end(self, name, info, duration):
+        pass
+
+    def on_step_start(self, step, info):
+        pass
+
+    def on_step(self, step, info, duration):
+        pass
+
+
+class StageTracer:
+    """
+    Dispatch stage and step events to the registered callbacks.
+
+    Without callbacks every hook is a no-op, so the instrumentation stays in the
+    hot paths at no cost. With ``synchronize=True`` CUDA is synchronized at stage
+    boundaries so wall times include the GPU work of the stage.
+    """
+
+    def __init__(self, callbacks=None, synchronize=True):
+        self.callbacks = list(callbacks or [])
+        self.synchronize = synchronize
+
+    @property
+    def enabled(self):
+        return len(self.callbacks) > 0
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    @contextmanager
+    def callbacks_added(self, callbacks):
+        callbacks = list(callbacks or [])
+        for callback in callbacks:
+            self.add_callback(callback)
+        try:
+            yield self
+        finally:
+            for callback in callbacks:
+                self.remove_callback(callback)
+
+    def _sync(self):
+        if self.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def _dispatch(self, method, *args):
+        for callback in self.callbacks:
+            try:
+                getattr(callback, method)(*args)
+            except Exception:
+                logger.exception(f"Pipeline callback {type(callback).__name__}.{method} failed")
+
+    def generation_start(self, **info):
+        if self.enabled:
+            self._dispatch("on_generation_start", info)
+
+    def generation_end(self, **info):
+        if self.enabled:
+            self._dispatch("on_generation_end", info)
+
+    @contextmanager
+    def stage(self, name, **info):
+        if not self.callbacks:
+            yield
+            return
+        self._sync()
+        self._dispatch("on_stage_start", name, info)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self._dispatch("on_stage_end", name, info, time.perf_counter() - start)
+
+    @contextmanager
+    def step(self, step, **info):
+        if not self.callbacks:
+            yield
+            return
+        self._sync()
+        self._dispatch("on_step_start", step, info)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self._dispatch("on_step", step, info, time.perf_counter() - start)
+
+
+NULL_TRACER = StageTracer()
+
+
+class TraceRecorder(PipelineCallback):
+    """
+    Record stage and step timings and export them.
+
+    Args:
+        profile_steps: Diffusion steps to run under ``torch.profiler``.
+        profile_dir: Directory for the ``torch.profiler`` traces of those steps.
+    """
+
+    def __init__(self, profile_steps=None, profile_dir="./outputs/profiles"):
+        self.profile_steps = set(profile_steps or [])
+        self.profile_dir = profile_dir
+        self.events = []
+        self._open = {}
+        self._profiler = None
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.events = []
+            self._open = {}
+            self._origin = time.perf_counter()
+
+    def _timestamp_us(self):
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def _begin(self, key):
+        self._open[(threading.get_ident(), key)] = self._timestamp_us()
+
+    def _end(self, key, name, category, args, duration):
+        start_us = self._open.pop((threading.get_ident(), key), None)
+        if start_us is None:
+            start_us = self._timestamp_us() - duration * 1e6
+        with self._lock:
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": start_us,
+                    "dur": duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {k: v if isinstance(v, (int, float, str, bool)) else str(v) for k, v in args.items()},
+                }
+            )
+
+    def on_stage_start(self, name, info):
+        self._begin(("stage", name))
+
+    def on_stage_end(self, name, info, duration):
+        self._end(("stage", name), name, name.split(".")[0], info, duration)
+
+    def on_step_start(self, step, info):
+        self._begin(("step", step))
+        if step in self.profile_steps:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self._profiler.__enter__()
+
+    def on_step(self, step, info, duration):
+        self._end(("step", step), "diffusion.step", "diffusion", {"step": step, **info}, duration)
+        if self._profiler is not None:
+            self._profiler.__exit__(None, None, None)
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f"step_{step}_{time.strftime('%Y%m%d%H%M%S')}.json")
+            self._profiler.export_chrome_trace(path)
+            logger.info(f"Saved torch.profiler trace of step {step} to {path}")
+            self._profiler = None
+
+    def export_chrome_trace(self, path):
+        """Write the events as Chrome trace JSON, viewable in chrome://tracing or Perfetto."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._lock:
+            events = list(self.events)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return path
+
+    def summary(self):
+        """
+        Aggregate the events by name.
+
+        Returns:
+            OrderedDict: name -> dict with count, total_s, mean_ms, max_ms, in first seen order.
+        """
+        rows = OrderedDict()
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            row = rows.setdefault(event["name"], {"count": 0, "total_s": 0.0, "max_ms": 0.0})
+            row["count"] += 1
+            row["total_s"] += event["dur"] / 1e6
+            row["max_ms"] = max(row["max_ms"], event["dur"] / 1e3)
+        for row in rows.values():
+            row["mean_ms"] = row["total_s"] * 1e3 / row["count"]
+        return rows
+
+    def format_summary(self):
+        rows = self.summary()
+        lines = [f"{'stage':<36} {'count':>6} {'total s':>10} {'mean ms':>10} {'max ms':>10}"]
+        for name, row in rows.items():
+            lines.append(
+                f"{name:<36} {row['count']:>6} {row['total_s']:>10.3f} {row['mean_ms']:>10.2f} {row['max_ms']:>10.2f}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,141 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from loguru import logger
+
+
+INT8_MODES = ("dynamic", "weight_only")
+
+
+class Int8WeightOnlyLinear(nn.Module):
+    """
+    Linear layer with int8 weights and one fp32 scale per output channel.
+
+    The weights are converted to the activation dtype on the fly and the scales are
+    applied to the output, so the layer holds a quarter of the fp32 memory and runs
+    on any device.
+    """
+
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight_int8", torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("weight_scale", torch.ones(out_features, dtype=torch.float32))
+        if bias:
+            self.register_buffer("bias", torch.zeros(out_features, dtype=torch.float32))
+        else:
+            self.bias = None
+
+    @classmethod
+    def from_float(cls, linear):
+        module = cls(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+        module.weight_int8 = torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8)
+        module.weight_scale = scale
+        if linear.bias is not None:
+            module.bias = linear.bias.detach().float().clone()
+        return module.to(linear.weight.device)
+
+    def forward(self, x):
+        output = F.linear(x, self.weight_int8.to(x.dtype)) * self.weight_scale.to(x.dtype)
+        if self.bias is not None:
+            output = output + self.bias.to(x.dtype)
+        return output
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+class PointwiseConv1d(nn.Module):
+    """A 1x1 Conv1d as a linear over the channels, so it can use the quantized linear kernels."""
+
+    def __init__(self, linear):
+        super().__init__()
+        self.linear = linear
+
+    @classmethod
+    def from_conv(cls, conv):
+        linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        linear = linear.to(conv.weight.device, conv.weight.dtype)
+        with torch.no_grad():
+            linear.weight.copy_(conv.weight[:, :, 0])
+            if conv.bias is not None:
+                linear.bias.copy_(conv.bias)
+        return cls(linear)
+
+    def forward(self, x):
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def is_pointwise_conv(module):
+    return (
+        isinstance(module, nn.Conv1d)
+        and module.kernel_size == (1,)
+        and module.stride == (1,)
+        and module.padding in ((0,), 0)
+        and module.dilation == (1,)
+        and module.groups == 1
+    )
+
+
+def replace_modules(model, predicate, convert):
+    """Replace every submodule matching ``predicate`` by ``convert(module)``, returns the count."""
+    replaced = 0
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if predicate(child):
+                setattr(module, child_name, convert(child))
+                replaced += 1
+    return replaced
+
+
+def quantize_int8(model, mode="dynamic"):
+    """
+    Quantize the ``nn.Linear`` layers and the 1x1 convs of ``model`` to int8 in place.
+
+    ``dynamic`` stores per-channel int8 weights and quantizes the activations on the
+    fly with the fbgemm/qnnpack kernels, it is the fast path for CPU inference and
+    needs a float32 model on the CPU. ``weight_only`` only stores the weights in
+    int8 and computes in the activation dtype, it works on every device.
+    """
+    if mode not in INT8_MODES:
+        raise ValueError(f"Unknown int8 quantization mode {mode}, expected one of {INT8_MODES}")
+    convs = replace_modules(model, is_pointwise_conv, PointwiseConv1d.from_conv)
+    if mode == "dynamic":
+        from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+
+        quantize_dynamic(model, {nn.Linear: per_channel_dynamic_qconfig}, dtype=torch.qint8, inplace=True)
+    else:
+        replace_modules(model, lambda module: type(module) is nn.Linear, Int8WeightOnlyLinear.from_float)
+    logger.info(f"Quantized {model.__class__.__name__} to int8 ({mode}), {convs} pointwise convs as linears")
+    return model
+
+
+def save_int8_checkpoint(model, path):
+    torch.save(model.state_dict(), path)
+    logger.info(f"Int8 weights saved to: {path}")
+
+
+def load_int8_checkpoint(model, path, mode="dynamic"):
+    """Quantize the structure of a freshly built ``model`` and load exported int8 weights into it."""
+    quantize_int8(model, mode)
+    model.load_state_dict(torch.load(path, map_location="cpu"))
+    logger.info(f"Int8 weights loaded from: {path}")
+    return model
+
+
+@torch.no_grad()
+def relative_error(reference, output):
+    """Relative L2 error of ``output`` against ``reference``."""
+    reference, output = reference.float(), output.float()
+    return ((output - reference).norm() / reference.norm().clamp(min=1e-12)).item()
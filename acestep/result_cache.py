@@ -0,0 +1,178 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from loguru import logger
+from safetensors.torch import load_file, save_file
+
+
+RESULT_CACHE_INDEX_NAME = "index.json"
+RESULT_META_NAME = "meta.json"
+RESULT_LATENTS_NAME = "latents.safetensors"
+
+
+def canonical_hash(data):
+    """sha256 of the canonical JSON encoding of ``data``, independent of key order."""
+    encoded = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of generated audio on local disk.
+
+    Every entry lives in ``<cache_dir>/<key[:2]>/<key>`` and holds the audio files,
+    ``meta.json`` with the input params of the generation and optionally the final
+    latents. The least recently used entries are evicted once the cache grows
+    beyond ``max_size_gb``.
+
+    Args:
+        cache_dir: Cache directory.
+        max_size_gb: Size limit of all entries together.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=10.0):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_gb * 1024**3)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, RESULT_CACHE_INDEX_NAME)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # drop entries whose directory disappeared
+        return {key: entry for key, entry in index.items() if os.path.isdir(self.entry_dir(key))}
+
+    def _save_index(self):
+        index_path = self._index_path()
+        with open(index_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """
+        Look up a cached result.
+
+        Returns:
+            dict or None: ``audio_paths`` of the cached files, ``input_params_json``
+            of the original generation and ``latents_path`` if latents were stored.
+        """
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry_dir = self.entry_dir(key)
+            try:
+                with open(os.path.join(entry_dir, RESULT_META_NAME), encoding="utf-8") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                logger.warning(f"Dropping broken result cache entry {key}")
+                del self.index[key]
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                self._save_index()
+                self.misses += 1
+                return None
+            entry["last_access"] = time.time()
+            self._save_index()
+            self.hits += 1
+        latents_path = os.path.join(entry_dir, RESULT_LATENTS_NAME)
+        return {
+            "audio_paths": [os.path.join(entry_dir, name) for name in meta["audio_files"]],
+            "input_params_json": meta["input_params_json"],
+            "latents_path": latents_path if os.path.exists(latents_path) else None,
+        }
+
+    def load_latents(self, result):
+        if result["latents_path"] is None:
+            return None
+        return load_file(result["latents_path"])["latents"]
+
+    def put(self, key, audio_paths, input_params_json, latents=None, audio_format="wav"):
+        """
+        Store the result of a generation.
+
+        Args:
+            key: Cache key from canonical_hash.
+            audio_paths: Generated audio files, copied into the cache, or the
+                encoded bytes of in memory generations.
+            input_params_json: Input params saved next to the audio.
+            latents: Optional final latents to store as well.
+            audio_format: File extension of audio passed as bytes.
+        """
+        entry_dir = self.entry_dir(key)
+        tmp_dir = entry_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        audio_files = []
+        for i, audio_path in enumerate(audio_paths):
+            if isinstance(audio_path, bytes):
+                name = f"{i}.{audio_format}"
+                with open(os.path.join(tmp_dir, name), "wb") as f:
+                    f.write(audio_path)
+            else:
+                name = f"{i}{os.path.splitext(audio_path)[1]}"
+                shutil.copyfile(audio_path, os.path.join(tmp_dir, name))
+            audio_files.append(name)
+        if latents is not None:
+            save_file({"latents": latents.detach().cpu().contiguous()}, os.path.join(tmp_dir, RESULT_LATENTS_NAME))
+        with open(os.path.join(tmp_dir, RESULT_META_NAME), "w", encoding="utf-8") as f:
+            json.dump({"audio_files": audio_files, "input_params_json": input_params_json}, f, ensure_ascii=False, default=str)
+        size = sum(os.path.getsize(os.path.join(tmp_dir, name)) for name in os.listdir(tmp_dir))
+
+        with self._lock:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+            self.index[key] = {"size": size, "last_access": time.time()}
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        total = sum(entry["size"] for entry in self.index.values())
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.max_size_bytes:
+                break
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            del self.index[key]
+            total -= entry["size"]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.index),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": sum(entry["size"] for entry in self.index.values()),
+        }
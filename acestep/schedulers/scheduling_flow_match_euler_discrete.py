@@ -253,6 +253,7 @@ class FlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
         generator: Optional[torch.Generator] = None,
         return_dict: bool = True,
         omega: Union[float, np.array] = 0.0,
+        latent_mask: Optional[torch.FloatTensor] = None,
     ) -> Union[FlowMatchEulerDiscreteSchedulerOutput, Tuple]:
         """
         Predict the sample from the previous timestep by reversing the SDE. This function propagates the diffusion
@@ -272,6 +273,9 @@ class FlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
                 Scaling factor for noise added to the sample.
             generator (`torch.Generator`, *optional*):
                 A random number generator.
+            latent_mask (`torch.FloatTensor`, *optional*):
+                Mask broadcastable to `sample` with 1 for valid and 0 for right padded frames of a batch with
+                mixed durations. Padded frames are excluded from the mean shift and stay at zero.
             return_dict (`bool`):
                 Whether or not to return a [`~schedulers.scheduling_euler_discrete.EulerDiscreteSchedulerOutput`] or
                 tuple.
@@ -327,11 +331,17 @@ class FlowMatchEulerDiscreteScheduler(SchedulerMixin, ConfigMixin):
         ## --
         ## mean shift 1
         dx = (sigma_next - sigma) * model_output
-        m = dx.mean()
+        if latent_mask is None:
+            m = dx.mean()
+        else:
+            # mean over the valid frames only
+            m = (dx * latent_mask).sum() / latent_mask.expand_as(dx).sum()
         # print(dx.shape) # torch.Size([1, 16, 128, 128])
         # print(f'm: {m}') # m: -0.0014209747314453125
         # raise NotImplementedError
         dx_ = (dx - m) * omega + m
+        if latent_mask is not None:
+            dx_ = dx_ * latent_mask
         prev_sample = sample + dx_
 
         # ## --
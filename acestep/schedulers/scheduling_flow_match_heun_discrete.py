@@ -218,6 +218,7 @@ class FlowMatchHeunDiscreteScheduler(SchedulerMixin, ConfigMixin):
         generator: Optional[torch.Generator] = None,
         return_dict: bool = True,
         omega: Union[float, np.array] = 0.0,
+        latent_mask: Optional[torch.FloatTensor] = None,
     ) -> Union[FlowMatchHeunDiscreteSchedulerOutput, Tuple]:
         """
         Predict the sample from the previous timestep by reversing the SDE. This function propagates the diffusion
@@ -237,6 +238,9 @@ class FlowMatchHeunDiscreteScheduler(SchedulerMixin, ConfigMixin):
                 Scaling factor for noise added to the sample.
             generator (`torch.Generator`, *optional*):
                 A random number generator.
+            latent_mask (`torch.FloatTensor`, *optional*):
+                Mask broadcastable to `sample` with 1 for valid and 0 for right padded frames of a batch with
+                mixed durations. Padded frames are excluded from the mean shift and stay at zero.
             return_dict (`bool`):
                 Whether or not to return a [`~schedulers.scheduling_Heun_discrete.HeunDiscreteSchedulerOutput`] or
                 tuple.
@@ -345,8 +349,14 @@ class FlowMatchHeunDiscreteScheduler(SchedulerMixin, ConfigMixin):
         # prev_sample = sample + derivative * dt
 
         dx = derivative * dt
-        m = dx.mean()
+        if latent_mask is None:
+            m = dx.mean()
+        else:
+            # mean over the valid frames only
+            m = (dx * latent_mask).sum() / latent_mask.expand_as(dx).sum()
         dx_ = (dx - m) * omega + m
+        if latent_mask is not None:
+            dx_ = dx_ * latent_mask
         prev_sample = sample + dx_
 
         # Cast sample back to model compatible dtype
@@ -253,6 +253,7 @@ class FlowMatchPingPongScheduler(SchedulerMixin, ConfigMixin):
         generator: Optional[torch.Generator] = None,
         return_dict: bool = True,
         omega: Union[float, np.array] = 0.0,
+        latent_mask: Optional[torch.FloatTensor] = None,
     ) -> Union[FlowMatchPingPongSchedulerOutput, Tuple]:
         """
         Predict the sample from the previous timestep by reversing the SDE. This function propagates the diffusion
@@ -272,6 +273,9 @@ class FlowMatchPingPongScheduler(SchedulerMixin, ConfigMixin):
                 Scaling factor for noise added to the sample.
             generator (`torch.Generator`, *optional*):
                 A random number generator.
+            latent_mask (`torch.FloatTensor`, *optional*):
+                Mask broadcastable to `sample` with 1 for valid and 0 for right padded frames of a batch with
+                mixed durations. Padded frames stay at zero instead of receiving fresh noise.
             return_dict (`bool`):
                 Whether or not to return a [`~schedulers.scheduling_euler_discrete.EulerDiscreteSchedulerOutput`] or
                 tuple.
@@ -327,6 +331,8 @@ class FlowMatchPingPongScheduler(SchedulerMixin, ConfigMixin):
         denoised = sample - sigma * model_output
         noise = torch.empty_like(sample).normal_(generator=generator)
         prev_sample = (1 - sigma_next) * denoised + sigma_next * noise
+        if latent_mask is not None:
+            prev_sample = prev_sample * latent_mask
 
         # Cast sample back to model compatible dtype
         prev_sample = prev_sample.to(model_output.dtype)
@@ -0,0 +1,73 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import os
+
+import torch
+import torch.nn as nn
+from loguru import logger
+
+
+def module_tensors(model):
+    """Every parameter and buffer of ``model`` by name, tied and non persistent ones included."""
+    tensors = {}
+    for name, param in model.named_parameters(remove_duplicate=False):
+        tensors[name] = param.detach()
+    for name, buffer in model.named_buffers(remove_duplicate=False):
+        tensors[name] = buffer
+    return tensors
+
+
+def save_shared_weights(model, path):
+    """Save the tensors of ``model`` for load_shared_weights, tied tensors keep one storage."""
+    tmp_path = f"{path}.tmp"
+    torch.save({name: tensor.cpu() for name, tensor in module_tensors(model).items()}, tmp_path)
+    os.replace(tmp_path, path)
+    logger.info(f"Shared weights saved to: {path}")
+
+
+def load_shared_weights(model, path):
+    """
+    Point the parameters and buffers of ``model``, usually built on the meta device,
+    at the tensors of ``path`` mapped into memory. The pages are read only for
+    inference, so every process mapping the file shares them through the page cache
+    instead of holding a private copy.
+
+    Every tensor must have the shape of the one it replaces, weights exported from
+    a differently configured model raise a ValueError instead of being swapped in.
+
+    Tensors that are neither parameters nor buffers only cache values derived from
+    the configuration, the ones left on the meta device are reset to None so their
+    modules rebuild them on first use.
+    """
+    tensors = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    expected = module_tensors(model)
+    unexpected = [name for name in tensors if name not in expected]
+    if unexpected:
+        raise ValueError(f"{path} has {len(unexpected)} tensors {model.__class__.__name__} does not have, e.g. {unexpected[:3]}")
+    for name, tensor in tensors.items():
+        if tensor.shape != expected[name].shape:
+            raise ValueError(
+                f"{path} has {name} of shape {tuple(tensor.shape)}, "
+                f"{model.__class__.__name__} expects {tuple(expected[name].shape)}"
+            )
+        module_name, _, tensor_name = name.rpartition(".")
+        module = model.get_submodule(module_name) if module_name else model
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[tensor_name] = tensor
+    missing = [name for name, tensor in module_tensors(model).items() if tensor.is_meta]
+    if missing:
+        raise ValueError(f"{path} has no tensors for {len(missing)} weights of {model.__class__.__name__}, e.g. {missing[:3]}")
+    for module in model.modules():
+        for attr, value in list(vars(module).items()):
+            if isinstance(value, torch.Tensor) and value.is_meta:
+                setattr(module, attr, None)
+    logger.info(f"Shared weights mapped from: {path}")
+    return model
@@ -0,0 +1,152 @@
+"""
+ACE-Step: A Step Towards Music Generation Foundation Model
+
+https://github.com/ace-step/ACE-Step
+
+Apache 2.0 License
+"""
+
+import inspect
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import nullcontext
+
+import torch
+from loguru import logger
+
+from acestep.cancellation import GenerationCancelled
+
+
+_STOP = object()
+
+
+class StagedExecutor:
+    """
+    Run many generations through one pipeline as three overlapping stages.
+
+    Stage 1 loads the checkpoint and encodes prompts, lyrics and source audio,
+    stage 2 runs the diffusion and stage 3 decodes with DCAE/vocoder and writes the
+    files. Every stage has its own worker thread and, on CUDA, its own stream, and
+    the stages are connected by bounded queues. While request N is in diffusion,
+    request N + 1 is encoded and request N - 1 is decoded, so the throughput of a
+    long job approaches the cost of the slowest stage instead of the sum.
+
+    LoRA weights are only switched by the diffusion stage, so requests with
+    different LoRAs can be mixed. CPU offloading moves models between devices
+    around every stage and cannot be combined with the executor.
+
+    Args:
+        pipeline: ACEStepPipeline to run, it must not be used elsewhere meanwhile.
+        queue_size: Capacity of the queues between the stages.
+        use_cuda_streams: Run every stage on its own CUDA stream when CUDA is available.
+    """
+
+    def __init__(self, pipeline, queue_size=2, use_cuda_streams=True):
+        if pipeline.cpu_offload:
+            raise ValueError("StagedExecutor cannot be used with cpu_offload")
+        self.pipeline = pipeline
+        self.use_cuda_streams = use_cuda_streams and torch.cuda.is_available()
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(3)]
+        stages = [
+            ("encode", self._encode),
+            ("diffusion", self._diffuse),
+            ("decode", self._decode),
+        ]
+        self._workers = []
+        for index, (name, stage_fn) in enumerate(stages):
+            worker = threading.Thread(
+                target=self._work,
+                args=(index, stage_fn),
+                name=f"acestep-stage-{name}",
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def submit(self, **params):
+        """
+        Queue a generation with the keyword arguments of ``ACEStepPipeline.__call__``.
+        Blocks while the first queue is full and returns a Future with the result.
+        """
+        future = Future()
+        self._queues[0].put((future, self._call_params(params)))
+        return future
+
+    def map(self, params_list):
+        """Run the generations of ``params_list`` and yield their results in order."""
+        futures = [self.submit(**params) for params in params_list]
+        for future in futures:
+            yield future.result()
+
+    def shutdown(self, wait=True):
+        """Finish the queued generations and stop the workers."""
+        self._queues[0].put(_STOP)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _call_params(self, params):
+        # fill in the defaults of __call__, the stages expect every argument
+        bound = inspect.signature(self.pipeline.__call__).bind(**params)
+        bound.apply_defaults()
+        return dict(bound.arguments)
+
+    def _work(self, index, stage_fn):
+        stream = torch.cuda.Stream() if self.use_cuda_streams else None
+        out_queue = self._queues[index + 1] if index + 1 < len(self._queues) else None
+        while True:
+            item = self._queues[index].get()
+            if item is _STOP:
+                if out_queue is not None:
+                    out_queue.put(_STOP)
+                return
+            future, state = item
+            if index == 0 and not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                    result = stage_fn(state)
+                    if stream is not None:
+                        # the next stage reads these tensors from another stream, and once they
+                        # are handed over this stream must not have pending work on them
+                        stream.synchronize()
+            except Exception as e:
+                logger.exception(f"Generation failed in stage {index + 1}")
+                future.set_exception(e)
+                continue
+            if out_queue is None:
+                future.set_result(result)
+            else:
+                out_queue.put((future, result))
+
+    def _encode(self, params):
+        return self.pipeline.prepare_generation(params)
+
+    def _diffuse(self, state):
+        if state["cached_result"] is None:
+            try:
+                self.pipeline.run_diffusion(state)
+            except GenerationCancelled as e:
+                state["cancelled"] = (
+                    e.reason,
+                    e.stage,
+                    e.step,
+                    e.latents if state["return_partial_on_cancel"] else None,
+                )
+        return state
+
+    def _decode(self, state):
+        cancelled = state.pop("cancelled", None)
+        if cancelled is None:
+            try:
+                return self.pipeline.finalize_generation(state)
+            except GenerationCancelled as e:
+                cancelled = (e.reason, e.stage, e.step, e.latents if state["return_partial_on_cancel"] else None)
+        return self.pipeline.cancel_generation(state, *cancelled)
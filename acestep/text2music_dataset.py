@@ -1,8 +1,13 @@
 import os
+import json
+import shutil
+import hashlib
+import multiprocessing
+from functools import partial
 import torch
 import numpy as np
 import random
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from datasets import load_from_disk
 from loguru import logger
 import time
@@ -12,11 +17,19 @@ from pathlib import Path
 import re
 from acestep.language_segmentation import LangSegment
 from acestep.models.lyrics_utils.lyric_tokenizer import VoiceBpeTokenizer
+from acestep.models.lyrics_utils.vocab_utils import DEFAULT_VOCAB_NAME, get_vocab_file_path
+from acestep.lru_cache import LRUCache
+from acestep.audio_shard_cache import AudioShardCache, AudioShardWriter, TARGET_SAMPLE_RATE, decode_audio
 import warnings
 
 warnings.simplefilter("ignore", category=FutureWarning)
 
 DEFAULT_TRAIN_PATH = "lora_dataset/"
+LYRIC_TOKENS_FINGERPRINT_NAME = "lyric_tokens.json"
+BAD_SAMPLES_NAME = "bad_samples.jsonl"
+# reasons validate_dataset writes, a new validation replaces only these entries
+AUDIO_BAD_SAMPLE_REASONS = ("undecodable", "silent", "too_long")
+VALIDATION_REPORT_NAME = "validation_report.json"
 
 
 def is_silent_audio(audio_tensor, silence_threshold=0.95):
@@ -64,6 +77,240 @@ SUPPORT_LANGUAGES = {
 structure_pattern = re.compile(r"\[.*?\]")
 
 
+def lyric_tokens_fingerprint(vocab_name=DEFAULT_VOCAB_NAME):
+    """
+    Fingerprint of the lyric tokenizer used to pre-tokenize a dataset
+
+    Args:
+        vocab_name: Name of the vocab json used by VoiceBpeTokenizer
+
+    Returns:
+        dict: Vocab name and sha256 of the vocab file
+    """
+    with open(get_vocab_file_path(vocab_name), "rb") as f:
+        vocab_sha256 = hashlib.sha256(f.read()).hexdigest()
+    return {"vocab_name": vocab_name, "vocab_sha256": vocab_sha256}
+
+
+# Per-process tokenizers and lyric cache used by pretokenize_lyrics workers
+_row_tokenizers = {}
+_row_token_cache = LRUCache(maxsize=4096)
+
+
+def _tokenize_lyrics_row(item, vocab_name, vocab_sha256):
+    if vocab_name not in _row_tokenizers:
+        _row_tokenizers[vocab_name] = Text2MusicDataset.lyric_tokenizer_only(vocab_name)
+    # converted datasets repeat the same song many times, tokenize each lyric once per process
+    cache_key = (vocab_sha256, item["norm_lyrics"])
+    cached = _row_token_cache.get(cache_key)
+    if cached is None:
+        try:
+            tokenized = _row_tokenizers[vocab_name].tokenize_lyrics_map(dict(item))
+            cached = (tokenized["norm_lyrics"], tokenized["lyric_token_idx"], "")
+        except ValueError as e:
+            # e.g. an unsupported language, the row goes to the bad-sample index instead of failing the map
+            cached = (item["norm_lyrics"], [], str(e))
+        _row_token_cache.put(cache_key, cached)
+    item["norm_lyrics"], item["lyric_token_idx"], item["lyric_token_error"] = cached
+    return item
+
+
+def pretokenize_lyrics(dataset_path, output_path=None, vocab_name=DEFAULT_VOCAB_NAME, num_proc=None):
+    """
+    Tokenize the lyrics of every row once and store them in the lyric_token_idx column
+
+    Rows whose lyrics cannot be tokenized, e.g. in an unsupported language, get an
+    empty lyric_token_idx and are added to the bad-sample index.
+
+    Args:
+        dataset_path: Path to a dataset saved with save_to_disk
+        output_path: Where to save the tokenized dataset, defaults to dataset_path
+        vocab_name: Name of the vocab json used by VoiceBpeTokenizer
+        num_proc: Number of tokenizer processes
+
+    Returns:
+        str: Path of the tokenized dataset
+    """
+    output_path = output_path or dataset_path
+    fingerprint = lyric_tokens_fingerprint(vocab_name)
+    ds = load_from_disk(dataset_path)
+    if "lyric_token_idx" in ds.column_names:
+        ds = ds.remove_columns("lyric_token_idx")
+    ds = ds.map(
+        _tokenize_lyrics_row,
+        fn_kwargs=fingerprint,
+        num_proc=num_proc,
+        desc=f"Tokenizing lyrics with {vocab_name}",
+    )
+
+    # rows whose lyrics cannot be tokenized keep an empty token list and are skipped in training
+    bad_samples = [
+        {"idx": idx, "filename": filename, "reason": f"lyrics: {error}"}
+        for idx, (filename, error) in enumerate(zip(ds["filename"], ds["lyric_token_error"]))
+        if error
+    ]
+    ds = ds.remove_columns("lyric_token_error")
+
+    # save_to_disk cannot overwrite the dataset it is reading from
+    tmp_path = output_path.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    ds.save_to_disk(tmp_path)
+    with open(os.path.join(tmp_path, LYRIC_TOKENS_FINGERPRINT_NAME), "w", encoding="utf-8") as f:
+        json.dump(fingerprint, f, indent=4)
+    for name in (BAD_SAMPLES_NAME, VALIDATION_REPORT_NAME):
+        if os.path.exists(os.path.join(dataset_path, name)):
+            shutil.copy(os.path.join(dataset_path, name), os.path.join(tmp_path, name))
+    if bad_samples:
+        logger.warning(f"{len(bad_samples)} rows with lyrics that cannot be tokenized, added to {BAD_SAMPLES_NAME}")
+        with open(os.path.join(tmp_path, BAD_SAMPLES_NAME), "a", encoding="utf-8") as f:
+            for bad_sample in bad_samples:
+                f.write(json.dumps(bad_sample, ensure_ascii=False) + "\n")
+    if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+    os.replace(tmp_path, output_path)
+    logger.info(f"Saved {len(ds)} pre-tokenized rows to {output_path}")
+    return output_path
+
+
+# Per-process resamplers used by build_audio_cache workers
+_cache_resamplers = {}
+
+
+def _decode_for_cache(filename, max_duration):
+    torch.set_num_threads(1)
+    metadata = {}
+    try:
+        audio, orig_sr = decode_audio(filename, _cache_resamplers)
+    except Exception as e:
+        metadata["error"] = str(e)
+        return filename, None, metadata
+
+    metadata["orig_sr"] = orig_sr
+    metadata["duration"] = audio.shape[-1] / TARGET_SAMPLE_RATE
+    # same padding as get_audio so the silence check matches the training loader
+    padded = audio
+    if padded.shape[-1] < TARGET_SAMPLE_RATE * 3:
+        padded = torch.nn.functional.pad(padded, (0, TARGET_SAMPLE_RATE * 3 - padded.shape[-1]), "constant", 0)
+    metadata["silent"] = is_silent_audio(padded)
+    if metadata["silent"]:
+        return filename, None, metadata
+
+    # process() never uses more than max_duration seconds
+    if max_duration is not None:
+        audio = audio[:, : int(max_duration * TARGET_SAMPLE_RATE)]
+    return filename, audio, metadata
+
+
+def build_audio_cache(dataset_path, cache_dir, num_proc=None, max_duration=240.0, dtype="int16", shard_size_mb=1024):
+    """
+    Decode every audio file of a dataset once and store it in memory-mappable shards
+
+    Args:
+        dataset_path: Path to a dataset saved with save_to_disk
+        cache_dir: Output directory for the shards and index.json
+        num_proc: Number of decoding processes
+        max_duration: Maximum audio duration in seconds kept in the cache
+        dtype: Storage dtype, "int16" or "float16"
+        shard_size_mb: Approximate size of a shard in MB
+
+    Returns:
+        dict: Number of cached, silent and undecodable files
+    """
+    ds = load_from_disk(dataset_path)
+    # converted datasets repeat every song, decode each file once
+    filenames = list(dict.fromkeys(ds["filename"]))
+    writer = AudioShardWriter(cache_dir, shard_size_mb=shard_size_mb, dtype=dtype)
+    stats = {"cached": 0, "silent": 0, "error": 0}
+    with multiprocessing.Pool(num_proc) as pool:
+        results = pool.imap(partial(_decode_for_cache, max_duration=max_duration), filenames)
+        for filename, audio, metadata in results:
+            writer.add(filename, audio, metadata)
+            if "error" in metadata:
+                stats["error"] += 1
+            elif metadata["silent"]:
+                stats["silent"] += 1
+            else:
+                stats["cached"] += 1
+    writer.close()
+    logger.info(f"Audio cache for {dataset_path} written to {cache_dir}: {stats}")
+    return stats
+
+
+def _probe_audio(filename, max_duration):
+    # only the metadata is sent back to the parent process
+    _, _, metadata = _decode_for_cache(filename, max_duration=None)
+    metadata["too_long"] = metadata.get("duration", 0.0) > max_duration
+    return filename, metadata
+
+
+def validate_dataset(dataset_path, num_proc=None, max_duration=240.0, exclude_too_long=False):
+    """
+    Check every audio file of a dataset in parallel and write the bad-sample index
+
+    Silent and undecodable files are written to bad_samples.jsonl, which
+    Text2MusicDataset and BadSampleExcludingSampler skip. Too long files are
+    only reported because process() truncates them, unless exclude_too_long is set.
+    Entries of earlier validations are replaced, the ones of pretokenize_lyrics and
+    failed loads are kept.
+
+    Args:
+        dataset_path: Path to a dataset saved with save_to_disk
+        num_proc: Number of decoding processes
+        max_duration: Maximum audio duration in seconds
+        exclude_too_long: Whether too long files are added to the bad-sample index
+
+    Returns:
+        dict: Validation report
+    """
+    ds = load_from_disk(dataset_path)
+    filenames = list(dict.fromkeys(ds["filename"]))
+    report = {
+        "dataset_path": dataset_path,
+        "num_rows": len(ds),
+        "num_files": len(filenames),
+        "max_duration": max_duration,
+        "silent": [],
+        "too_long": [],
+        "undecodable": [],
+    }
+    bad_samples = []
+    with multiprocessing.Pool(num_proc) as pool:
+        for filename, metadata in pool.imap(partial(_probe_audio, max_duration=max_duration), filenames):
+            reason = None
+            if "error" in metadata:
+                report["undecodable"].append({"filename": filename, "error": metadata["error"]})
+                reason = "undecodable"
+            elif metadata["silent"]:
+                report["silent"].append(filename)
+                reason = "silent"
+            elif metadata["too_long"]:
+                report["too_long"].append({"filename": filename, "duration": metadata["duration"]})
+                if exclude_too_long:
+                    reason = "too_long"
+            if reason is not None:
+                bad_samples.append({"filename": filename, "reason": reason})
+
+    with open(os.path.join(dataset_path, VALIDATION_REPORT_NAME), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+    bad_samples_path = os.path.join(dataset_path, BAD_SAMPLES_NAME)
+    kept_lines = []
+    if os.path.exists(bad_samples_path):
+        with open(bad_samples_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip() and json.loads(line).get("reason") not in AUDIO_BAD_SAMPLE_REASONS:
+                    kept_lines.append(line if line.endswith("\n") else line + "\n")
+    with open(bad_samples_path + ".tmp", "w", encoding="utf-8") as f:
+        f.writelines(kept_lines)
+        for bad_sample in bad_samples:
+            f.write(json.dumps(bad_sample, ensure_ascii=False) + "\n")
+    os.replace(bad_samples_path + ".tmp", bad_samples_path)
+    logger.info(
+        f"Validated {len(filenames)} files in {dataset_path}: {len(report['silent'])} silent, "
+        f"{len(report['too_long'])} too long, {len(report['undecodable'])} undecodable"
+    )
+    return report
+
+
 class Text2MusicDataset(Dataset):
     """
     Dataset for text-to-music generation that processes lyrics and audio files
@@ -78,6 +325,9 @@ class Text2MusicDataset(Dataset):
         sample_size=None,
         shuffle=True,
         minibatch_size=1,
+        vocab_name=DEFAULT_VOCAB_NAME,
+        audio_cache_dir=None,
+        max_retries=10,
     ):
         """
         Initialize the Text2Music dataset
@@ -89,12 +339,55 @@ class Text2MusicDataset(Dataset):
             sample_size: Optional limit on number of samples to use
             shuffle: Whether to shuffle the dataset
             minibatch_size: Size of mini-batches
+            vocab_name: Name of the vocab json used to tokenize lyrics
+            audio_cache_dir: Optional directory written by build_audio_cache, with one subdirectory per split
+            max_retries: Number of other samples tried when loading a sample fails
         """
         self.dataset_path = os.path.join(dataset_path, split) if split else dataset_path
         self.max_duration = max_duration
         self.minibatch_size = minibatch_size
         self.train = train
+        self.vocab_name = vocab_name
+        self.max_retries = max_retries
+        self.bad_samples_path = os.path.join(self.dataset_path, BAD_SAMPLES_NAME)
+
+        self.setup_lyric_tokenizer(vocab_name)
+
+        # Decoded audio cache and resamplers for files missing from it
+        self.resamplers = {}
+        self.audio_cache = None
+        if audio_cache_dir is not None:
+            audio_cache_dir = os.path.join(audio_cache_dir, split) if split else audio_cache_dir
+            self.audio_cache = AudioShardCache(audio_cache_dir)
+            logger.info(f"Using audio cache {audio_cache_dir} with {len(self.audio_cache)} files")
 
+        # Load dataset
+        self.setup_full(train, shuffle, sample_size)
+        logger.info(f"Dataset size: {len(self)} total {self.total_samples} samples")
+
+    @classmethod
+    def lyric_tokenizer_only(cls, vocab_name=DEFAULT_VOCAB_NAME):
+        """
+        Create an instance that can tokenize lyrics without loading a dataset
+
+        Args:
+            vocab_name: Name of the vocab json used to tokenize lyrics
+
+        Returns:
+            Text2MusicDataset: Instance with only the lyric tokenizer set up
+        """
+        dataset = cls.__new__(cls)
+        dataset.vocab_name = vocab_name
+        dataset.setup_lyric_tokenizer(vocab_name)
+        return dataset
+
+    def setup_lyric_tokenizer(self, vocab_name=DEFAULT_VOCAB_NAME):
+        """
+        Initialize language segmentation and the lyric tokenizer
+
+        Args:
+            vocab_name: Name of the vocab json used to tokenize lyrics
+        """
         # Initialize language segmentation
         self.lang_segment = LangSegment()
         self.lang_segment.setfilters(
@@ -200,11 +493,7 @@ class Text2MusicDataset(Dataset):
         )
 
         # Initialize lyric tokenizer
-        self.lyric_tokenizer = VoiceBpeTokenizer()
-
-        # Load dataset
-        self.setup_full(train, shuffle, sample_size)
-        logger.info(f"Dataset size: {len(self)} total {self.total_samples} samples")
+        self.lyric_tokenizer = VoiceBpeTokenizer(vocab_name)
 
     def setup_full(self, train=True, shuffle=True, sample_size=None):
         """
@@ -222,6 +511,76 @@ class Text2MusicDataset(Dataset):
 
         self.pretrain_ds = pretrain_ds
         self.total_samples = len(self.pretrain_ds)
+        self.pretokenized = self.check_pretokenized()
+        self.filenames = self.pretrain_ds["filename"]
+        self.load_bad_samples()
+
+    def load_bad_samples(self):
+        """
+        Load the bad-sample index written by validate_dataset and by failed loads
+        """
+        self.bad_indices = set()
+        self.bad_filenames = set()
+        if not os.path.exists(self.bad_samples_path):
+            return
+        with open(self.bad_samples_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                bad_sample = json.loads(line)
+                if bad_sample.get("idx") is not None:
+                    self.bad_indices.add(bad_sample["idx"])
+                elif bad_sample.get("filename") is not None:
+                    self.bad_filenames.add(bad_sample["filename"])
+
+    def is_bad_sample(self, idx):
+        return idx in self.bad_indices or self.filenames[idx] in self.bad_filenames
+
+    def good_indices(self):
+        """
+        Return the indices that are not in the bad-sample index
+
+        Returns:
+            list: Dataset indices
+        """
+        return [idx for idx in range(self.total_samples) if not self.is_bad_sample(idx)]
+
+    def mark_bad_sample(self, idx, reason):
+        """
+        Add a sample that failed to load to the bad-sample index
+
+        Args:
+            idx: Dataset index
+            reason: Error message
+        """
+        self.bad_indices.add(idx)
+        bad_sample = {"idx": idx, "filename": self.filenames[idx], "reason": reason}
+        try:
+            # single small appends, safe to do from several DataLoader workers
+            with open(self.bad_samples_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(bad_sample, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.warning(f"Failed to update {self.bad_samples_path}: {e}")
+
+    def check_pretokenized(self):
+        """
+        Check whether lyric_token_idx was stored by pretokenize_lyrics with the current vocab
+
+        Returns:
+            bool: True if lyrics can be used without tokenizing them again
+        """
+        if "lyric_token_idx" not in self.pretrain_ds.column_names:
+            return False
+        fingerprint_path = os.path.join(self.dataset_path, LYRIC_TOKENS_FINGERPRINT_NAME)
+        if os.path.exists(fingerprint_path):
+            with open(fingerprint_path, encoding="utf-8") as f:
+                fingerprint = json.load(f)
+            if fingerprint == lyric_tokens_fingerprint(self.vocab_name):
+                return True
+        logger.warning(
+            f"Pre-tokenized lyrics in {self.dataset_path} do not match vocab {self.vocab_name}, tokenizing on the fly"
+        )
+        return False
 
     def __len__(self):
         """Return the number of batches in the dataset"""
@@ -399,39 +758,35 @@ class Text2MusicDataset(Dataset):
             torch.Tensor or None: Processed audio tensor
         """
         filename = item["filename"]
-        sr = 48000
-        try:
-            audio, sr = torchaudio.load(filename)
-        except Exception as e:
-            logger.error(f"Failed to load audio {item}: {e}")
-            return None
+        from_cache = self.audio_cache is not None and filename in self.audio_cache
+        if from_cache:
+            metadata = self.audio_cache.metadata(filename)
+            if "error" in metadata:
+                logger.error(f"Failed to load audio {item}: {metadata['error']}")
+                return None
+            if metadata["silent"]:
+                logger.error(f"Silent audio {item}")
+                return None
+            audio = self.audio_cache.load(filename)
+        else:
+            try:
+                audio, _ = decode_audio(filename, self.resamplers)
+            except Exception as e:
+                logger.error(f"Failed to load audio {item}: {e}")
+                return None
 
         if audio is None:
             logger.error(f"Failed to load audio {item}")
             return None
 
-        # Convert mono to stereo if needed
-        if audio.shape[0] == 1:
-            audio = torch.cat([audio, audio], dim=0)
-
-        # Take first two channels if more than stereo
-        audio = audio[:2]
-
-        # Resample if needed
-        if sr != 48000:
-            audio = torchaudio.transforms.Resample(sr, 48000)(audio)
-
-        # Clip values to [-1.0, 1.0]
-        audio = torch.clamp(audio, -1.0, 1.0)
-
         # Pad to minimum 3 seconds if needed
         if audio.shape[-1] < 48000 * 3:
             audio = torch.nn.functional.pad(
                 audio, (0, 48000 * 3 - audio.shape[-1]), "constant", 0
             )
 
-        # Check if audio is silent
-        if is_silent_audio(audio):
+        # Check if audio is silent, cached audio was already checked when the cache was built
+        if not from_cache and is_silent_audio(audio):
             logger.error(f"Silent audio {item}")
             return None
 
@@ -486,6 +841,9 @@ class Text2MusicDataset(Dataset):
 
         # Process lyrics
         lyric_token_idx = item["lyric_token_idx"]
+        if len(lyric_token_idx) == 0:
+            # left empty by pretokenize_lyrics when the lyrics could not be tokenized
+            raise ValueError(f"Lyrics of {key} could not be tokenized")
         lyric_token_idx = torch.tensor(lyric_token_idx).long()
         lyric_token_idx = lyric_token_idx[:4096]  # Limit lyric context length
         lyric_mask = torch.ones(len(lyric_token_idx))
@@ -547,7 +905,8 @@ class Text2MusicDataset(Dataset):
 
         item = self.pretrain_ds[idx]
         item["idx"] = idx
-        item = self.tokenize_lyrics_map(item)
+        if not self.pretokenized:
+            item = self.tokenize_lyrics_map(item)
         features = self.process(item)
 
         if features:
@@ -663,17 +1022,59 @@ class Text2MusicDataset(Dataset):
         Returns:
             dict: Example features
         """
-        try:
-            example = self.get_full_features(idx)
-            if len(example["keys"]) == 0:
-                raise Exception(f"Empty example {idx=}")
-            return example
-        except Exception as e:
-            # Log error and try a different random index
-            logger.error(f"Error in getting item {idx}: {e}")
-            traceback.print_exc()
-            new_idx = random.choice(range(len(self)))
-            return self.__getitem__(new_idx)
+        for _ in range(self.max_retries + 1):
+            try:
+                example = self.get_full_features(idx)
+                if len(example["keys"]) == 0:
+                    raise Exception(f"Empty example {idx=}")
+                return example
+            except Exception as e:
+                # Log error, remember the sample and try a different random index
+                logger.error(f"Error in getting item {idx}: {e}")
+                traceback.print_exc()
+                self.mark_bad_sample(idx, str(e))
+                idx = random.choice(range(len(self)))
+                for _ in range(self.max_retries):
+                    if not self.is_bad_sample(idx):
+                        break
+                    idx = random.choice(range(len(self)))
+        raise RuntimeError(f"Failed to load a valid example after {self.max_retries + 1} attempts")
+
+
+class BadSampleExcludingSampler(Sampler):
+    """
+    Sampler that skips the samples in the bad-sample index of a Text2MusicDataset
+
+    The index is reloaded at the start of every epoch, so samples that failed
+    in the DataLoader workers during the previous epoch are skipped as well.
+    """
+
+    def __init__(self, dataset, shuffle=True, seed=0):
+        """
+        Args:
+            dataset: Text2MusicDataset
+            shuffle: Whether to shuffle the indices every epoch
+            seed: Seed of the shuffle
+        """
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.indices = self.dataset.good_indices()
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        self.dataset.load_bad_samples()
+        self.indices = self.dataset.good_indices()
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            self.epoch += 1
+            order = torch.randperm(len(self.indices), generator=generator).tolist()
+            return iter([self.indices[i] for i in order])
+        return iter(self.indices)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,408 @@
+import inspect
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import time
+from pathlib import Path
+
+import click
+from loguru import logger
+
+from acestep.cpu_affinity import pin_to_cpus, plan_worker_cpus
+from acestep.result_cache import canonical_hash
+
+
+# arguments that may differ between the samples of one pipeline call
+PER_SAMPLE_ARGS = ("prompt", "lyrics", "audio_duration", "manual_seeds", "save_path")
+# per sample as well when batches may mix LoRAs, see acestep/multi_lora.py
+LORA_ARGS = ("lora_name_or_path", "lora_weight")
+# bookkeeping fields of saved input params, not generation arguments
+IGNORED_FIELDS = ("timecosts", "retake_seeds", "audio_path", "actual_seeds", "result_cache_hit")
+
+
+def call_defaults():
+    from acestep.pipeline_ace_step import ACEStepPipeline
+
+    return {
+        name: parameter.default
+        for name, parameter in inspect.signature(ACEStepPipeline.__call__).parameters.items()
+        if name != "self"
+    }
+
+
+def load_manifest(manifest):
+    """
+    Read jobs from a JSONL file with one job per line or from a directory of
+    ``*_input_params.json`` style files, as written next to generated audio.
+    """
+    if os.path.isdir(manifest):
+        entries = []
+        for path in sorted(Path(manifest).glob("*.json")):
+            with open(path, encoding="utf-8") as f:
+                entries.append(json.load(f))
+        return entries
+    with open(manifest, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def normalize_job(entry, defaults, output_dir):
+    """Map a manifest entry to a job with an id and the full set of __call__ arguments."""
+    entry = dict(entry)
+    if "actual_seeds" in entry and "manual_seeds" not in entry:
+        entry["manual_seeds"] = entry["actual_seeds"]
+    if "audio_path" in entry and "save_path" not in entry:
+        entry["save_path"] = entry["audio_path"]
+    if isinstance(entry.get("oss_steps"), list):
+        entry["oss_steps"] = ", ".join(map(str, entry["oss_steps"]))
+    job_id = entry.pop("id", None)
+    unknown = set(entry) - set(defaults) - set(IGNORED_FIELDS)
+    if unknown:
+        logger.warning(f"Ignoring unknown job fields {sorted(unknown)}")
+    params = dict(defaults, **{k: v for k, v in entry.items() if k in defaults})
+    if job_id is None:
+        job_id = canonical_hash({k: v for k, v in params.items() if k != "save_path"})[:16]
+    if params["save_path"] is None:
+        params["save_path"] = os.path.join(output_dir, f"{job_id}.{params['format']}")
+    return {"id": str(job_id), "params": params}
+
+
+def single_seed(seeds):
+    """The seed of a job as an int, None if it has no single fixed seed."""
+    if isinstance(seeds, list) and len(seeds) == 1:
+        seeds = seeds[0]
+    if isinstance(seeds, str) and seeds.strip().isdigit():
+        return int(seeds)
+    if isinstance(seeds, int):
+        return seeds
+    return None
+
+
+def batch_key(job, mix_loras=False):
+    """Jobs with equal keys can share one pipeline call."""
+    params = job["params"]
+    if params["task"] != "text2music" or params["audio2audio_enable"] or params["batch_size"] != 1:
+        # never packed
+        return ("single", job["id"])
+    per_sample_args = PER_SAMPLE_ARGS + LORA_ARGS if mix_loras else PER_SAMPLE_ARGS
+    return tuple(
+        (name, json.dumps(value, sort_keys=True, default=str))
+        for name, value in sorted(params.items())
+        if name not in per_sample_args
+    )
+
+
+def lora_key(params):
+    return (params["lora_name_or_path"], params["lora_weight"])
+
+
+def job_cost(job):
+    params = job["params"]
+    duration = params["audio_duration"] if params["audio_duration"] > 0 else 240.0
+    return duration * params["infer_step"] * params["batch_size"]
+
+
+def plan_batches(jobs, max_batch_size, mix_loras=False):
+    """
+    Group jobs by LoRA so every LoRA is loaded once, then pack jobs that only
+    differ in prompt, lyrics, duration and seed into batches. Jobs are sorted by
+    duration before packing so a batch pads as little as possible. With
+    ``mix_loras`` jobs with different LoRAs are packed together as well.
+    """
+    groups = {}
+    for job in jobs:
+        groups.setdefault(batch_key(job, mix_loras), []).append(job)
+
+    batches = []
+    for key, group in groups.items():
+        group.sort(key=lambda job: job["params"]["audio_duration"])
+        size = 1 if key[0] == "single" else max_batch_size
+        for start in range(0, len(group), size):
+            batches.append(group[start : start + size])
+    batches.sort(key=lambda batch: (str(lora_key(batch[0]["params"])), str(batch_key(batch[0], mix_loras))))
+    return batches
+
+
+def shard_batches(batches, num_workers):
+    """Split the LoRA sorted batches into contiguous shards of similar cost."""
+    total = sum(job_cost(job) for batch in batches for job in batch)
+    shards = [[] for _ in range(num_workers)]
+    done = 0.0
+    for batch in batches:
+        cost = sum(job_cost(job) for job in batch)
+        shard = min(int((done + cost / 2) / total * num_workers), num_workers - 1) if total > 0 else 0
+        shards[shard].append(batch)
+        done += cost
+    return shards
+
+
+def count_lora_swaps(batches):
+    swaps = 0
+    current = ("none", 1.0)
+    for batch in batches:
+        key = lora_key(batch[0]["params"])
+        if key != current:
+            swaps += 1
+            current = key
+    return swaps
+
+
+def batch_call_params(batch):
+    """Merge a packed batch into the keyword arguments of one pipeline call."""
+    params = dict(batch[0]["params"])
+    if len(batch) == 1:
+        return params
+    seeds = [single_seed(job["params"]["manual_seeds"]) for job in batch]
+    params.update(
+        prompt=[job["params"]["prompt"] for job in batch],
+        lyrics=[job["params"]["lyrics"] for job in batch],
+        audio_duration=[job["params"]["audio_duration"] for job in batch],
+        manual_seeds=[seed if seed is not None else random.randrange(2**32) for seed in seeds],
+        save_path=[job["params"]["save_path"] for job in batch],
+        batch_size=len(batch),
+    )
+    for name in LORA_ARGS:
+        values = [job["params"][name] for job in batch]
+        if len(set(values)) > 1:
+            params[name] = values
+    return params
+
+
+def load_completed(output_dir):
+    completed = set()
+    for path in Path(output_dir).glob("completed*.jsonl"):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    completed.add(json.loads(line)["id"])
+    return completed
+
+
+def build_pipeline(args, shared_weights_dir=None):
+    from acestep.pipeline_ace_step import ACEStepPipeline
+
+    return ACEStepPipeline(
+        checkpoint_dir=args["checkpoint_path"],
+        dtype="bfloat16" if args["bf16"] else "float32",
+        torch_compile=args["torch_compile"],
+        overlapped_decode=args["overlapped_decode"],
+        result_cache_dir=args["result_cache_dir"],
+        int8_quantization=args["int8_quantization"],
+        attention_chunk_threshold=args["attention_chunk_threshold"],
+        inference_only=args["inference_only"],
+        shared_weights_dir=shared_weights_dir,
+    )
+
+
+def pin_worker(cpu_set):
+    """Pin the process to its (node, cpus) set, before torch creates its thread pools."""
+    node, cpus = cpu_set
+    pin_to_cpus(cpus, node)
+    os.environ["OMP_NUM_THREADS"] = str(len(cpus))
+
+
+def export_shared_weights(args, shared_weights_dir, cpu_set=None):
+    # pinned to the node that maps the export, so its page cache is local
+    if cpu_set is not None:
+        pin_worker(cpu_set)
+    pipeline = build_pipeline(args)
+    pipeline.load_checkpoint(pipeline.checkpoint_dir)
+    pipeline.export_shared_weights(shared_weights_dir)
+
+
+def copy_shared_weights(source_dir, shared_weights_dir, cpu_set):
+    pin_worker(cpu_set)
+    tmp_dir = f"{shared_weights_dir}.tmp"
+    shutil.copytree(source_dir, tmp_dir, dirs_exist_ok=True)
+    os.replace(tmp_dir, shared_weights_dir)
+
+
+def prepare_shared_weights(args, shared_weights_dir, cpu_sets, context):
+    """
+    Shared weights directory of every worker. Pinned workers get one copy per NUMA
+    node, so each node maps weights from its own memory, the first one is exported
+    from the checkpoint and the others are copied from it.
+    """
+    from acestep.pipeline_ace_step import SHARED_WEIGHTS_INFO
+
+    nodes = {}
+    for cpu_set in cpu_sets:
+        node = None if cpu_set is None else cpu_set[0]
+        nodes.setdefault(node, cpu_set)
+    if len(nodes) == 1:
+        directories = {node: shared_weights_dir for node in nodes}
+    else:
+        directories = {node: os.path.join(shared_weights_dir, f"node{node}") for node in nodes}
+    source_dir = None
+    for node, cpu_set in nodes.items():
+        directory = directories[node]
+        if not os.path.exists(os.path.join(directory, SHARED_WEIGHTS_INFO)):
+            if source_dir is None:
+                logger.info(f"Exporting the shared weights to {directory}")
+                process = context.Process(target=export_shared_weights, args=(args, directory, cpu_set))
+            else:
+                logger.info(f"Copying the shared weights to {directory} for NUMA node {node}")
+                process = context.Process(target=copy_shared_weights, args=(source_dir, directory, cpu_set))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise SystemExit(f"Preparing the shared weights in {directory} failed")
+        source_dir = source_dir or directory
+    return [directories[None if cpu_set is None else cpu_set[0]] for cpu_set in cpu_sets]
+
+
+def run_worker(rank, shard, args, batch_queue=None):
+    device_ids = args["device_ids"]
+    os.environ["CUDA_VISIBLE_DEVICES"] = str(device_ids[rank % len(device_ids)])
+    cpu_set = args["cpu_sets"][rank]
+    if cpu_set is not None:
+        pin_worker(cpu_set)
+
+    import torch
+
+    threads = args["threads_per_worker"]
+    if threads <= 0 and cpu_set is not None:
+        threads = len(cpu_set[1])
+    if threads > 0:
+        torch.set_num_threads(threads)
+
+    shared_weights_dirs = args["shared_weights_dirs"]
+    pipeline = build_pipeline(args, shared_weights_dirs[rank] if shared_weights_dirs else None)
+    if shared_weights_dirs:
+        # fail the worker right away when the export does not match its settings
+        pipeline.load_shared_checkpoint(pipeline.checkpoint_dir)
+    completed_path = os.path.join(args["output_dir"], f"completed.{rank}.jsonl")
+    # with a queue the workers take the next batch when they are free, the total is unknown
+    if batch_queue is not None:
+        shard = iter(batch_queue.get, None)
+        num_jobs = "?"
+    else:
+        num_jobs = sum(len(batch) for batch in shard)
+    finished = 0
+    for batch in shard:
+        start_time = time.time()
+        try:
+            outputs = pipeline(**batch_call_params(batch))
+        except Exception:
+            logger.exception(f"Worker {rank}: batch {[job['id'] for job in batch]} failed, it is retried on the next run")
+            continue
+        output_paths = outputs[:-1]
+        # record completion only after the files exist, so an interrupted batch reruns
+        with open(completed_path, "a", encoding="utf-8") as f:
+            for job, output_path in zip(batch, output_paths):
+                f.write(json.dumps({"id": job["id"], "output_path": output_path, "finished_at": time.time()}) + "\n")
+        finished += len(batch)
+        logger.info(
+            f"Worker {rank}: {finished}/{num_jobs} jobs, batch of {len(batch)} in {time.time() - start_time:.1f}s"
+        )
+
+
+@click.command()
+@click.option("--manifest", type=str, required=True, help="JSONL file with one job per line, or a directory of input params JSON files")
+@click.option("--output_dir", type=str, default="./outputs/batch", help="Directory for outputs without a save_path and the completion records")
+@click.option("--checkpoint_path", type=str, default="", help="Path to the checkpoint directory")
+@click.option("--bf16", type=bool, default=True, help="Whether to use bfloat16")
+@click.option("--torch_compile", type=bool, default=False, help="Whether to use torch compile")
+@click.option("--overlapped_decode", type=bool, default=False, help="Whether to use overlapped decoding")
+@click.option("--result_cache_dir", type=str, default=None, help="Directory to cache and replay results of generations with fixed seeds")
+@click.option("--max_batch_size", type=int, default=4, help="Maximum number of jobs packed into one pipeline call")
+@click.option("--num_workers", type=int, default=1, help="Number of worker processes")
+@click.option("--device_ids", type=str, default="0", help="Comma separated GPU ids, assigned to the workers round robin")
+@click.option("--threads_per_worker", type=int, default=0, help="torch threads per worker, 0 keeps the default")
+@click.option("--int8_quantization", type=click.Choice(["dynamic", "weight_only"]), default=None, help="Run the transformer and text encoder in int8, 'dynamic' for CPU workers")
+@click.option("--attention_chunk_threshold", type=int, default=None, help="Run the linear attention in chunks from this many latent frames on, fits larger batches of long songs")
+@click.option("--inference_only", type=bool, default=False, help="Skip the training only transformer heads")
+@click.option("--numa", is_flag=True, default=False, help="Pin every worker to its own cores of one NUMA node, with a torch thread per core")
+@click.option("--shared_weights_dir", type=str, default=None, help="Map the weights from this directory in all CPU workers instead of private copies, exported on first use")
+@click.option("--shared_queue", is_flag=True, default=False, help="Workers take batches from one queue instead of fixed shards, balances uneven jobs")
+@click.option("--mix_loras", is_flag=True, default=False, help="Pack jobs with different LoRAs into one batch, each sample runs its own adapter")
+@click.option("--dry_run", is_flag=True, default=False, help="Only print the batch plan")
+def main(manifest, output_dir, checkpoint_path, bf16, torch_compile, overlapped_decode, result_cache_dir, max_batch_size, num_workers, device_ids, threads_per_worker, int8_quantization, attention_chunk_threshold, inference_only, numa, shared_weights_dir, shared_queue, mix_loras, dry_run):
+    os.makedirs(output_dir, exist_ok=True)
+    defaults = call_defaults()
+    jobs = {}
+    for entry in load_manifest(manifest):
+        job = normalize_job(entry, defaults, output_dir)
+        if job["id"] in jobs:
+            logger.warning(f"Skipping duplicate job {job['id']}, give repeated jobs distinct ids or seeds")
+            continue
+        jobs[job["id"]] = job
+    jobs = list(jobs.values())
+    completed = load_completed(output_dir)
+    pending = [job for job in jobs if job["id"] not in completed]
+    logger.info(f"{len(jobs)} jobs in the manifest, {len(jobs) - len(pending)} already completed")
+    if not pending:
+        return
+
+    if shared_weights_dir and int8_quantization:
+        raise click.BadParameter("cannot be combined with --int8_quantization", param_hint="--shared_weights_dir")
+
+    batches = plan_batches(pending, max_batch_size, mix_loras)
+    if shared_queue:
+        # the queue keeps the plan order, so consecutive batches of a worker mostly share their LoRA
+        shards = [batches]
+        num_processes = min(num_workers, len(batches))
+        logger.info(f"{len(batches)} batches in one queue for {num_processes} workers")
+    else:
+        shards = [shard for shard in shard_batches(batches, num_workers) if shard]
+        num_processes = len(shards)
+        logger.info(
+            f"{len(batches)} batches on {len(shards)} workers, "
+            f"{sum(count_lora_swaps(shard) for shard in shards)} LoRA loads "
+            f"instead of {count_lora_swaps([[job] for job in pending])} in manifest order"
+        )
+    cpu_sets = plan_worker_cpus(num_processes) if numa else [None] * num_processes
+    if dry_run:
+        for rank, shard in enumerate(shards):
+            owner = "queue" if shared_queue else f"worker {rank}"
+            for batch in shard:
+                logger.info(f"{owner}: lora {lora_key(batch[0]['params'])} jobs {[job['id'] for job in batch]}")
+        for rank, cpu_set in enumerate(cpu_sets):
+            if cpu_set is not None:
+                logger.info(f"worker {rank}: NUMA node {cpu_set[0]}, {len(cpu_set[1])} CPUs {cpu_set[1][0]}-{cpu_set[1][-1]}")
+        return
+
+    args = {
+        "checkpoint_path": checkpoint_path,
+        "bf16": bf16,
+        "torch_compile": torch_compile,
+        "overlapped_decode": overlapped_decode,
+        "result_cache_dir": result_cache_dir,
+        "output_dir": output_dir,
+        "device_ids": [device_id.strip() for device_id in device_ids.split(",") if device_id.strip()],
+        "threads_per_worker": threads_per_worker,
+        "int8_quantization": int8_quantization,
+        "attention_chunk_threshold": attention_chunk_threshold,
+        "inference_only": inference_only,
+        "cpu_sets": cpu_sets,
+        "shared_weights_dirs": None,
+    }
+    context = multiprocessing.get_context("spawn")
+    if shared_weights_dir:
+        args["shared_weights_dirs"] = prepare_shared_weights(args, shared_weights_dir, cpu_sets, context)
+    if num_processes == 1:
+        run_worker(0, shards[0], args)
+        return
+    if shared_queue:
+        batch_queue = context.Queue()
+        for batch in batches:
+            batch_queue.put(batch)
+        for _ in range(num_processes):
+            batch_queue.put(None)
+        processes = [
+            context.Process(target=run_worker, args=(rank, None, args, batch_queue)) for rank in range(num_processes)
+        ]
+    else:
+        processes = [context.Process(target=run_worker, args=(rank, shard, args)) for rank, shard in enumerate(shards)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [rank for rank, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise SystemExit(f"Workers {failed} exited with an error, rerun to resume")
+
+
+if __name__ == "__main__":
+    main()
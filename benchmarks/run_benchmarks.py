@@ -0,0 +1,382 @@
+"""
+CPU benchmarks for the ACE-Step hot paths.
+
+Every stage is timed independently on the tiny random-weight models from
+``benchmarks/tiny_models.py``. Results are written as JSON and can be compared
+against a stored baseline to catch regressions on CPU-only CI:
+
+    python -m benchmarks.run_benchmarks --output bench.json
+    python -m benchmarks.run_benchmarks --baseline benchmarks/baseline.json
+    python -m benchmarks.run_benchmarks --save_baseline benchmarks/baseline.json
+"""
+
+import argparse
+import copy
+import json
+import platform
+import statistics
+import sys
+import time
+
+import torch
+
+from acestep.apg_guidance import MomentumBuffer, apg_forward, cfg_forward
+from acestep.quantization import INT8_MODES, quantize_int8, relative_error
+from acestep.schedulers.scheduling_flow_match_euler_discrete import FlowMatchEulerDiscreteScheduler
+from acestep.schedulers.scheduling_flow_match_heun_discrete import FlowMatchHeunDiscreteScheduler
+from acestep.schedulers.scheduling_flow_match_pingpong import FlowMatchPingPongScheduler
+
+from benchmarks.tiny_models import (
+    build_lyric_pipeline,
+    build_tiny_lyric_encoder,
+    build_tiny_music_dcae,
+    build_tiny_transformer,
+    frame_length_for,
+    random_condition_inputs,
+)
+
+
+SAMPLE_LYRICS = """[verse]
+Neon lights they flicker bright
+City hums in dead of night
+[chorus]
+별빛 아래 춤을 춰요
+夜空に響く僕らの歌
+Bailando bajo la luna llena
+
+[bridge]
+Sous les étoiles, nous chantons
+"""
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a benchmark. The function does the setup and returns the callable to time."""
+
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return decorator
+
+
+@benchmark("transformer.encode")
+def bench_transformer_encode(ctx):
+    inputs = random_condition_inputs(ctx.batch_size * 2, generator=ctx.generator)
+    return lambda: ctx.transformer.encode(**inputs)
+
+
+def decode_step(ctx, transformer, generator):
+    bsz = ctx.batch_size * 2
+    inputs = random_condition_inputs(bsz, generator=generator)
+    encoder_hidden_states, encoder_hidden_mask = transformer.encode(**inputs)
+    frame_length = frame_length_for(ctx.duration)
+    hidden_states = torch.randn(bsz, 8, 16, frame_length, generator=generator)
+    attention_mask = torch.ones(bsz, frame_length)
+    timestep = torch.full((bsz,), 500.0)
+    return lambda: transformer.decode(
+        hidden_states=hidden_states,
+        attention_mask=attention_mask,
+        encoder_hidden_states=encoder_hidden_states,
+        encoder_hidden_mask=encoder_hidden_mask,
+        timestep=timestep,
+        output_length=frame_length,
+    )
+
+
+@benchmark("transformer.decode_step")
+def bench_transformer_decode_step(ctx):
+    return decode_step(ctx, ctx.transformer, ctx.generator)
+
+
+@benchmark("transformer.decode_step.int8_dynamic")
+def bench_transformer_decode_step_int8_dynamic(ctx):
+    return decode_step(ctx, ctx.int8_transformer("dynamic"), ctx.generator)
+
+
+@benchmark("transformer.decode_step.int8_weight_only")
+def bench_transformer_decode_step_int8_weight_only(ctx):
+    return decode_step(ctx, ctx.int8_transformer("weight_only"), ctx.generator)
+
+
+@benchmark("lyric_encoder")
+def bench_lyric_encoder(ctx):
+    lyric_encoder = build_tiny_lyric_encoder()
+    lyric_embs = torch.randn(ctx.batch_size * 2, 256, lyric_encoder.output_size, generator=ctx.generator)
+    lyric_mask = torch.ones(ctx.batch_size * 2, 256, dtype=torch.long)
+    return lambda: lyric_encoder(lyric_embs, lyric_mask, decoding_chunk_size=1, num_decoding_left_chunks=-1)
+
+
+def latent_pair(ctx):
+    shape = (ctx.batch_size, 8, 16, frame_length_for(ctx.duration))
+    return torch.randn(shape, generator=ctx.generator), torch.randn(shape, generator=ctx.generator)
+
+
+@benchmark("guidance.apg")
+def bench_apg(ctx):
+    pred_cond, pred_uncond = latent_pair(ctx)
+    momentum_buffer = MomentumBuffer()
+    return lambda: apg_forward(pred_cond, pred_uncond, guidance_scale=15.0, momentum_buffer=momentum_buffer)
+
+
+@benchmark("guidance.cfg")
+def bench_cfg(ctx):
+    pred_cond, pred_uncond = latent_pair(ctx)
+    return lambda: cfg_forward(pred_cond, pred_uncond, cfg_strength=15.0)
+
+
+def scheduler_step(ctx, scheduler_cls, **step_kwargs):
+    model_output, sample = latent_pair(ctx)
+    scheduler = scheduler_cls(num_train_timesteps=1000, shift=3.0)
+    scheduler.set_timesteps(ctx.infer_steps)
+    timestep = scheduler.timesteps[ctx.infer_steps // 2]
+
+    def run():
+        # restart from the same step so every call does identical work
+        scheduler._step_index = None
+        return scheduler.step(model_output=model_output, timestep=timestep, sample=sample, return_dict=False, **step_kwargs)
+
+    return run
+
+
+@benchmark("scheduler.euler_step")
+def bench_euler_step(ctx):
+    return scheduler_step(ctx, FlowMatchEulerDiscreteScheduler, omega=10.0)
+
+
+@benchmark("scheduler.heun_step")
+def bench_heun_step(ctx):
+    return scheduler_step(ctx, FlowMatchHeunDiscreteScheduler, omega=10.0)
+
+
+@benchmark("scheduler.pingpong_step")
+def bench_pingpong_step(ctx):
+    return scheduler_step(ctx, FlowMatchPingPongScheduler, omega=10.0, generator=ctx.generator)
+
+
+@benchmark("dcae.decode")
+def bench_dcae_decode(ctx):
+    latents = torch.randn(1, 8, 16, frame_length_for(ctx.duration), generator=ctx.generator)
+    return lambda: ctx.music_dcae.dcae.decoder(latents)
+
+
+@benchmark("vocoder.decode")
+def bench_vocoder_decode(ctx):
+    mel = torch.randn(1, 128, frame_length_for(ctx.duration) * 8, generator=ctx.generator)
+    return lambda: ctx.music_dcae.vocoder.decode(mel)
+
+
+@benchmark("vocoder.mel")
+def bench_mel(ctx):
+    audio = torch.randn(2, int(ctx.duration * 44100), generator=ctx.generator).clamp(-1, 1)
+    return lambda: ctx.music_dcae.vocoder.mel_transform(audio)
+
+
+@benchmark("music_dcae.decode")
+def bench_music_dcae_decode(ctx):
+    latents = torch.randn(1, 8, 16, frame_length_for(ctx.duration), generator=ctx.generator)
+    return lambda: ctx.music_dcae.decode(latents, sr=48000)
+
+
+@benchmark("lyrics.tokenize_lyrics")
+def bench_tokenize_lyrics(ctx):
+    return lambda: ctx.lyric_pipeline.tokenize_lyrics(SAMPLE_LYRICS)
+
+
+@benchmark("lyrics.lang_segment")
+def bench_lang_segment(ctx):
+    return lambda: ctx.lyric_pipeline.lang_segment.getTexts(SAMPLE_LYRICS)
+
+
+class BenchmarkContext:
+    """Models shared by the benchmarks, built lazily so filtered runs stay fast."""
+
+    def __init__(self, batch_size, duration, infer_steps, seed):
+        self.batch_size = batch_size
+        self.duration = duration
+        self.infer_steps = infer_steps
+        self.seed = seed
+        self.generator = torch.Generator().manual_seed(seed)
+        self._transformer = None
+        self._music_dcae = None
+        self._lyric_pipeline = None
+        self._int8_transformers = {}
+
+    @property
+    def transformer(self):
+        if self._transformer is None:
+            torch.manual_seed(self.seed)
+            self._transformer = build_tiny_transformer()
+        return self._transformer
+
+    def int8_transformer(self, mode):
+        """The tiny transformer with the same weights, quantized to int8."""
+        if mode not in self._int8_transformers:
+            self._int8_transformers[mode] = quantize_int8(copy.deepcopy(self.transformer), mode)
+        return self._int8_transformers[mode]
+
+    @property
+    def music_dcae(self):
+        if self._music_dcae is None:
+            torch.manual_seed(self.seed)
+            self._music_dcae = build_tiny_music_dcae()
+        return self._music_dcae
+
+    @property
+    def lyric_pipeline(self):
+        if self._lyric_pipeline is None:
+            self._lyric_pipeline = build_lyric_pipeline()
+        return self._lyric_pipeline
+
+
+def time_callable(func, warmup, repeat):
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        "median_ms": statistics.median(times),
+        "mean_ms": statistics.mean(times),
+        "min_ms": min(times),
+        "max_ms": max(times),
+        "stdev_ms": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "repeat": repeat,
+    }
+
+
+def run_benchmarks(names, ctx, warmup, repeat):
+    results = {}
+    with torch.no_grad():
+        for name in names:
+            func = BENCHMARKS[name](ctx)
+            results[name] = time_callable(func, warmup, repeat)
+            print(f"{name:<28} {results[name]['median_ms']:>10.3f} ms")
+    return results
+
+
+def check_int8_accuracy(ctx, tolerance):
+    """Relative error of an int8 decode step against float32 on the same inputs, and the modes above ``tolerance``."""
+    errors = {}
+    with torch.no_grad():
+        reference = decode_step(ctx, ctx.transformer, torch.Generator().manual_seed(ctx.seed))().sample
+        for mode in INT8_MODES:
+            output = decode_step(ctx, ctx.int8_transformer(mode), torch.Generator().manual_seed(ctx.seed))().sample
+            errors[mode] = relative_error(reference, output)
+            print(f"int8 {mode:<24} relative error {errors[mode]:.4f}")
+    return errors, [mode for mode, error in errors.items() if error > tolerance]
+
+
+def check_weight_norm_folding(ctx, tolerance):
+    """Relative error of the vocoder with folded weight norm, as MusicDCAE runs it in eval mode, against the normalized one."""
+    vocoder = ctx.music_dcae.vocoder
+    reference_vocoder = copy.deepcopy(vocoder)
+    reference_vocoder.apply_weight_norm()
+    mel = torch.randn(1, 128, frame_length_for(ctx.duration) * 8, generator=torch.Generator().manual_seed(ctx.seed))
+    with torch.no_grad():
+        error = relative_error(reference_vocoder.decode(mel), vocoder.decode(mel))
+    print(f"vocoder folded weight norm   relative error {error:.2e}")
+    return error, error > tolerance
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Return the stages whose median time grew by more than ``tolerance``."""
+    regressions = []
+    print(f"\n{'stage':<28} {'baseline':>10} {'current':>10} {'ratio':>8}")
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        baseline_ms = baseline["results"][name]["median_ms"]
+        ratio = result["median_ms"] / max(baseline_ms, 1e-9)
+        flag = ""
+        if ratio > 1.0 + tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<28} {baseline_ms:>10.3f} {result['median_ms']:>10.3f} {ratio:>8.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ACE-Step stages on tiny random-weight models.")
+    parser.add_argument("--stages", type=str, nargs="*", default=None, help="Stages to run, defaults to all of them.")
+    parser.add_argument("--list", action="store_true", help="List the available stages and exit.")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=30.0, help="Audio duration in seconds used for latent and audio shapes.")
+    parser.add_argument("--infer_steps", type=int, default=60)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads, keep it fixed between runs.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", type=str, default=None, help="Compare against this results JSON.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown ratio before a stage counts as a regression.")
+    parser.add_argument("--save_baseline", type=str, default=None, help="Store the results as the new baseline.")
+    parser.add_argument("--check_int8", action="store_true", help="Compare int8 quantized decode outputs against float32.")
+    parser.add_argument("--int8_tolerance", type=float, default=0.05, help="Allowed relative error of the int8 decode outputs.")
+    parser.add_argument("--check_weight_norm", action="store_true", help="Compare the vocoder output with folded weight norm against the normalized weights.")
+    parser.add_argument("--weight_norm_tolerance", type=float, default=1e-5, help="Allowed relative error of the folded vocoder output.")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(BENCHMARKS))
+        return 0
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    names = args.stages or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown stages: {unknown}")
+
+    ctx = BenchmarkContext(args.batch_size, args.duration, args.infer_steps, args.seed)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "num_threads": torch.get_num_threads(),
+        },
+        "settings": {
+            "batch_size": args.batch_size,
+            "duration": args.duration,
+            "infer_steps": args.infer_steps,
+            "warmup": args.warmup,
+            "repeat": args.repeat,
+        },
+        "results": run_benchmarks(names, ctx, args.warmup, args.repeat),
+    }
+    int8_failures = []
+    if args.check_int8:
+        report["int8_relative_error"], int8_failures = check_int8_accuracy(ctx, args.int8_tolerance)
+    weight_norm_failure = False
+    if args.check_weight_norm:
+        report["weight_norm_relative_error"], weight_norm_failure = check_weight_norm_folding(ctx, args.weight_norm_tolerance)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report["results"], baseline, args.tolerance)
+        if regressions:
+            print(f"\nRegressions: {', '.join(regressions)}")
+            return 1
+    if int8_failures:
+        print(f"\nInt8 modes above the error tolerance: {', '.join(int8_failures)}")
+        return 1
+    if weight_norm_failure:
+        print("\nThe folded vocoder output differs from the weight normalized one")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Scaled-down, randomly initialized ACE-Step models for CPU benchmarks.
+
+The configs keep the structure of the released checkpoints (block types,
+patching, latent and mel shapes) but shrink widths and depths so every stage
+runs in milliseconds and no checkpoint has to be downloaded.
+"""
+
+import tempfile
+
+import torch
+
+from acestep.language_segmentation import LangSegment, language_filters
+from acestep.models.ace_step_transformer import ACEStepTransformer2DModel
+from acestep.models.lyrics_utils.lyric_encoder import ConformerEncoder as LyricEncoder
+from acestep.models.lyrics_utils.lyric_tokenizer import VoiceBpeTokenizer
+from acestep.music_dcae.music_dcae_pipeline import MusicDCAE
+from acestep.pipeline_ace_step import ACEStepPipeline
+
+
+TINY_LYRIC_ENCODER_CONFIG = {
+    "output_size": 64,
+    "attention_heads": 2,
+    "linear_units": 128,
+    "num_blocks": 2,
+}
+
+TINY_TRANSFORMER_CONFIG = {
+    "num_layers": 2,
+    "attention_head_dim": 32,
+    "num_attention_heads": 4,
+    "mlp_ratio": 2.0,
+    "ssl_encoder_depths": [0, 1],
+    "ssl_latent_dims": [32, 32],
+    "lyric_hidden_size": 64,
+    "lyric_encoder_config": TINY_LYRIC_ENCODER_CONFIG,
+}
+
+TINY_DCAE_CONFIG = {
+    "in_channels": 2,
+    "latent_channels": 8,
+    "attention_head_dim": 8,
+    "encoder_block_types": ["ResBlock", "ResBlock", "ResBlock", "EfficientViTBlock"],
+    "decoder_block_types": ["ResBlock", "ResBlock", "ResBlock", "EfficientViTBlock"],
+    "encoder_block_out_channels": [16, 32, 32, 64],
+    "decoder_block_out_channels": [16, 32, 32, 64],
+    "encoder_layers_per_block": [1, 1, 1, 1],
+    "decoder_layers_per_block": [1, 1, 1, 1],
+    "encoder_qkv_multiscales": [[], [], [], [5]],
+    "decoder_qkv_multiscales": [[], [], [], [5]],
+    "upsample_block_type": "interpolate",
+    "downsample_block_type": "Conv",
+    "decoder_norm_types": "rms_norm",
+    "decoder_act_fns": "silu",
+}
+
+TINY_VOCODER_CONFIG = {
+    "depths": [1, 1],
+    "dims": [32, 64],
+    "resblock_kernel_sizes": [3],
+    "resblock_dilation_sizes": [[1, 3, 5]],
+    "num_mels": 64,
+    "upsample_initial_channel": 128,
+}
+
+
+def build_tiny_transformer(**overrides):
+    config = {**TINY_TRANSFORMER_CONFIG, **overrides}
+    return ACEStepTransformer2DModel(**config).eval()
+
+
+def build_tiny_lyric_encoder(**overrides):
+    config = {**TINY_LYRIC_ENCODER_CONFIG, **overrides}
+    return LyricEncoder(input_size=config["output_size"], static_chunk_size=0, **config).eval()
+
+
+def build_tiny_music_dcae(dcae_overrides=None, vocoder_overrides=None):
+    return MusicDCAE(
+        dcae_config={**TINY_DCAE_CONFIG, **(dcae_overrides or {})},
+        vocoder_config={**TINY_VOCODER_CONFIG, **(vocoder_overrides or {})},
+    ).eval()
+
+
+def build_lyric_pipeline():
+    """ACEStepPipeline with only the lyric tokenizer and language segmentation loaded."""
+    pipeline = ACEStepPipeline(checkpoint_dir=tempfile.mkdtemp(prefix="ace_step_bench_"))
+    lang_segment = LangSegment()
+    lang_segment.setfilters(language_filters.default)
+    pipeline.lang_segment = lang_segment
+    pipeline.lyric_tokenizer = VoiceBpeTokenizer()
+    return pipeline
+
+
+def frame_length_for(duration):
+    # same latent length as text2music_diffusion_process
+    return int(duration * 44100 / 512 / 8)
+
+
+def random_condition_inputs(batch_size, text_len=64, lyric_len=256, vocab_size=6681, generator=None):
+    return {
+        "encoder_text_hidden_states": torch.randn(batch_size, text_len, 768, generator=generator),
+        "text_attention_mask": torch.ones(batch_size, text_len, dtype=torch.long),
+        "speaker_embeds": torch.randn(batch_size, 512, generator=generator),
+        "lyric_token_idx": torch.randint(0, vocab_size, (batch_size, lyric_len), generator=generator),
+        "lyric_mask": torch.ones(batch_size, lyric_len, dtype=torch.long),
+    }
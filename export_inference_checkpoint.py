@@ -0,0 +1,92 @@
+"""
+Write a slim copy of an ACE-Step checkpoint for inference.
+
+The transformer is saved without the SSL projection heads that are only used in
+training and its config is marked inference_only, so it loads without building
+them. With --dcae_decoder_only the DCAE encoder weights are dropped as well, such a
+checkpoint only serves text2music and is loaded with --dcae_decoder_only.
+"""
+
+import json
+import os
+import shutil
+
+import click
+from loguru import logger
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from acestep.pipeline_ace_step import ACEStepPipeline, REPO_ID
+
+
+def strip_safetensors(src_dir, dst_dir, keep):
+    """Copy the model folder src_dir to dst_dir with only the weights whose key passes keep, returns the dropped count."""
+    os.makedirs(dst_dir, exist_ok=True)
+    weight_map = {}
+    dropped = 0
+    index_names = []
+    for name in sorted(os.listdir(src_dir)):
+        src = os.path.join(src_dir, name)
+        if name.endswith(".safetensors.index.json"):
+            index_names.append(name)
+        elif name.endswith(".safetensors"):
+            tensors = {}
+            with safe_open(src, framework="pt") as f:
+                metadata = f.metadata()
+                for key in f.keys():
+                    if keep(key):
+                        tensors[key] = f.get_tensor(key)
+                    else:
+                        dropped += 1
+            save_file(tensors, os.path.join(dst_dir, name), metadata=metadata)
+            weight_map.update(dict.fromkeys(tensors, name))
+        elif name.endswith((".pt", ".bin")):
+            # exported int8/int4 weights follow the full module structure, export them again from the slim checkpoint
+            logger.info(f"Skipping {src}")
+        elif os.path.isdir(src):
+            shutil.copytree(src, os.path.join(dst_dir, name), dirs_exist_ok=True)
+        else:
+            shutil.copy2(src, os.path.join(dst_dir, name))
+    # sharded checkpoints list every key in their index
+    for name in index_names:
+        with open(os.path.join(src_dir, name), encoding="utf-8") as f:
+            index = json.load(f)
+        index["weight_map"] = {key: shard for key, shard in index["weight_map"].items() if key in weight_map}
+        with open(os.path.join(dst_dir, name), "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2)
+    return dropped
+
+
+@click.command()
+@click.option("--checkpoint_path", type=str, default="", help="Checkpoint directory to export, downloads the checkpoint when empty")
+@click.option("--output_path", type=str, required=True, help="Directory for the inference checkpoint")
+@click.option("--dcae_decoder_only", is_flag=True, default=False, help="Drop the DCAE encoder too, the export then only serves text2music")
+def main(checkpoint_path, output_path, dcae_decoder_only):
+    checkpoint_dir = ACEStepPipeline(checkpoint_dir=checkpoint_path).get_checkpoint_path(checkpoint_path or None, REPO_ID)
+    if os.path.abspath(checkpoint_dir) == os.path.abspath(output_path):
+        raise click.BadParameter("The output path must differ from the checkpoint path", param_hint="--output_path")
+    os.makedirs(output_path, exist_ok=True)
+    for name in sorted(os.listdir(checkpoint_dir)):
+        src = os.path.join(checkpoint_dir, name)
+        dst = os.path.join(output_path, name)
+        if name == "ace_step_transformer":
+            dropped = strip_safetensors(src, dst, lambda key: not key.startswith("projectors."))
+            config_path = os.path.join(dst, "config.json")
+            with open(config_path, encoding="utf-8") as f:
+                config = json.load(f)
+            config["inference_only"] = True
+            with open(config_path, "w", encoding="utf-8") as f:
+                json.dump(config, f, indent=2)
+            logger.info(f"Transformer exported without {dropped} training only tensors")
+        elif name == "music_dcae_f8c8" and dcae_decoder_only:
+            dropped = strip_safetensors(src, dst, lambda key: key.startswith("decoder."))
+            logger.info(f"DCAE exported without {dropped} encoder tensors")
+        elif os.path.isdir(src):
+            shutil.copytree(src, dst, dirs_exist_ok=True)
+        else:
+            shutil.copy2(src, dst)
+    logger.info(f"Inference checkpoint written to: {output_path}")
+
+
+if __name__ == "__main__":
+    main()
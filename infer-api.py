@@ -1,13 +1,47 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
 from pydantic import BaseModel
 from typing import List, Optional
 import os
+import queue
+import threading
+import time
+import torch
 from acestep.pipeline_ace_step import ACEStepPipeline
 from acestep.data_sampler import DataSampler
+from acestep.metrics import MetricsRegistry, DEFAULT_MEMORY_BUCKETS
+from acestep.job_queue import JobManager, JobProgressCallback, SUCCEEDED, CANCELLED
+from acestep.cancellation import CancelledResult
+from acestep.audio_writer import AUDIO_MEDIA_TYPES
 import uuid
 
 app = FastAPI(title="ACEStep Pipeline API")
 
+metrics = MetricsRegistry()
+REQUESTS = metrics.counter(
+    "acestep_requests_total", "Generation requests by outcome.", ["task", "scheduler_type", "lora", "status"]
+)
+IN_PROGRESS = metrics.gauge("acestep_requests_in_progress", "Generations currently running.")
+BATCH_SIZE = metrics.gauge("acestep_current_batch_size", "Batch size of the generation currently running.")
+QUEUE_WAIT = metrics.histogram("acestep_queue_wait_seconds", "Time a job waited in the queue before it started.")
+QUEUE_SIZE = metrics.gauge("acestep_queue_size", "Jobs waiting in the queue.")
+STAGE_DURATION = metrics.histogram(
+    "acestep_stage_duration_seconds", "Pipeline stage durations from the reported timecosts.", ["stage"]
+)
+GENERATION_DURATION = metrics.histogram("acestep_generation_duration_seconds", "End to end generation time.")
+PEAK_MEMORY = metrics.histogram(
+    "acestep_peak_memory_bytes", "Peak CUDA memory allocated during a generation.", buckets=DEFAULT_MEMORY_BUCKETS
+)
+CACHE_HITS = metrics.gauge("acestep_cache_hits", "Preprocessing cache hits since start.", ["cache"])
+CACHE_MISSES = metrics.gauge("acestep_cache_misses", "Preprocessing cache misses since start.", ["cache"])
+CACHE_HIT_RATIO = metrics.gauge("acestep_cache_hit_ratio", "Preprocessing cache hit ratio since start.", ["cache"])
+CACHE_ENTRIES = metrics.gauge("acestep_cache_entries", "Entries held by the preprocessing caches.", ["cache"])
+
+# pipelines are reused across requests, keyed by their construction arguments
+pipelines = {}
+pipelines_lock = threading.Lock()
+
+
 class ACEStepInput(BaseModel):
     checkpoint_path: str
     bf16: bool = True
@@ -32,70 +66,224 @@ class ACEStepInput(BaseModel):
     oss_steps: List[int]
     guidance_scale_text: float = 0.0
     guidance_scale_lyric: float = 0.0
+    lora_name_or_path: str = "none"
+    lora_weight: float = 1.0
+    batch_size: int = 1
+
+class ACEStepJobInput(ACEStepInput):
+    # lower runs first, e.g. 0 for short previews and 10 for batch renders
+    priority: int = 5
+    # seconds from submission until the job is cancelled, queue wait included
+    timeout: Optional[float] = None
+    # on cancellation decode and keep the audio of the current latent estimate
+    return_partial_on_cancel: bool = False
+
+class ACEStepAudioInput(ACEStepInput):
+    format: str = "wav"
 
 class ACEStepOutput(BaseModel):
     status: str
     output_path: Optional[str]
     message: str
 
+class ACEStepJobStatus(BaseModel):
+    job_id: str
+    status: str
+    priority: int
+    step: int
+    total_steps: Optional[int]
+    output_path: Optional[str] = None
+    error: Optional[str] = None
+    cancel_reason: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
 def initialize_pipeline(checkpoint_path: str, bf16: bool, torch_compile: bool, device_id: int) -> ACEStepPipeline:
     os.environ["CUDA_VISIBLE_DEVICES"] = str(device_id)
     return ACEStepPipeline(
         checkpoint_dir=checkpoint_path,
         dtype="bfloat16" if bf16 else "float32",
         torch_compile=torch_compile,
+        result_cache_dir=os.environ.get("ACESTEP_RESULT_CACHE_DIR"),
+        result_cache_size_gb=float(os.environ.get("ACESTEP_RESULT_CACHE_SIZE_GB", 10.0)),
     )
 
-@app.post("/generate", response_model=ACEStepOutput)
-async def generate_audio(input_data: ACEStepInput):
+def get_pipeline(checkpoint_path: str, bf16: bool, torch_compile: bool, device_id: int):
+    key = (checkpoint_path, bf16, torch_compile, device_id)
+    with pipelines_lock:
+        if key not in pipelines:
+            pipelines[key] = (
+                initialize_pipeline(checkpoint_path, bf16, torch_compile, device_id),
+                threading.Lock(),
+            )
+        return pipelines[key]
+
+def collect_cache_metrics():
+    totals = {}
+    with pipelines_lock:
+        loaded = [pipeline for pipeline, _ in pipelines.values()]
+    for pipeline in loaded:
+        for name, stats in pipeline.cache_stats().items():
+            total = totals.setdefault(name, {"hits": 0, "misses": 0, "size": 0})
+            for field in total:
+                total[field] += stats[field]
+    for name, total in totals.items():
+        lookups = total["hits"] + total["misses"]
+        CACHE_HITS.set(total["hits"], cache=name)
+        CACHE_MISSES.set(total["misses"], cache=name)
+        CACHE_HIT_RATIO.set(total["hits"] / lookups if lookups else 0.0, cache=name)
+        CACHE_ENTRIES.set(total["size"], cache=name)
+
+metrics.add_collector(collect_cache_metrics)
+
+def run_generation(job):
+    input_data = job.params
+    lora = os.path.basename(input_data.lora_name_or_path.rstrip("/")) or "none"
+    labels = {"task": "text2music", "scheduler_type": input_data.scheduler_type, "lora": lora}
+    QUEUE_WAIT.observe(job.started_at - job.created_at)
     try:
-        # Initialize pipeline
-        model_demo = initialize_pipeline(
+        # Reuse the pipeline for this checkpoint
+        model_demo, model_lock = get_pipeline(
             input_data.checkpoint_path,
             input_data.bf16,
             input_data.torch_compile,
             input_data.device_id
         )
 
-        # Prepare parameters
-        params = (
-            input_data.audio_duration,
-            input_data.prompt,
-            input_data.lyrics,
-            input_data.infer_step,
-            input_data.guidance_scale,
-            input_data.scheduler_type,
-            input_data.cfg_type,
-            input_data.omega_scale,
-            ", ".join(map(str, input_data.actual_seeds)),
-            input_data.guidance_interval,
-            input_data.guidance_interval_decay,
-            input_data.min_guidance_scale,
-            input_data.use_erg_tag,
-            input_data.use_erg_lyric,
-            input_data.use_erg_diffusion,
-            ", ".join(map(str, input_data.oss_steps)),
-            input_data.guidance_scale_text,
-            input_data.guidance_scale_lyric,
-        )
+        # audio requested in the response is encoded in memory and never written to disk
+        return_audio_bytes = isinstance(input_data, ACEStepAudioInput)
+        format = getattr(input_data, "format", "wav")
 
         # Generate output path if not provided
         output_path = input_data.output_path or f"output_{uuid.uuid4().hex}.wav"
 
-        # Run pipeline
-        model_demo(
-            *params,
-            save_path=output_path
-        )
+        progress = JobProgressCallback(job)
+        with model_lock:
+            IN_PROGRESS.inc()
+            BATCH_SIZE.set(input_data.batch_size)
+            model_demo.add_callback(progress)
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            start_time = time.time()
+            try:
+                # Run pipeline
+                outputs = model_demo(
+                    audio_duration=input_data.audio_duration,
+                    prompt=input_data.prompt,
+                    lyrics=input_data.lyrics,
+                    infer_step=input_data.infer_step,
+                    guidance_scale=input_data.guidance_scale,
+                    scheduler_type=input_data.scheduler_type,
+                    cfg_type=input_data.cfg_type,
+                    omega_scale=input_data.omega_scale,
+                    manual_seeds=", ".join(map(str, input_data.actual_seeds)),
+                    guidance_interval=input_data.guidance_interval,
+                    guidance_interval_decay=input_data.guidance_interval_decay,
+                    min_guidance_scale=input_data.min_guidance_scale,
+                    use_erg_tag=input_data.use_erg_tag,
+                    use_erg_lyric=input_data.use_erg_lyric,
+                    use_erg_diffusion=input_data.use_erg_diffusion,
+                    oss_steps=", ".join(map(str, input_data.oss_steps)),
+                    guidance_scale_text=input_data.guidance_scale_text,
+                    guidance_scale_lyric=input_data.guidance_scale_lyric,
+                    lora_name_or_path=input_data.lora_name_or_path,
+                    lora_weight=input_data.lora_weight,
+                    batch_size=input_data.batch_size,
+                    save_path=output_path,
+                    format=format,
+                    return_audio_bytes=return_audio_bytes,
+                    cancellation_token=job.token,
+                    return_partial_on_cancel=getattr(input_data, "return_partial_on_cancel", False),
+                )
+            finally:
+                model_demo.remove_callback(progress)
+                IN_PROGRESS.dec()
+                BATCH_SIZE.set(0)
+
+        if isinstance(outputs, CancelledResult):
+            REQUESTS.inc(status=outputs.reason, **labels)
+            return outputs
+
+        GENERATION_DURATION.observe(time.time() - start_time)
+        for stage, seconds in outputs[-1]["timecosts"].items():
+            STAGE_DURATION.observe(seconds, stage=stage)
+        if torch.cuda.is_available():
+            PEAK_MEMORY.observe(torch.cuda.max_memory_allocated())
+        REQUESTS.inc(status="success", **labels)
+        if return_audio_bytes:
+            return outputs[0]
+        return output_path
+
+    except Exception:
+        REQUESTS.inc(status=job.token.reason or "error", **labels)
+        raise
 
+job_manager = JobManager(run_generation, max_queue_size=int(os.environ.get("ACESTEP_MAX_QUEUE_SIZE", 64)))
+metrics.add_collector(lambda: QUEUE_SIZE.set(job_manager.queue_size()))
+
+def job_status(job):
+    status = job.to_dict()
+    result = status.pop("result")
+    status["output_path"] = result if isinstance(result, str) else None
+    return ACEStepJobStatus(**status)
+
+def submit_job(input_data, priority, timeout=None):
+    try:
+        return job_manager.submit(input_data, priority=priority, timeout=timeout)
+    except queue.Full:
+        raise HTTPException(status_code=429, detail="Job queue is full, retry later")
+
+@app.post("/jobs", response_model=ACEStepJobStatus)
+async def create_job(input_data: ACEStepJobInput):
+    job = submit_job(input_data, input_data.priority, input_data.timeout)
+    return job_status(job)
+
+@app.get("/jobs/{job_id}", response_model=ACEStepJobStatus)
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job_status(job)
+
+@app.delete("/jobs/{job_id}", response_model=ACEStepJobStatus)
+async def cancel_job(job_id: str):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job_status(job)
+
+# blocking variant of POST /jobs, a plain def waits in FastAPI's threadpool instead of the event loop
+@app.post("/generate", response_model=ACEStepOutput)
+def generate_audio(input_data: ACEStepInput):
+    job = submit_job(input_data, priority=5)
+    job.wait()
+    if job.status == SUCCEEDED:
         return ACEStepOutput(
             status="success",
-            output_path=output_path,
+            output_path=job.result,
             message="Audio generated successfully"
         )
+    if job.status == CANCELLED:
+        raise HTTPException(status_code=409, detail="Generation was cancelled")
+    raise HTTPException(status_code=500, detail=f"Error generating audio: {job.error}")
+
+# like /generate, but responds with the encoded audio of the first sample instead of a path
+@app.post("/generate_audio")
+def generate_audio_bytes(input_data: ACEStepAudioInput):
+    if input_data.format not in AUDIO_MEDIA_TYPES:
+        raise HTTPException(status_code=422, detail=f"Unsupported format {input_data.format}")
+    job = submit_job(input_data, priority=5)
+    job.wait()
+    if job.status == SUCCEEDED:
+        return Response(content=job.result, media_type=AUDIO_MEDIA_TYPES[input_data.format])
+    if job.status == CANCELLED:
+        raise HTTPException(status_code=409, detail="Generation was cancelled")
+    raise HTTPException(status_code=500, detail=f"Error generating audio: {job.error}")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating audio: {str(e)}")
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.render(), media_type=metrics.content_type)
 
 @app.get("/health")
 async def health_check():
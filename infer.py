@@ -2,6 +2,8 @@ import click
 import os
 from acestep.pipeline_ace_step import ACEStepPipeline
 from acestep.data_sampler import DataSampler
+from acestep.profiling import TraceRecorder
+from acestep.staged_executor import StagedExecutor
 
 
 @click.command()
@@ -22,8 +24,38 @@ from acestep.data_sampler import DataSampler
     "--overlapped_decode", type=bool, default=False, help="Whether to use overlapped decoding (run dcae and vocoder using sliding windows)"
 )
 @click.option("--device_id", type=int, default=0, help="Device ID to use")
+@click.option(
+    "--result_cache_dir", type=str, default=None, help="Directory to cache and replay results of generations with fixed seeds"
+)
 @click.option("--output_path", type=str, default=None, help="Path to save the output")
-def main(checkpoint_path, vocab_name, bf16, torch_compile, cpu_offload, overlapped_decode, device_id, output_path):
+@click.option(
+    "--trace_path", type=str, default=None, help="Record per-stage and per-step timings and save them as a Chrome trace JSON"
+)
+@click.option(
+    "--profile_steps", type=str, default="", help="Comma separated diffusion steps to run under torch.profiler, requires --trace_path"
+)
+@click.option(
+    "--pipelined", type=bool, default=False, help="Overlap text encoding, diffusion and decoding of consecutive samples (not with cpu_offload)"
+)
+@click.option(
+    "--async_io", type=bool, default=False, help="Encode and write audio files on background threads while the next sample is generated"
+)
+@click.option(
+    "--merge_lora", type=bool, default=False, help="Fold LoRA weights into the base weights instead of running adapter layers"
+)
+@click.option(
+    "--int8_quantization", type=click.Choice(["dynamic", "weight_only"]), default=None, help="Run the transformer and text encoder in int8, 'dynamic' for CPU inference"
+)
+@click.option(
+    "--attention_chunk_threshold", type=int, default=None, help="Run the linear attention in chunks for sequences of at least this many latent frames, saves memory on long songs"
+)
+@click.option(
+    "--inference_only", type=bool, default=False, help="Skip the training only transformer heads, lowers load time and memory"
+)
+@click.option(
+    "--dcae_decoder_only", type=bool, default=False, help="Load the DCAE without its encoder, only for text2music"
+)
+def main(checkpoint_path, vocab_name, bf16, torch_compile, cpu_offload, overlapped_decode, device_id, result_cache_dir, output_path, trace_path, profile_steps, pipelined, async_io, merge_lora, int8_quantization, attention_chunk_threshold, inference_only, dcae_decoder_only):
     os.environ["CUDA_VISIBLE_DEVICES"] = str(device_id)
 
     model_demo = ACEStepPipeline(
@@ -31,12 +63,28 @@ def main(checkpoint_path, vocab_name, bf16, torch_compile, cpu_offload, overlapp
         dtype="bfloat16" if bf16 else "float32",
         torch_compile=torch_compile,
         cpu_offload=cpu_offload,
-        overlapped_decode=overlapped_decode
+        overlapped_decode=overlapped_decode,
+        result_cache_dir=result_cache_dir,
+        async_io=async_io,
+        merge_lora=merge_lora,
+        int8_quantization=int8_quantization,
+        attention_chunk_threshold=attention_chunk_threshold,
+        inference_only=inference_only,
+        dcae_decoder_only=dcae_decoder_only,
     )
     print(model_demo)
 
+    recorder = None
+    if trace_path:
+        recorder = TraceRecorder(
+            profile_steps=[int(step) for step in profile_steps.split(",") if step],
+            profile_dir=os.path.join(os.path.dirname(os.path.abspath(trace_path)), "torch_profiles"),
+        )
+        model_demo.add_callback(recorder)
+
     data_sampler = DataSampler()
     sampled_json_data_list = data_sampler.sample()
+    params_list = []
     for json_data in sampled_json_data_list:
         (
             audio_duration,
@@ -62,7 +110,7 @@ def main(checkpoint_path, vocab_name, bf16, torch_compile, cpu_offload, overlapp
             lora_weight
         ) = json_data
 
-        model_demo(
+        params_list.append(dict(
             vocab_name=vocab_name,
             lora_name_or_path=lora_name_or_path,
             audio_duration=audio_duration,
@@ -85,7 +133,20 @@ def main(checkpoint_path, vocab_name, bf16, torch_compile, cpu_offload, overlapp
             guidance_scale_lyric=guidance_scale_lyric,
             save_path=audio_path,
             lora_weight=lora_weight
-        )
+        ))
+
+    if pipelined:
+        with StagedExecutor(model_demo) as executor:
+            for _ in executor.map(params_list):
+                pass
+    else:
+        for params in params_list:
+            model_demo(**params)
+    model_demo.flush_io()
+
+    if recorder is not None:
+        recorder.export_chrome_trace(trace_path)
+        print(recorder.format_summary())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+import argparse
+import os
+
+from acestep.models.lyrics_utils.vocab_utils import DEFAULT_VOCAB_NAME
+from acestep.text2music_dataset import build_audio_cache, pretokenize_lyrics, validate_dataset
+
+
+def get_split_paths(dataset_path, splits):
+    if not splits:
+        return [dataset_path]
+    return [os.path.join(dataset_path, split) for split in splits]
+
+
+def tokenize(args):
+    for split_path in get_split_paths(args.dataset_path, args.splits):
+        pretokenize_lyrics(
+            split_path,
+            vocab_name=args.vocab_name,
+            num_proc=args.num_proc,
+        )
+
+
+def cache_audio(args):
+    for split in args.splits or [None]:
+        build_audio_cache(
+            os.path.join(args.dataset_path, split) if split else args.dataset_path,
+            os.path.join(args.output_dir, split) if split else args.output_dir,
+            num_proc=args.num_proc,
+            max_duration=args.max_duration,
+            dtype=args.dtype,
+            shard_size_mb=args.shard_size_mb,
+        )
+
+
+def validate(args):
+    for split_path in get_split_paths(args.dataset_path, args.splits):
+        validate_dataset(
+            split_path,
+            num_proc=args.num_proc,
+            max_duration=args.max_duration,
+            exclude_too_long=args.exclude_too_long,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocess a Huggingface dataset created by convert2hf_dataset.py for training.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    tokenize_parser = subparsers.add_parser("tokenize", help="Tokenize lyrics once and store them in the lyric_token_idx column.")
+    tokenize_parser.add_argument("--dataset_path", type=str, default="./lora_dataset", help="Path to the dataset.")
+    tokenize_parser.add_argument("--splits", type=str, nargs="*", default=["train", "val", "test"], help="Splits under dataset_path to process. Pass no value to process dataset_path itself.")
+    tokenize_parser.add_argument("--vocab_name", type=str, default=DEFAULT_VOCAB_NAME, help="Vocab used by the lyric tokenizer, must match --vocab_name of the trainer.")
+    tokenize_parser.add_argument("--num_proc", type=int, default=os.cpu_count(), help="Number of tokenizer processes.")
+    tokenize_parser.set_defaults(func=tokenize)
+
+    cache_parser = subparsers.add_parser("cache_audio", help="Decode all audio once to 48kHz stereo memory-mappable shards.")
+    cache_parser.add_argument("--dataset_path", type=str, default="./lora_dataset", help="Path to the dataset.")
+    cache_parser.add_argument("--splits", type=str, nargs="*", default=["train", "val", "test"], help="Splits under dataset_path to process. Pass no value to process dataset_path itself.")
+    cache_parser.add_argument("--output_dir", type=str, default="./lora_dataset_audio_cache", help="Output directory, pass it to the trainer with --audio_cache_dir.")
+    cache_parser.add_argument("--num_proc", type=int, default=os.cpu_count(), help="Number of decoding processes.")
+    cache_parser.add_argument("--max_duration", type=float, default=240.0, help="Audio longer than this many seconds is truncated in the cache.")
+    cache_parser.add_argument("--dtype", type=str, default="int16", choices=["int16", "float16"], help="Storage dtype of the shards.")
+    cache_parser.add_argument("--shard_size_mb", type=int, default=1024, help="Approximate size of a shard in MB.")
+    cache_parser.set_defaults(func=cache_audio)
+
+    validate_parser = subparsers.add_parser("validate", help="Find silent, too long and undecodable audio and write the bad-sample index.")
+    validate_parser.add_argument("--dataset_path", type=str, default="./lora_dataset", help="Path to the dataset.")
+    validate_parser.add_argument("--splits", type=str, nargs="*", default=["train", "val", "test"], help="Splits under dataset_path to process. Pass no value to process dataset_path itself.")
+    validate_parser.add_argument("--num_proc", type=int, default=os.cpu_count(), help="Number of decoding processes.")
+    validate_parser.add_argument("--max_duration", type=float, default=240.0, help="Audio longer than this many seconds is reported as too long.")
+    validate_parser.add_argument("--exclude_too_long", action="store_true", help="Also exclude too long audio from training instead of truncating it.")
+    validate_parser.set_defaults(func=validate)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("peft")
+
+from acestep.lora_merge import LoRAMerger
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(16, 32), torch.nn.SiLU(), torch.nn.Linear(32, 8)).float()
+
+
+def test_merge_unmerge_round_trip_float32():
+    model = tiny_model()
+    originals = {name: param.detach().clone() for name, param in model.named_parameters()}
+    deltas = {"0": torch.randn(32, 16), "2": torch.randn(8, 32)}
+    merger = LoRAMerger()
+
+    merger.merge(model, deltas, scale=0.5)
+    assert not torch.equal(model[0].weight, originals["0.weight"])
+    # switching the weight starts from the originals again instead of stacking deltas
+    merger.merge(model, deltas, scale=1.0)
+    assert torch.equal(model[0].weight, originals["0.weight"] + deltas["0"])
+    merger.unmerge(model)
+
+    for name, param in model.named_parameters():
+        assert torch.equal(param, originals[name]), name
+    assert torch.equal(merger._originals["0"], originals["0.weight"])
+
+
+def test_merge_rejects_mismatched_delta():
+    model = tiny_model()
+    with pytest.raises(ValueError):
+        LoRAMerger().merge(model, {"0": torch.randn(16, 16)})
@@ -0,0 +1,55 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("peft")
+
+from acestep.multi_lora import MultiLoRA, MultiLoRALayer
+
+
+class TinyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.lyric_embs = torch.nn.Embedding(12, 8)
+        self.proj = torch.nn.Linear(8, 4)
+
+
+def test_layer_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        MultiLoRALayer(torch.nn.Linear(8, 4), None)
+
+
+def test_mismatched_factors_fail_at_install():
+    model = TinyModel()
+    multi_lora = MultiLoRA(model)
+    # lyric_embs factors of a checkpoint trained with a larger vocab
+    factors = {
+        "proj": (torch.randn(2, 8), torch.randn(4, 2), 1.0),
+        "lyric_embs": (torch.randn(2, 16), torch.randn(8, 2), 1.0),
+    }
+    with pytest.raises(ValueError, match="lyric_embs"):
+        multi_lora.add_adapter("resized", factors)
+    assert "resized" not in multi_lora
+
+    multi_lora.add_adapter("ok", {**factors, "lyric_embs": (torch.randn(2, 12), torch.randn(8, 2), 1.0)})
+    multi_lora.install()
+    assert isinstance(model.lyric_embs, MultiLoRALayer) and isinstance(model.proj, MultiLoRALayer)
+    with pytest.raises(ValueError, match="lyric_embs"):
+        multi_lora.add_adapter("resized", factors)
+
+
+def test_route_covers_doubled_batches():
+    torch.manual_seed(0)
+    model = TinyModel()
+    multi_lora = MultiLoRA(model)
+    multi_lora.add_adapter("a", {"proj": (torch.randn(2, 8), torch.randn(4, 2), 1.0)})
+    multi_lora.add_adapter("b", {"proj": (torch.randn(2, 8), torch.randn(4, 2), 1.0)})
+    multi_lora.set_route(["a", None, "b"], [1.0, 1.0, 0.5])
+    x = torch.randn(3, 8)
+    with torch.no_grad():
+        single = model.proj(x)
+        # classifier free guidance stacks the conditional and unconditional halves
+        doubled = model.proj(torch.cat([x, x]))
+    torch.testing.assert_close(doubled, torch.cat([single, single]))
+    torch.testing.assert_close(single[1], model.proj.base_layer(x[1]))
+    with pytest.raises(ValueError, match="batch of 3"):
+        model.proj(torch.randn(4, 8))
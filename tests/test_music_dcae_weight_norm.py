@@ -0,0 +1,71 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+pytest.importorskip("torchaudio")
+
+from benchmarks.tiny_models import build_tiny_music_dcae, frame_length_for
+
+
+def tiny_music_dcae():
+    torch.manual_seed(0)
+    # train mode keeps the weight norm of the vocoder
+    return build_tiny_music_dcae().train()
+
+
+def effective_weights(vocoder):
+    # weight_norm only fixes g * v / ||v||, g and v themselves change when it is applied again
+    return [
+        (conv.weight_g * conv.weight_v / conv.weight_v.norm(dim=(1, 2), keepdim=True)).detach().clone()
+        for conv in vocoder.head.weight_norm_convs()
+    ]
+
+
+def test_eval_folding_keeps_decode_output():
+    music_dcae = tiny_music_dcae()
+    latents = torch.randn(1, 8, 16, frame_length_for(2.0), generator=torch.Generator().manual_seed(0))
+    assert not music_dcae.vocoder.head.weight_norm_folded
+    _, reference = music_dcae.decode(latents)
+
+    music_dcae.eval()
+    assert music_dcae.vocoder.head.weight_norm_folded
+    _, folded = music_dcae.decode(latents)
+
+    torch.testing.assert_close(folded[0], reference[0], rtol=1e-4, atol=1e-5)
+
+
+def test_train_eval_round_trip():
+    music_dcae = tiny_music_dcae()
+    vocoder = music_dcae.vocoder
+    with torch.no_grad():
+        # trained checkpoints have ||v|| != g, unlike freshly initialized weights
+        for conv in vocoder.head.weight_norm_convs():
+            conv.weight_v.mul_(3.0)
+    originals = effective_weights(vocoder)
+
+    music_dcae.eval()
+    folded = [conv.weight.detach().clone() for conv in vocoder.head.weight_norm_convs()]
+    # a second eval() must not fold the folded weights again
+    music_dcae.eval()
+    assert vocoder.head.weight_norm_folded
+    for conv, weight in zip(vocoder.head.weight_norm_convs(), folded):
+        assert torch.equal(conv.weight, weight)
+        assert not hasattr(conv, "weight_g")
+
+    music_dcae.train()
+    assert not vocoder.head.weight_norm_folded
+    for conv in vocoder.head.weight_norm_convs():
+        assert conv.weight_g.requires_grad and conv.weight_v.requires_grad
+    for weight, original in zip(effective_weights(vocoder), originals):
+        torch.testing.assert_close(weight, original)
+
+
+def test_eval_keeps_frozen_vocoder_frozen():
+    music_dcae = tiny_music_dcae()
+    # trainer.py freezes the whole MusicDCAE
+    music_dcae.requires_grad_(False)
+
+    music_dcae.eval()
+    assert not any(param.requires_grad for param in music_dcae.vocoder.parameters())
+    music_dcae.train()
+    assert not any(param.requires_grad for param in music_dcae.vocoder.parameters())
@@ -0,0 +1,20 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("safetensors")
+
+from acestep.result_cache import ResultCache
+
+
+def test_put_encoded_bytes(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    cache.put("ab" * 32, [b"RIFF0", b"RIFF1"], {"prompt": "pop"}, audio_format="wav")
+
+    result = cache.get("ab" * 32)
+    assert [path.endswith(f"{i}.wav") for i, path in enumerate(result["audio_paths"])] == [True, True]
+    contents = []
+    for path in result["audio_paths"]:
+        with open(path, "rb") as f:
+            contents.append(f.read())
+    assert contents == [b"RIFF0", b"RIFF1"]
+    assert result["input_params_json"] == {"prompt": "pop"}
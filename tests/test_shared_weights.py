@@ -0,0 +1,27 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from acestep.shared_weights import load_shared_weights, save_shared_weights
+
+
+def test_load_maps_saved_weights(tmp_path):
+    path = str(tmp_path / "model.pt")
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.LayerNorm(8))
+    save_shared_weights(model, path)
+    with torch.device("meta"):
+        shared = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.LayerNorm(8))
+    load_shared_weights(shared, path)
+
+    for (name, param), (_, shared_param) in zip(model.named_parameters(), shared.named_parameters()):
+        assert torch.equal(param, shared_param), name
+        assert not shared_param.requires_grad
+
+
+def test_load_rejects_shape_mismatch(tmp_path):
+    path = str(tmp_path / "model.pt")
+    save_shared_weights(torch.nn.Embedding(16, 8), path)
+    with torch.device("meta"):
+        shared = torch.nn.Embedding(12, 8)
+    with pytest.raises(ValueError, match="shape"):
+        load_shared_weights(shared, path)
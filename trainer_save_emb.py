@@ -15,7 +15,7 @@ from torch.utils.data import DataLoader
 from acestep.schedulers.scheduling_flow_match_euler_discrete import (
     FlowMatchEulerDiscreteScheduler,
 )
-from acestep.text2music_dataset import Text2MusicDataset
+from acestep.text2music_dataset import Text2MusicDataset, BadSampleExcludingSampler
 from loguru import logger
 from transformers import AutoModel, Wav2Vec2FeatureExtractor
 import torchaudio
@@ -28,9 +28,14 @@ from tqdm import tqdm
 import random
 import os
 from acestep.pipeline_ace_step import ACEStepPipeline
+from acestep.preview_worker import PreviewWorker
+from acestep.lora_checkpoint_writer import AsyncLoraCheckpointWriter, LORA_WEIGHT_NAME_SAFE, lora_file_metadata
 from acestep.models.lyrics_utils.vocab_utils import DEFAULT_VOCAB_NAME
+from peft.utils import get_peft_model_state_dict
 
 
+LYRIC_EMBS_WEIGHT_NAME = "lyric_embs.pt"
+
 matplotlib.use("Agg")
 torch.backends.cudnn.benchmark = False
 torch.set_float32_matmul_precision("high")
@@ -56,13 +61,20 @@ class Pipeline(LightningModule):
         dataset_path: str = "./data/your_dataset_path",
         lora_config_path: str = None,
         adapter_name: str = "lora_adapter",
-        vocab_name: str = DEFAULT_VOCAB_NAME
+        vocab_name: str = DEFAULT_VOCAB_NAME,
+        preview_duration: float = 240,
+        preview_infer_steps: int = 60,
+        preview_device: str = None,
+        preview_in_background: bool = True,
+        audio_cache_dir: str = None,
     ):
         super().__init__()
 
         self.save_hyperparameters()
         self.is_train = train
         self.T = T
+        self.preview_batch = None
+        self.preview_worker = None
 
         # Initialize scheduler
         self.scheduler = self.get_scheduler()
@@ -457,10 +469,15 @@ class Pipeline(LightningModule):
         return [optimizer], [{"scheduler": lr_scheduler, "interval": "step"}]
 
     def train_dataloader(self):
-        self.train_dataset = Text2MusicDataset(split="train", dataset_path=self.hparams.dataset_path)
+        self.train_dataset = Text2MusicDataset(
+            split="train",
+            dataset_path=self.hparams.dataset_path,
+            vocab_name=self.hparams.vocab_name,
+            audio_cache_dir=self.hparams.audio_cache_dir,
+        )
         return DataLoader(
             self.train_dataset,
-            shuffle=True,
+            sampler=BadSampleExcludingSampler(self.train_dataset, shuffle=True),
             batch_size=2,
             num_workers=self.hparams.num_workers,
             pin_memory=True,
@@ -468,10 +485,15 @@ class Pipeline(LightningModule):
         )
     
     def val_dataloader(self):
-        self.val_dataset = Text2MusicDataset(split="val", dataset_path=self.hparams.dataset_path)
+        self.val_dataset = Text2MusicDataset(
+            split="val",
+            dataset_path=self.hparams.dataset_path,
+            vocab_name=self.hparams.vocab_name,
+            audio_cache_dir=self.hparams.audio_cache_dir,
+        )
         return DataLoader(
             self.val_dataset,
-            shuffle=False,
+            sampler=BadSampleExcludingSampler(self.val_dataset, shuffle=False),
             batch_size=2,
             num_workers=self.hparams.num_workers,
             pin_memory=True,
@@ -479,7 +501,12 @@ class Pipeline(LightningModule):
         )
 
     def test_dataloader(self):
-        self.test_dataset = Text2MusicDataset(split="test", dataset_path=self.hparams.dataset_path)
+        self.test_dataset = Text2MusicDataset(
+            split="test",
+            dataset_path=self.hparams.dataset_path,
+            vocab_name=self.hparams.vocab_name,
+            audio_cache_dir=self.hparams.audio_cache_dir,
+        )
         return DataLoader(
             self.test_dataset,
             shuffle=False,
@@ -751,7 +778,7 @@ class Pipeline(LightningModule):
             mhubert_ssl_hidden_states,
         ) = self.preprocess(batch, train=False)
 
-        infer_steps = 60
+        infer_steps = self.hparams.preview_infer_steps
         guidance_scale = 15.0
         omega_scale = 10.0
         seed_num = 1234
@@ -763,7 +790,7 @@ class Pipeline(LightningModule):
             seed = random.randint(0, 2**32 - 1)
             random_generators[i].manual_seed(seed)
             seeds.append(seed)
-        duration = 240  # Fixed duration (24 * 10)
+        duration = self.hparams.preview_duration
         pred_latents = self.diffusion_process(
             duration=duration,
             encoder_text_hidden_states=encoder_text_hidden_states,
@@ -799,27 +826,26 @@ class Pipeline(LightningModule):
         lyrics = "\n".join(lyrics)
         return lyrics
 
-    def plot_step(self, batch, batch_idx):
-        global_step = self.global_step
-        if (
-            global_step % self.hparams.every_plot_step != 0
-            or self.local_rank != 0
-            or torch.distributed.get_rank() != 0
-            or torch.cuda.current_device() != 0
-        ):
-            return
-        
-        test_loader = self.test_dataloader()
-        if isinstance(test_loader, list):
-            test_loader = test_loader[0]
-        try:
-            batch = next(iter(test_loader))
-            batch = {k: v.to(self.device) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
-        except StopIteration:
-            return
-        
-        results = self.predict_step(batch)
+    def get_preview_batch(self):
+        # load the first test batch once instead of rebuilding the test dataloader for every preview
+        if self.preview_batch is None:
+            test_dataset = Text2MusicDataset(
+                split="test",
+                dataset_path=self.hparams.dataset_path,
+                vocab_name=self.hparams.vocab_name,
+                audio_cache_dir=self.hparams.audio_cache_dir,
+            )
+            test_loader = DataLoader(
+                test_dataset,
+                shuffle=False,
+                batch_size=2,
+                num_workers=0,
+                collate_fn=test_dataset.collate_fn,
+            )
+            self.preview_batch = next(iter(test_loader))
+        return {k: v.to(self.device) if isinstance(v, torch.Tensor) else v for k, v in self.preview_batch.items()}
 
+    def save_preview_results(self, results, save_dir):
         target_wavs = results["target_wavs"]
         pred_wavs = results["pred_wavs"]
         keys = results["keys"]
@@ -827,18 +853,13 @@ class Pipeline(LightningModule):
         candidate_lyric_chunks = results["candidate_lyric_chunks"]
         sr = results["sr"]
         seeds = results["seeds"]
+        os.makedirs(save_dir, exist_ok=True)
         i = 0
         for key, target_wav, pred_wav, prompt, candidate_lyric_chunk, seed in zip(
             keys, target_wavs, pred_wavs, prompts, candidate_lyric_chunks, seeds
         ):
-            key = key
-            prompt = prompt
             lyric = self.construct_lyrics(candidate_lyric_chunk)
             key_prompt_lyric = f"# KEY\n\n{key}\n\n\n# PROMPT\n\n{prompt}\n\n\n# LYRIC\n\n{lyric}\n\n# SEED\n\n{seed}\n\n"
-            log_dir = self.logger.save_dir
-            save_dir = f"{log_dir}/test_results/step_{self.global_step}"
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir, exist_ok=True)
             torchaudio.save(
                 f"{save_dir}/target_wav_{key}_{i}.wav", target_wav.float().cpu(), sr
             )
@@ -851,21 +872,89 @@ class Pipeline(LightningModule):
                 f.write(key_prompt_lyric)
             i += 1
 
+    def plot_step(self, batch, batch_idx):
+        global_step = self.global_step
+        if (
+            global_step % self.hparams.every_plot_step != 0
+            or self.local_rank != 0
+            or torch.distributed.get_rank() != 0
+            or torch.cuda.current_device() != 0
+        ):
+            return
+
+        log_dir = self.logger.save_dir
+        save_dir = f"{log_dir}/test_results/step_{global_step}"
+
+        if not self.hparams.preview_in_background:
+            try:
+                batch = self.get_preview_batch()
+            except StopIteration:
+                return
+            results = self.predict_step(batch)
+            self.save_preview_results(results, save_dir)
+            return
+
+        if self.preview_worker is None:
+            module_kwargs = dict(self.hparams)
+            module_kwargs["train"] = False
+            self.preview_worker = PreviewWorker(
+                module_cls=type(self),
+                module_kwargs=module_kwargs,
+                device=self.hparams.preview_device or self.device,
+            )
+        # snapshot only the trainable tensors, the worker already holds the frozen weights
+        state_dict = {
+            name: param.detach().to("cpu", copy=True)
+            for name, param in self.transformers.named_parameters()
+            if param.requires_grad
+        }
+        self.preview_worker.submit(global_step, state_dict, save_dir)
+
+    def on_train_end(self):
+        if self.preview_worker is not None:
+            self.preview_worker.close()
+            self.preview_worker = None
+
 class SaveLoraPtCallback(Callback):
-    def __init__(self, adapter_name="default", every_n_steps=1000):
+    def __init__(self, adapter_name="default", every_n_steps=1000, keep_last_n=None):
         self.adapter_name = adapter_name
         self.every_n_steps = every_n_steps
+        self.keep_last_n = keep_last_n
+        self.writer = None
 
     def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
         step = trainer.global_step
         if step > 0 and step % self.every_n_steps == 0 and trainer.is_global_zero:
-            log_dir = trainer.logger.save_dir
-            checkpoint_dir = os.path.join(log_dir, "checkpoints", f"step={step}_lora")
-            os.makedirs(checkpoint_dir, exist_ok=True)
-            pl_module.transformers.save_lora_adapter(checkpoint_dir, adapter_name=self.adapter_name)
-
-            lyric_checkpoint_dir = os.path.join(log_dir, "checkpoints", "lyric_embs.pt")
-            torch.save(pl_module.transformers.lyric_embs.state_dict(), lyric_checkpoint_dir)
+            if self.writer is None:
+                log_dir = trainer.logger.save_dir
+                self.writer = AsyncLoraCheckpointWriter(
+                    os.path.join(log_dir, "checkpoints"), keep_last_n=self.keep_last_n
+                )
+            state_dicts = {
+                LORA_WEIGHT_NAME_SAFE: get_peft_model_state_dict(
+                    pl_module.transformers, adapter_name=self.adapter_name
+                ),
+                # the resized lyric embedding table, a torch.save state dict as before
+                LYRIC_EMBS_WEIGHT_NAME: pl_module.transformers.lyric_embs.state_dict(),
+            }
+            lora_config = pl_module.transformers.peft_config[self.adapter_name]
+            metadata = {
+                "epoch": trainer.current_epoch,
+                "adapter_name": self.adapter_name,
+                "lora_config": lora_config.to_dict(),
+                "vocab_name": pl_module.hparams.vocab_name,
+            }
+            # the adapter config goes into the safetensors metadata, where load_lora_adapter reads it
+            file_metadata = {LORA_WEIGHT_NAME_SAFE: lora_file_metadata(lora_config)}
+            self.writer.save(step, state_dicts, metadata, file_metadata)
+
+    def on_train_end(self, trainer, pl_module):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def on_exception(self, trainer, pl_module, exception):
+        self.on_train_end(trainer, pl_module)
 
 def main(args):
     model = Pipeline(
@@ -878,12 +967,18 @@ def main(args):
         checkpoint_dir=args.checkpoint_dir,
         adapter_name=args.exp_name,
         lora_config_path=args.lora_config_path,
-        vocab_name=args.vocab_name
+        vocab_name=args.vocab_name,
+        preview_duration=args.preview_duration,
+        preview_infer_steps=args.preview_infer_steps,
+        preview_device=args.preview_device,
+        preview_in_background=not args.preview_in_foreground,
+        audio_cache_dir=args.audio_cache_dir,
     )
 
     lora_callback = SaveLoraPtCallback(
         adapter_name=args.exp_name,
-        every_n_steps=args.every_n_train_steps
+        every_n_steps=args.every_n_train_steps,
+        keep_last_n=args.keep_last_n_checkpoints or None,
     )
     # add datetime str to version
     logger_callback = TensorBoardLogger(
@@ -932,7 +1027,9 @@ if __name__ == "__main__":
     args.add_argument("--epochs", type=int, default=-1)
     args.add_argument("--max_steps", type=int, default=4000)
     args.add_argument("--every_n_train_steps", type=int, default=500)
+    args.add_argument("--keep_last_n_checkpoints", type=int, default=0)
     args.add_argument("--dataset_path", type=str, default="./lora_dataset")
+    args.add_argument("--audio_cache_dir", type=str, default=None)
     args.add_argument("--exp_name", type=str, default="speaker_lyric_emb")
     args.add_argument("--precision", type=str, default="32")
     args.add_argument("--accumulate_grad_batches", type=int, default=1)
@@ -949,5 +1046,9 @@ if __name__ == "__main__":
     args.add_argument('--wandb_project', type=str, default="pansori-gen")
     args.add_argument('--wandb_name', type=str, default="speaker_lyric_emb")
     args.add_argument('--vocab_name', type=str, default="pansori_vocab")
+    args.add_argument("--preview_duration", type=float, default=240)
+    args.add_argument("--preview_infer_steps", type=int, default=60)
+    args.add_argument("--preview_device", type=str, default=None)
+    args.add_argument("--preview_in_foreground", action="store_true")
     args = args.parse_args()
     main(args)